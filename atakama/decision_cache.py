@@ -0,0 +1,166 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Cache of rule engine decisions, for identical requests repeated within seconds."""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple, FrozenSet
+
+from atakama.rule_engine import (
+    RuleEngine,
+    ApprovalRequest,
+    FrozenApprovalRequest,
+    ProfileInfo,
+    RequestType,
+)
+
+
+def decision_key(request: ApprovalRequest) -> Hashable:
+    """Everything rules can see of a request.
+
+    Includes the profile words and auth meta, not only the ids, so that a cached
+    decision is always the one the engine would make.  A `FrozenApprovalRequest` is
+    its own key, with a precomputed hash.
+    """
+    if isinstance(request, FrozenApprovalRequest):
+        return request
+    profile = request.profile
+    return (
+        request.request_type,
+        request.device_id,
+        profile.profile_id,
+        request.cryptographic_id,
+        tuple(profile.profile_words),
+        tuple((meta.meta, meta.complete) for meta in request.auth_meta),
+    )
+
+
+class DecisionCache:
+    """Bounded LRU cache of `RuleEngine.approve_request` results, with a TTL.
+
+    Only decisions that don't depend on rule state are cached: the approving
+    ruleset, and every ruleset evaluated before it, must hold stateless rules only
+    (see `RulePlugin.is_stateless`).  Requests whose first ruleset uses quota bypass
+    the cache entirely.
+
+    Call reset() with the new engine on policy reload, and clear_quota() instead of
+    the engine's: both invalidate the affected entries.  reset() must also be called
+    after modifying the engine's rule map.
+
+    Hits are recorded by the tracer and metrics of the engine's plan, if any, see
+    `EvaluationPlan.record_cached`.
+
+    Thread safe.  The counters are informational and not reset by reset().
+    """
+
+    def __init__(
+        self,
+        engine: RuleEngine,
+        maxsize: int = 4096,
+        ttl: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        assert maxsize > 0 and ttl > 0, "maxsize and ttl must be positive"
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # key -> (expiry, result, profile_id), least recently used first
+        self._entries: "OrderedDict[Hashable, Tuple[float, Optional[int], bytes]]" = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+        """Requests evaluated, and their decision cached."""
+        self.bypassed = 0
+        """Requests evaluated, whose decision can't be cached."""
+        # engine, and per request type: ids of the sets whose approvals can be cached,
+        # and whether rejections can be, replaced at once by reset()
+        self._state: Tuple[
+            RuleEngine, Dict[RequestType, Tuple[FrozenSet[int], bool]]
+        ] = (engine, {})
+        self.reset(engine)
+
+    @property
+    def engine(self) -> RuleEngine:
+        return self._state[0]
+
+    def reset(self, engine: RuleEngine):
+        """Use a new engine, dropping all entries."""
+        cacheable = {}
+        for rtype, tree in engine.map.items():
+            stateless = []
+            for rset in tree:
+                if not all(rule.is_stateless() for rule in rset):
+                    break
+                stateless.append(id(rset))
+            # approvals by these sets, and rejections by all sets, are cacheable
+            cacheable[rtype] = (frozenset(stateless), len(stateless) == len(tree))
+        with self._lock:
+            self._state = (engine, cacheable)
+            self._entries.clear()
+
+    def approve_request(self, request: ApprovalRequest) -> Optional[int]:
+        """Same as `RuleEngine.approve_request`, from the cache if possible."""
+        state = self._state
+        engine, cacheable = state
+        sets, rejections = cacheable.get(request.request_type, (frozenset(), True))
+        if not sets and not rejections:
+            with self._lock:
+                self.bypassed += 1
+            return engine.approve_request(request)
+
+        key = decision_key(request)
+        hit = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and state is self._state:
+                if entry[0] > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    hit = True
+                else:
+                    del self._entries[key]
+        if hit:
+            # recorded outside the lock, like the decisions of the engine
+            plan = engine.plan
+            if plan is not None:
+                plan.record_cached(request, entry[1])
+            return entry[1]
+
+        result = engine.approve_request(request)
+        with self._lock:
+            if not ((result in sets) if result else rejections):
+                self.bypassed += 1
+            else:
+                self.misses += 1
+                # a reset while evaluating makes the result stale
+                if state is self._state:
+                    expiry = self._clock() + self.ttl
+                    self._entries[key] = (expiry, result, request.profile.profile_id)
+                    self._entries.move_to_end(key)
+                    if len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+        return result
+
+    def clear_quota(self, profile: ProfileInfo):
+        """Clear the profile's quota in the engine, and drop its cached decisions."""
+        with self._lock:
+            engine = self._state[0]
+            pid = profile.profile_id
+            for key in [k for k, ent in self._entries.items() if ent[2] == pid]:
+                del self._entries[key]
+        engine.clear_quota(profile)
+
+    def clear(self):
+        """Drop all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+__all__ = ["DecisionCache", "decision_key"]
@@ -0,0 +1,469 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Compiled evaluation of a RuleEngine, see `RuleEngine.compile`."""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING
+
+from atakama.metrics import EngineMetrics
+from atakama.quota_lock import QUOTA_KEY_ALL
+from atakama.request import ApprovalRequest, RequestType
+from atakama.tracing import DecisionTracer, Explanation, RuleResult, RulesetResult
+
+if TYPE_CHECKING:
+    from atakama.rule_engine import RulePlugin, RuleSet, RuleTree
+
+log = logging.getLogger(__name__)
+
+
+def compile_stripes(
+    rules: Tuple["RulePlugin", ...],
+    bound: Dict[int, Tuple],
+    stripes_for: Callable[[List[Hashable]], List[int]],
+) -> Optional[Callable[[ApprovalRequest], Optional[List[int]]]]:
+    """Function returning the lock stripes of the quota keys of a request.
+
+    The function returns None, meaning the whole lock, if a rule returns
+    QUOTA_KEY_ALL or fails.  None if a rule has no quota_key(): all requests then
+    hold the whole lock, don't bother asking the others.  See `RuleSet.compile`.
+    """
+    keyers = tuple((rule, bound[id(rule)][2]) for rule in rules)
+    if any(keyer is None for _, keyer in keyers):
+        return None
+
+    def stripes(request: ApprovalRequest) -> Optional[List[int]]:
+        keys = []
+        for rule, keyer in keyers:
+            try:
+                qkey = keyer(request)
+            except Exception as ex:
+                log.error("error in rule quota_key %s: %r", rule, ex)
+                return None
+            if qkey is QUOTA_KEY_ALL:
+                return None
+            if qkey is not None:
+                keys.append(qkey)
+        return stripes_for(keys)
+
+    return stripes
+
+
+def compile_use(
+    rules: Tuple["RulePlugin", ...],
+    bound: Dict[int, Tuple],
+    release_quota: Callable[[ApprovalRequest, Tuple["RulePlugin", ...]], None],
+) -> Optional[Callable[[ApprovalRequest], bool]]:
+    """Function using the quotas of a request, called with the RuleSet's lock held.
+
+    Quotas are used in list order.  If a rule refuses or fails, the quotas used by
+    the rules before it are released.  None if no rule implements use_quota().
+    """
+    users = tuple(
+        (i, bound[id(rule)][1])
+        for i, rule in enumerate(rules)
+        if rule.overrides("use_quota")
+    )
+    if not users:
+        return None
+
+    def use(request: ApprovalRequest) -> bool:
+        for i, user in users:
+            try:
+                if user(request) is not False:
+                    continue
+                log.debug("quota refused by rule %s", rules[i])
+            except Exception as ex:
+                log.error("error in rule use_quota %s: %r", rules[i], ex)
+            release_quota(request, rules[:i])
+            return False
+        return True
+
+    return use
+
+
+class RuleStats:
+    """Evaluation count, rejections and elapsed time of a rule or ruleset."""
+
+    __autodoc__ = False
+    __slots__ = ("count", "rejected", "elapsed")
+
+    def __init__(self):
+        # updated without locks: stats are approximate under concurrency
+        self.count = 0
+        self.rejected = 0
+        self.elapsed = 0.0
+
+    def record(self, elapsed: float, res: Any):
+        self.count += 1
+        self.elapsed += elapsed
+        if not res:
+            self.rejected += 1
+
+    def cost(self) -> float:
+        """Mean seconds per evaluation."""
+        return self.elapsed / self.count if self.count else 0.0
+
+    def reject_rate(self) -> float:
+        """Smoothed probability of rejection, unseen rules are 50/50."""
+        return (self.rejected + 1) / (self.count + 2)
+
+
+class EvaluationPlan:  # pylint: disable=too-many-instance-attributes
+    """Flattened evaluation plan for a RuleEngine, see `RuleEngine.compile`.
+
+    Each request type maps to a tuple of (ruleset id, compiled ruleset) pairs.
+    Rules and trees shared among rulesets and request types are compiled once.
+
+    Rules with identical configuration in more than one ruleset of a tree are
+    evaluated once per request, see `RulePlugin.pure`.
+
+    Adaptive plans time one request in SAMPLE_EVERY, and every REORDER_EVERY samples
+    reorder evaluation to minimize expected cost: cheap, frequently rejecting rules
+    first within a RuleSet, cheap, frequently approving sets first within a RuleTree.
+    Impure rules, `RuleSet.ordered` and `RuleTree.ordered` keep the declared order.
+
+    With `metrics`, every decision is counted, and rule and ruleset evaluations are
+    counted and timed for one request in `EngineMetrics.sample_every`, see
+    `atakama.metrics`.  The sampling interval then also applies to adaptive plans.
+
+    With a `tracer`, every decision is recorded with the result of each rule, see
+    `atakama.tracing`.
+    """
+
+    __autodoc__ = False
+    __slots__ = (
+        "rules",
+        "rule_ids",
+        "rule_stats",
+        "set_stats",
+        "metrics",
+        "tracer",
+        "_map",
+        "_bound",
+        "_memo_keys",
+        "_orders",
+        "_compiled",
+        "_trees",
+        "_sampled",
+        "_memoize",
+        "_requests",
+        "_sample_every",
+        "_observed",
+        "_set_ids",
+        "_ordered",
+        "_explainers",
+        "_explain_local",
+        "_reorder_lock",
+    )
+
+    SAMPLE_EVERY = 16
+    REORDER_EVERY = 1024
+
+    def __init__(
+        self,
+        rule_map: Dict[RequestType, "RuleTree"],
+        adaptive=False,
+        metrics: Optional[EngineMetrics] = None,
+        tracer: Optional[DecisionTracer] = None,
+    ):
+        self._map = rule_map
+        self.metrics = metrics
+        self.tracer = tracer
+        self._observed = metrics is not None or tracer is not None
+        self._set_ids: Dict[int, str] = {}
+        if tracer is not None:
+            self._set_ids = {
+                id(rset): rset.stable_id for tree in rule_map.values() for rset in tree
+            }
+        self._bound: Dict[int, Tuple] = {}
+        self._memo_keys: Dict[int, Dict[int, str]] = {}
+        unique: Dict[int, "RulePlugin"] = {}
+        for tree in rule_map.values():
+            if id(tree) not in self._memo_keys:
+                self._memo_keys[id(tree)] = self._shared_memo_keys(tree)
+                for rset in tree:
+                    for rule in rset:
+                        unique.setdefault(id(rule), rule)
+        self.rules: Tuple["RulePlugin", ...] = tuple(unique.values())
+        self.rule_ids: Tuple[str, ...] = tuple(rule.rule_id for rule in self.rules)
+        self._memoize = frozenset(
+            rtype for rtype, tree in rule_map.items() if self._memo_keys[id(tree)]
+        )
+
+        self.rule_stats: Optional[Dict[int, RuleStats]] = None
+        self.set_stats: Optional[Dict[int, RuleStats]] = None
+        self._sampled: Optional[Dict[RequestType, Tuple]] = None
+        self._orders: Dict[int, Optional[Tuple[int, ...]]] = {}
+        self._requests = 0
+        self._sample_every = metrics.sample_every if metrics else self.SAMPLE_EVERY
+        self._reorder_lock = threading.Lock()
+        if adaptive:
+            self.rule_stats = {id(rule): RuleStats() for rule in self.rules}
+            self.set_stats = {
+                id(rset): RuleStats() for tree in rule_map.values() for rset in tree
+            }
+        self._trees: Dict[RequestType, Tuple] = {}
+        self._compiled: Dict[int, Tuple] = {}
+        self._explain_local = threading.local()
+        self._build()
+
+    @staticmethod
+    def _shared_memo_keys(tree: "RuleTree") -> Dict[int, str]:
+        """Memo keys of rules whose configuration appears in more than one ruleset."""
+        keys: Dict[int, str] = {}
+        sets_by_key: Dict[str, set] = defaultdict(set)
+        for rset in tree:
+            for rule in rset:
+                key = rule.memo_key()
+                if key is not None:
+                    keys[id(rule)] = key
+                    sets_by_key[key].add(id(rset))
+        return {rid: key for rid, key in keys.items() if len(sets_by_key[key]) > 1}
+
+    def _timed(self, rule: "RulePlugin", approver: Callable) -> Callable:
+        stats = self.rule_stats[id(rule)]
+
+        def timed(request):
+            start = time.perf_counter()
+            res = False
+            try:
+                res = approver(request)
+                return res
+            finally:
+                stats.record(time.perf_counter() - start, res)
+
+        return timed
+
+    def _compile_set(self, rset: "RuleSet", memo_keys: Dict[int, str]) -> Tuple:
+        """Plain and sampled (adaptive or metrics plans only) functions for the set."""
+        order = self._orders.get(id(rset))
+        tracer = self.tracer
+        traced: Optional[Callable] = None
+        if tracer is not None:
+
+            def trace_rule(rule, approver):
+                return tracer.wrap_rule(rset, rule, approver)
+
+            traced = trace_rule
+        plain = rset.compile(self._bound, memo_keys, order, traced)
+        metrics = self.metrics
+        if self.rule_stats is None and metrics is None:
+            return plain, None
+
+        def wrap(rule, approver):
+            if metrics is not None:
+                approver = metrics.wrap_rule(rule, approver)
+            if self.rule_stats is not None:
+                approver = self._timed(rule, approver)
+            if tracer is not None:
+                approver = tracer.wrap_rule(rset, rule, approver)
+            return approver
+
+        sampled = rset.compile(self._bound, memo_keys, order, wrap)
+        if metrics is not None:
+            sampled = metrics.wrap_set(rset, sampled)
+        return plain, sampled
+
+    def _build(self, previous: Optional[Dict[int, Tuple]] = None):
+        """Compile (or recompile) rulesets according to the current orders.
+
+        Rulesets that are in `previous`, and whose order did not change, are reused.
+        """
+        previous = previous or {}
+        compiled: Dict[int, Tuple] = {}
+        trees: Dict[int, Tuple] = {}
+        for tree in self._map.values():
+            if id(tree) in trees:
+                continue
+            memo_keys = self._memo_keys[id(tree)]
+            entries = []
+            for rset in tree:
+                if id(rset) not in compiled:
+                    if id(rset) in previous:
+                        compiled[id(rset)] = previous[id(rset)]
+                    else:
+                        compiled[id(rset)] = self._compile_set(rset, memo_keys)
+                entries.append((rset, compiled[id(rset)]))
+            order = self._orders.get(id(tree))
+            if order is not None:
+                entries = [entries[i] for i in order]
+            trees[id(tree)] = tuple(entries)
+
+        self._trees = {
+            rtype: tuple((id(rset), fns[0]) for rset, fns in trees[id(tree)])
+            for rtype, tree in self._map.items()
+        }
+        self._ordered: Dict[RequestType, Tuple["RuleSet", ...]] = {
+            rtype: tuple(rset for rset, _ in trees[id(tree)])
+            for rtype, tree in self._map.items()
+        }
+        # compiled on demand, in the current orders
+        self._explainers: Dict[int, Callable] = {}
+        set_stats = self.set_stats
+        if set_stats is not None or self.metrics is not None:
+            self._sampled = {
+                rtype: tuple(
+                    (
+                        id(rset),
+                        fns[1],
+                        set_stats[id(rset)] if set_stats is not None else None,
+                    )
+                    for rset, fns in trees[id(tree)]
+                )
+                for rtype, tree in self._map.items()
+            }
+        self._compiled = compiled
+
+    def reorder(self):
+        """Recompute evaluation orders from the collected statistics."""
+        rule_stats, set_stats = self.rule_stats, self.set_stats
+        if rule_stats is None:
+            return
+        changed = set()
+        for tree in self._map.values():
+            for rset in tree:
+                if rset.ordered or not all(rule.pure for rule in rset):
+                    continue
+                # expected cost of an AND chain: ascending cost per rejection
+                order = tuple(
+                    sorted(
+                        range(len(rset)),
+                        key=lambda i, r=rset: (
+                            rule_stats[id(r[i])].cost()
+                            / rule_stats[id(r[i])].reject_rate()
+                        ),
+                    )
+                )
+                if order != self._orders.get(id(rset), tuple(range(len(rset)))):
+                    self._orders[id(rset)] = order
+                    changed.add(id(rset))
+            if not tree.ordered:
+                # expected cost of an OR chain: ascending cost per approval
+                self._orders[id(tree)] = tuple(
+                    sorted(
+                        range(len(tree)),
+                        key=lambda i, t=tree: (
+                            set_stats[id(t[i])].cost()
+                            / (1 - set_stats[id(t[i])].reject_rate())
+                        ),
+                    )
+                )
+        self._build({k: v for k, v in self._compiled.items() if k not in changed})
+
+    def approve_request(self, request: ApprovalRequest) -> Union[None, bool, int]:
+        """Same as `RuleEngine.approve_request`."""
+        if self._observed:
+            return self._approve_observed(request)
+        return self._approve(request)
+
+    def _explaining(self, rule: "RulePlugin", approver: Callable) -> Callable:
+        local = self._explain_local
+        rule_id = rule.rule_id
+
+        def explained(request):
+            start = time.perf_counter()
+            try:
+                res = approver(request)
+            except Exception as ex:
+                elapsed = time.perf_counter() - start
+                local.rules.append(RuleResult(rule_id, None, repr(ex), elapsed))
+                raise
+            elapsed = time.perf_counter() - start
+            local.rules.append(RuleResult(rule_id, res, None, elapsed))
+            return res
+
+        return explained
+
+    def explain(self, request: ApprovalRequest) -> Explanation:
+        """Same as `RuleEngine.explain`."""
+        rtype = request.request_type
+        rsets = self._ordered.get(rtype)
+        if rsets is None:
+            return Explanation(rtype.value, None, None, ())
+        explainers = self._explainers
+        local = self._explain_local
+        tried = []
+        for rset in rsets:
+            approve = explainers.get(id(rset))
+            if approve is None:
+                approve = explainers[id(rset)] = rset.compile(
+                    self._bound,
+                    order=self._orders.get(id(rset)),
+                    wrap=self._explaining,
+                    use_quota=False,
+                )
+            local.rules = rules = []
+            start = time.perf_counter()
+            ok = approve(request)
+            elapsed = time.perf_counter() - start
+            tried.append(RulesetResult(rset.stable_id, ok, elapsed, tuple(rules)))
+            if ok:
+                return Explanation(rtype.value, id(rset), rset.stable_id, tuple(tried))
+        return Explanation(rtype.value, False, None, tuple(tried))
+
+    def record_cached(self, request: ApprovalRequest, result: Union[None, bool, int]):
+        """Record a decision served by a `DecisionCache` in the tracer and metrics."""
+        tracer, metrics = self.tracer, self.metrics
+        if tracer is not None:
+            ruleset = self._set_ids.get(result) if result else None
+            tracer.trace_cached(request, result, ruleset)
+        if metrics is not None:
+            metrics.record_cache_hit(request.request_type, result)
+
+    def _approve_observed(self, request: ApprovalRequest) -> Union[None, bool, int]:
+        tracer, metrics = self.tracer, self.metrics
+        if tracer is not None:
+            res = tracer.trace(request, self._approve, self._set_ids)
+        else:
+            res = self._approve(request)
+        if metrics is not None:
+            metrics.record_decision(request.request_type, res)
+        return res
+
+    def _approve(self, request: ApprovalRequest) -> Union[None, bool, int]:
+        rtype = request.request_type
+        tree = self._trees.get(rtype)
+        if tree is None:
+            log.debug("RuleEngine.approve_request: no tree for type %s", rtype)
+            return None
+        memo = {} if rtype in self._memoize else None
+        if self._sampled is not None:
+            self._requests += 1
+            if not self._requests % self._sample_every:
+                return self._approve_sampled(request, memo)
+        for rs_id, approve in tree:
+            if approve(request, memo):
+                return rs_id
+        return False
+
+    def _approve_sampled(self, request: ApprovalRequest, memo: Optional[dict]):
+        ret: Union[bool, int] = False
+        for rs_id, approve, stats in self._sampled[request.request_type]:
+            if stats is None:
+                res = approve(request, memo)
+            else:
+                start = time.perf_counter()
+                res = approve(request, memo)
+                stats.record(time.perf_counter() - start, res)
+            if res:
+                ret = rs_id
+                break
+        if self.rule_stats is None:
+            return ret
+        if not self._requests % (self._sample_every * self.REORDER_EVERY):
+            # one thread reorders, the others go on with the current orders
+            # pylint: disable-next=consider-using-with
+            if self._reorder_lock.acquire(blocking=False):
+                try:
+                    self.reorder()
+                finally:
+                    self._reorder_lock.release()
+        return ret
+
+
+__all__ = ["EvaluationPlan", "RuleStats", "compile_stripes", "compile_use"]
@@ -0,0 +1,247 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Rule engine instrumentation: evaluation counters and latency histograms.
+
+Metrics are collected by compiled engines, see `RuleEngine.compile`.  Decisions are
+all counted, but rules and rulesets are only evaluated through the measuring path
+for one request in `EngineMetrics.sample_every`: their outcome counts are estimates,
+each sample counting sample_every times, and latency histograms hold the samples.
+
+Counters are updated without locks: under heavy concurrency a few updates may be
+lost, in exchange for an overhead low enough to leave metrics on.
+"""
+
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from atakama.rule_engine import RulePlugin, RuleSet, RequestType
+
+DEFAULT_BUCKETS: Tuple[float, ...] = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+"""Latency bucket upper bounds in seconds, 10us to 1s."""
+
+APPROVED, DENIED, NONE, ERROR = range(4)
+OUTCOMES = ("approved", "denied", "none", "error")
+
+
+class Histogram:
+    """Fixed-bucket histogram of observed values."""
+
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.bounds = bounds
+        # one count per bucket, the last one is +Inf
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """(upper bound, count of values <= bound) pairs, ending with +Inf."""
+        out = []
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"buckets": self.cumulative(), "sum": self.sum, "count": self.count}
+
+
+class Counters:
+    """Outcome counts and latency of a rule, or of a ruleset."""
+
+    __slots__ = ("name", "outcomes", "latency")
+
+    def __init__(self, name: str, bounds: Tuple[float, ...]):
+        self.name = name
+        self.outcomes = [0] * len(OUTCOMES)
+        self.latency = Histogram(bounds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        ret: Dict[str, Any] = {"name": self.name}
+        ret.update(zip(OUTCOMES, self.outcomes))
+        ret["latency"] = self.latency.snapshot()
+        return ret
+
+
+class EngineMetrics:
+    """Metrics of a compiled RuleEngine.
+
+    Rules are identified by rule_id, and rulesets by `RuleSet.stable_id`, so the same
+    instance can be passed to the compile() of a reloaded engine to keep counting,
+    and snapshots of several workers can be added up.
+
+    Pass sample_every=1 to measure every request, at a higher overhead.
+    """
+
+    def __init__(
+        self,
+        bounds: Tuple[float, ...] = DEFAULT_BUCKETS,
+        clock: Callable[[], float] = time.perf_counter,
+        sample_every: int = 16,
+    ):
+        assert sample_every > 0, "sample_every must be positive"
+        self.bounds = bounds
+        self._clock = clock
+        self.sample_every = sample_every
+        self.rules: Dict[str, Counters] = {}
+        self.rulesets: Dict[str, Counters] = {}
+        self.decisions: Dict[str, List[int]] = {}
+        """Per request type value: approved, denied and no tree counts."""
+        self.cache_hits: Dict[str, int] = {}
+        """Per request type value: decisions served by a `DecisionCache`.
+
+        They are also counted in `decisions`, but no rule or ruleset is evaluated.
+        """
+
+    def wrap_rule(self, rule: "RulePlugin", approver: Callable) -> Callable:
+        """Return approver, counting outcomes and latency of the rule."""
+        counters = self.rules.get(rule.rule_id)
+        if counters is None:
+            counters = self.rules[rule.rule_id] = Counters(rule.name(), self.bounds)
+        outcomes, observe = counters.outcomes, counters.latency.observe
+        clock, weight = self._clock, self.sample_every
+
+        def measured(request):
+            start = clock()
+            try:
+                res = approver(request)
+            except Exception:
+                outcomes[ERROR] += weight
+                raise
+            finally:
+                observe(clock() - start)
+            outcomes[APPROVED if res else NONE if res is None else DENIED] += weight
+            return res
+
+        return measured
+
+    def wrap_set(self, rset: "RuleSet", approve: Callable) -> Callable:
+        """Return a compiled ruleset function, counting outcomes and latency."""
+        key = rset.stable_id
+        counters = self.rulesets.get(key)
+        if counters is None:
+            counters = self.rulesets[key] = Counters(key, self.bounds)
+        outcomes, observe = counters.outcomes, counters.latency.observe
+        clock, weight = self._clock, self.sample_every
+
+        def measured(request, memo=None):
+            start = clock()
+            res = approve(request, memo)
+            observe(clock() - start)
+            outcomes[APPROVED if res else DENIED] += weight
+            return res
+
+        return measured
+
+    def record_decision(self, request_type: "RequestType", result: Any) -> Any:
+        """Count an engine decision, and return it."""
+        counts = self.decisions.get(request_type.value)
+        if counts is None:
+            counts = self.decisions.setdefault(request_type.value, [0, 0, 0])
+        counts[APPROVED if result else NONE if result is None else DENIED] += 1
+        return result
+
+    def record_cache_hit(self, request_type: "RequestType", result: Any) -> Any:
+        """Count a decision served from a cache, and return it."""
+        rtype = request_type.value
+        self.cache_hits[rtype] = self.cache_hits.get(rtype, 0) + 1
+        return self.record_decision(request_type, result)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Plain dict of all metrics."""
+        return {
+            "rules": {rid: c.snapshot() for rid, c in list(self.rules.items())},
+            "rulesets": {sid: c.snapshot() for sid, c in list(self.rulesets.items())},
+            "decisions": {
+                rtype: dict(zip(("approved", "denied", "none"), counts))
+                for rtype, counts in list(self.decisions.items())
+            },
+            "cache_hits": dict(self.cache_hits),
+        }
+
+    def prometheus(self, prefix: str = "atakama") -> str:
+        """Metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+
+        def histogram(metric: str, labels: str, hist: Histogram):
+            for bound, count in hist.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {count}')
+            lines.append(f"{metric}_sum{{{labels}}} {hist.sum!r}")
+            lines.append(f"{metric}_count{{{labels}}} {hist.count}")
+
+        def section(kind: str, items: List[Tuple[str, Counters]], n: int):
+            total = f"{prefix}_{kind}_evaluations_total"
+            latency = f"{prefix}_{kind}_latency_seconds"
+            if kind == "rule":
+                labels = [
+                    f'rule_id="{_escape(key)}",rule="{_escape(c.name)}"'
+                    for key, c in items
+                ]
+            else:
+                labels = [f'ruleset="{_escape(key)}"' for key, _ in items]
+            lines.append(f"# HELP {total} Evaluations of each {kind} by result.")
+            lines.append(f"# TYPE {total} counter")
+            for label, (_, counters) in zip(labels, items):
+                for outcome, count in zip(OUTCOMES[:n], counters.outcomes):
+                    lines.append(f'{total}{{{label},result="{outcome}"}} {count}')
+            lines.append(f"# HELP {latency} Evaluation latency of each {kind}.")
+            lines.append(f"# TYPE {latency} histogram")
+            for label, (_, counters) in zip(labels, items):
+                histogram(latency, label, counters.latency)
+
+        section("rule", sorted(self.rules.items()), len(OUTCOMES))
+        section("ruleset", sorted(self.rulesets.items()), 2)
+
+        decisions = f"{prefix}_decisions_total"
+        lines.append(f"# HELP {decisions} Engine decisions by request type.")
+        lines.append(f"# TYPE {decisions} counter")
+        for rtype, counts in sorted(self.decisions.items()):
+            for outcome, count in zip(("approved", "denied", "none"), counts):
+                lines.append(
+                    f'{decisions}{{request_type="{_escape(rtype)}",'
+                    f'result="{outcome}"}} {count}'
+                )
+
+        hits = f"{prefix}_decision_cache_hits_total"
+        lines.append(f"# HELP {hits} Engine decisions served by a decision cache.")
+        lines.append(f"# TYPE {hits} counter")
+        for rtype, count in sorted(self.cache_hits.items()):
+            lines.append(f'{hits}{{request_type="{_escape(rtype)}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: Optional[str]) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+__all__ = ["Histogram", "EngineMetrics", "DEFAULT_BUCKETS"]
@@ -0,0 +1,166 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Path matching shared by all rules of an engine that inspect `MetaInfo.meta`.
+
+Rather than each rule scanning each request path against each of its patterns, the
+patterns of all path rules are merged into one `PathIndex`.  A path is matched once,
+in a single walk down a prefix trie, and every rule then tests the resulting set of
+pattern ids against its own.
+"""
+
+import re
+import threading
+from fnmatch import translate
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from atakama.rule_engine import RulePlugin, ApprovalRequest
+
+GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+def _components(path: str) -> List[str]:
+    return [comp for comp in path.replace("\\", "/").split("/") if comp]
+
+
+class _Node:
+    __slots__ = ("children", "prefixes", "globs")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        # ids of prefix patterns ending here
+        self.prefixes: List[int] = []
+        # globs whose literal leading components end here
+        self.globs: List[Tuple[int, Callable[[str], Any]]] = []
+
+
+class PathIndex:
+    """Prefix trie of path patterns, with globs attached to their literal prefix.
+
+    Patterns containing `*`, `?` or `[` are globs, with fnmatch syntax: `*` also
+    matches `/`.  Other patterns are prefixes matching whole path components, so
+    `/share` matches `/share` and `/share/a`, but not `/shared`.  Backslashes are
+    treated as `/`, and relative patterns and paths as absolute: `share/*.txt` is
+    `/share/*.txt`, and matches `/share/a.txt`.  Matching is case sensitive.
+
+    Results are cached per path, up to CACHE_SIZE paths.
+    """
+
+    CACHE_SIZE = 4096
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids: Dict[str, int] = {}
+        self._root = _Node()
+        self._cache: Dict[str, FrozenSet[int]] = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, pattern: str) -> int:
+        """Add a pattern and return its id, the same id if it was already added."""
+        with self._lock:
+            pid = self._ids.get(pattern)
+            if pid is not None:
+                return pid
+            pid = len(self._ids)
+            node = self._root
+            comps = _components(pattern)
+            glob = GLOB_CHARS.search(pattern) is not None
+            for comp in comps:
+                if glob and GLOB_CHARS.search(comp):
+                    break
+                node = node.children.setdefault(comp, _Node())
+            if glob:
+                regex = re.compile(translate("/" + "/".join(comps)))
+                node.globs.append((pid, regex.match))
+            else:
+                node.prefixes.append(pid)
+            self._ids[pattern] = pid
+            # results computed before the pattern was added are stale
+            self._cache = {}
+            return pid
+
+    def match(self, path: str) -> FrozenSet[int]:
+        """Ids of all patterns matching the path."""
+        cache = self._cache
+        found = cache.get(path)
+        if found is not None:
+            return found
+
+        ids = []
+        comps = _components(path)
+        # normalized like glob patterns
+        norm = "/" + "/".join(comps)
+        node: Optional[_Node] = self._root
+        walk = iter(comps)
+        while node is not None:
+            ids.extend(node.prefixes)
+            for pid, match in node.globs:
+                if match(norm):
+                    ids.append(pid)
+            node = node.children.get(next(walk, None))
+
+        found = frozenset(ids)
+        if len(cache) >= self.CACHE_SIZE:
+            cache.clear()
+        cache[path] = found
+        return found
+
+
+class PathRule(RulePlugin):
+    """
+    Base class for rules that approve requests by path, see `PathIndex` for patterns.
+
+    Policy arguments:
+     - paths: list of path patterns
+     - match: all (default), every path of the request must match a pattern, or any
+     - allow_partial: match incomplete paths too (`MetaInfo.complete`), default false
+
+    All path rules of an engine share one index, so each request path is scanned
+    once, however many path rules there are.  Subclasses must provide name(), and may
+    override approve_request() to add conditions, calling path_matches().
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.patterns: List[str] = args["paths"]
+        assert isinstance(self.patterns, list), "paths must be a list"
+        assert all(isinstance(p, str) for p in self.patterns), "paths must be strings"
+        assert args.get("match", "all") in ("all", "any"), "invalid match"
+        self.match_all = args.get("match", "all") == "all"
+        self.allow_partial = bool(args.get("allow_partial", False))
+        # usable on its own, until prepared by an engine
+        self._index = self._add_patterns(PathIndex())
+
+    def _add_patterns(self, index: PathIndex) -> Tuple[PathIndex, FrozenSet[int]]:
+        return index, frozenset(index.add(pattern) for pattern in self.patterns)
+
+    def prepare(self, shared: Dict[str, Any]) -> None:
+        index = shared.get("path_index")
+        if index is None:
+            index = shared["path_index"] = PathIndex()
+        # one assignment, requests in flight see either index
+        self._index = self._add_patterns(index)
+
+    def path_matches(self, request: ApprovalRequest) -> bool:
+        """Return True if the request's paths match the rule's patterns."""
+        index, ids = self._index
+        matched = False
+        for meta in request.auth_meta:
+            if meta.complete or self.allow_partial:
+                ok = not ids.isdisjoint(index.match(meta.meta))
+            else:
+                ok = False
+            if ok and not self.match_all:
+                return True
+            if not ok and self.match_all:
+                return False
+            matched = ok
+        return matched
+
+    def approve_request(self, request: ApprovalRequest) -> Optional[bool]:
+        return self.path_matches(request)
+
+
+__all__ = ["PathIndex", "PathRule"]
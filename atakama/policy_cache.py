@@ -0,0 +1,103 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""On-disk cache of parsed policy files, so restarts skip yaml parsing."""
+
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import tempfile
+from typing import Any, Optional, Union, TYPE_CHECKING
+
+from atakama.plugin_base import Plugin
+
+try:
+    from importlib.metadata import version, PackageNotFoundError
+except ImportError:  # pragma: no cover
+    version = None
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+def _sdk_version() -> str:
+    if version is None:  # pragma: no cover
+        return ""
+    try:
+        return version("atakama")
+    except PackageNotFoundError:
+        return ""
+
+
+class PolicyCache:
+    """Normalized policies, with rule ids injected, stored in a binary file per policy.
+
+    Entries are keyed by a hash of the policy file contents, the sdk version and the
+    python version, so any change to the file invalidates its entry.  Entries are
+    written with marshal: the cache directory must only be writable by the server.
+    """
+
+    MAGIC = b"APC1"
+    _KEY_SIZE = 32
+
+    def __init__(self, cache_dir: Union["Path", str]):
+        self.cache_dir = str(cache_dir)
+        self._version = (
+            f"{_sdk_version()}/{Plugin.CURRENT_SDK_VERSION}/{sys.version_info[:2]}"
+        )
+
+    def key(self, data: bytes, rule_ids: str = "md5") -> bytes:
+        """Cache key for the contents of a policy file, and the rule id algorithm."""
+        h = hashlib.sha256(f"{self._version}/{rule_ids}/".encode())
+        h.update(data)
+        return h.digest()
+
+    def path(self, yml: Union["Path", str]) -> str:
+        """Cache file for a policy file, one per policy path."""
+        name = hashlib.sha256(os.path.abspath(str(yml)).encode()).hexdigest()[:24]
+        return os.path.join(self.cache_dir, f"policy-{name}.bin")
+
+    def load(self, yml: Union["Path", str], key: bytes) -> Optional[Any]:
+        """Cached policy for the key, None if missing, stale or unreadable."""
+        try:
+            with open(self.path(yml), "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return None
+        head = len(self.MAGIC) + self._KEY_SIZE
+        if data[:head] != self.MAGIC + key:
+            return None
+        try:
+            return marshal.loads(data[head:])
+        except (EOFError, ValueError, TypeError):
+            log.warning("ignoring corrupt policy cache for %s", yml)
+            return None
+
+    def dumps(self, info: Any) -> Optional[bytes]:
+        """Serialize a policy, None if it holds values that can't be cached."""
+        try:
+            return marshal.dumps(info)
+        except ValueError:
+            return None
+
+    def store(self, yml: Union["Path", str], key: bytes, payload: bytes):
+        """Atomically replace the cache file for the policy, errors are logged."""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    fh.write(self.MAGIC + key + payload)
+                os.replace(tmp, self.path(yml))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as ex:
+            log.warning("failed to write policy cache for %s: %s", yml, repr(ex))
+
+
+__all__ = ["PolicyCache"]
@@ -0,0 +1,772 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Quota counter storage shared by rule plugins, within and across processes."""
+
+import abc
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Tuple, Dict, Union
+from typing import TYPE_CHECKING
+
+from atakama.request import ProfileInfo
+
+if TYPE_CHECKING:
+    from pathlib import Path
+    from atakama.rule_engine import RulePlugin, RuleTree
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+log = logging.getLogger(__name__)
+
+
+class QuotaStore(abc.ABC):
+    """Integer counters keyed by (rule_id, key), where key is typically a profile_id.
+
+    Rule plugins find the engine's store in `RulePlugin.quota_store`, and should use
+    incr() with a limit in use_quota(): it is an atomic check-and-increment, so
+    counters are never exceeded, even with several processes sharing the store.
+    In release_quota(), incr() by -1 gives the count back.
+    """
+
+    shared = False
+    """True if processes using the store, or forked with it, share its counters."""
+
+    @abc.abstractmethod
+    def get(self, rule_id: str, key: bytes) -> int:
+        """Current counter value, 0 if unset."""
+
+    def get_many(self, rule_id: str, keys: List[bytes]) -> List[int]:
+        """Current values of the rule's counters for each key, in order."""
+        return [self.get(rule_id, key) for key in keys]
+
+    @abc.abstractmethod
+    def incr(
+        self, rule_id: str, key: bytes, amount: int = 1, limit: Optional[int] = None
+    ) -> bool:
+        """Atomically add amount, unless the result would exceed limit.
+
+        Returns True if the amount was added.
+        """
+
+    @abc.abstractmethod
+    def clear(self, rule_id: str, key: bytes) -> None:
+        """Reset the counter to 0."""
+
+    @abc.abstractmethod
+    def items(self) -> Iterator[Tuple[str, bytes, int]]:
+        """Iterate over (rule_id, key, value) for all non-zero counters."""
+
+    def close(self) -> None:
+        """Release any resources held by the store."""
+
+    def after_fork(self) -> None:
+        """Called in a child process forked with the store, before it is used."""
+
+
+class MemoryQuotaStore(QuotaStore):
+    """In-process store, the default for a RuleEngine."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[Tuple[str, bytes], int] = {}
+
+    def get(self, rule_id, key):
+        return self._counts.get((rule_id, key), 0)
+
+    def get_many(self, rule_id, keys):
+        counts = self._counts
+        return [counts.get((rule_id, key), 0) for key in keys]
+
+    def incr(self, rule_id, key, amount=1, limit=None):
+        with self._lock:
+            value = self._counts.get((rule_id, key), 0) + amount
+            if limit is not None and value > limit:
+                return False
+            self._counts[(rule_id, key)] = value
+            return True
+
+    def clear(self, rule_id, key):
+        with self._lock:
+            self._counts.pop((rule_id, key), None)
+
+    def items(self):
+        with self._lock:
+            counts = list(self._counts.items())
+        for (rule_id, key), value in counts:
+            if value:
+                yield rule_id, key, value
+
+
+class MmapQuotaStore(QuotaStore):
+    """Store in a memory-mapped file, shared by processes on one host.
+
+    The file is a fixed-size, open-addressed hash table of `slots` counters.  Writers
+    hold a thread lock and an OS lock on the file, so every operation is atomic
+    across threads and processes.  Raises ValueError when full, or for ids and keys
+    longer than MAX_ID bytes.
+    """
+
+    shared = True
+    MAGIC = b"AQS1"
+    MAX_ID = 64
+    # used, rule_id length, key length, value, rule_id, key
+    _SLOT = struct.Struct(f"<BBBxxxxxq{MAX_ID}s{MAX_ID}s")
+    _HEADER = struct.Struct("<4sI")
+
+    def __init__(self, path: Union["Path", str], slots: int = 65536):
+        self._lock = threading.Lock()
+        self._fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o600)
+        size = self._HEADER.size + slots * self._SLOT.size
+        with self._file_lock():
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, self._HEADER.pack(self.MAGIC, slots))
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            magic, slots = self._HEADER.unpack(os.read(self._fd, self._HEADER.size))
+        if magic != self.MAGIC:
+            os.close(self._fd)
+            raise ValueError(f"not a quota store: {path}")
+        self.slots = slots
+        self._map = mmap.mmap(self._fd, self._HEADER.size + slots * self._SLOT.size)
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        else:  # pragma: no cover
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            with self._file_lock():
+                yield
+
+    def _offset(self, i: int) -> int:
+        return self._HEADER.size + i * self._SLOT.size
+
+    def _find(self, rule_id: bytes, key: bytes, create: bool) -> Optional[int]:
+        """Offset of the slot for rule_id/key, None if absent and not created."""
+        if len(rule_id) > self.MAX_ID or len(key) > self.MAX_ID:
+            raise ValueError("quota id or key too long")
+        digest = hashlib.blake2b(rule_id + b"\0" + key, digest_size=8).digest()
+        start = int.from_bytes(digest, "little") % self.slots
+        for n in range(self.slots):
+            off = self._offset((start + n) % self.slots)
+            used, id_len, key_len, _, s_id, s_key = self._SLOT.unpack_from(
+                self._map, off
+            )
+            if not used:
+                if not create:
+                    return None
+                self._SLOT.pack_into(
+                    self._map, off, 1, len(rule_id), len(key), 0, rule_id, key
+                )
+                return off
+            if s_id[:id_len] == rule_id and s_key[:key_len] == key:
+                return off
+        if create:
+            raise ValueError("quota store is full")
+        return None
+
+    def _value(self, off: int) -> int:
+        return struct.unpack_from("<q", self._map, off + 8)[0]
+
+    def get(self, rule_id, key):
+        with self._locked():
+            off = self._find(rule_id.encode(), key, False)
+            return 0 if off is None else self._value(off)
+
+    def incr(self, rule_id, key, amount=1, limit=None):
+        with self._locked():
+            off = self._find(rule_id.encode(), key, True)
+            value = self._value(off) + amount
+            if limit is not None and value > limit:
+                return False
+            struct.pack_into("<q", self._map, off + 8, value)
+            return True
+
+    def clear(self, rule_id, key):
+        # slots are never freed, that would break linear probing
+        with self._locked():
+            off = self._find(rule_id.encode(), key, False)
+            if off is not None:
+                struct.pack_into("<q", self._map, off + 8, 0)
+
+    def items(self):
+        with self._locked():
+            found = []
+            for i in range(self.slots):
+                used, id_len, key_len, value, s_id, s_key = self._SLOT.unpack_from(
+                    self._map, self._offset(i)
+                )
+                if used and value:
+                    found.append((s_id[:id_len].decode(), s_key[:key_len], value))
+        yield from found
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class SqliteQuotaStore(QuotaStore):
+    """Store in an sqlite database, durable, and shared by processes on one host.
+
+    Each thread uses its own connection, the database runs in WAL mode.  close()
+    closes the connections of all threads.
+    """
+
+    shared = True
+
+    def __init__(self, path: Union["Path", str], timeout: float = 30):
+        self._path = str(path)
+        self._timeout = timeout
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._conn().execute(
+            "create table if not exists quota "
+            "(rule_id text, key blob, value integer, primary key (rule_id, key))"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # only used by this thread, but closed by close(), from any thread
+            conn = sqlite3.connect(
+                self._path,
+                timeout=self._timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("pragma journal_mode=wal")
+            with self._conns_lock:
+                self._conns.append(conn)
+            self._local.conn = conn
+        return conn
+
+    def after_fork(self):
+        # connections can't be used across fork, the parent's are left to the parent
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+
+    def get(self, rule_id, key):
+        row = (
+            self._conn()
+            .execute(
+                "select value from quota where rule_id=? and key=?", (rule_id, key)
+            )
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def get_many(self, rule_id, keys):
+        found: Dict[bytes, int] = {}
+        conn = self._conn()
+        # stay under the default limit of 999 sql variables
+        for start in range(0, len(keys), 900):
+            chunk = keys[start : start + 900]
+            found.update(
+                conn.execute(
+                    "select key, value from quota where rule_id=? and key in "
+                    f"({','.join('?' * len(chunk))})",
+                    (rule_id, *chunk),
+                )
+            )
+        return [found.get(key, 0) for key in keys]
+
+    def incr(self, rule_id, key, amount=1, limit=None):
+        if limit is not None and amount > limit:
+            return False
+        sql = (
+            "insert into quota values (?, ?, ?) on conflict (rule_id, key) "
+            "do update set value = value + excluded.value"
+        )
+        args: tuple = (rule_id, key, amount)
+        if limit is not None:
+            sql += " where value + excluded.value <= ?"
+            args += (limit,)
+        # a single statement is atomic, no explicit transaction needed
+        return self._conn().execute(sql, args).rowcount == 1
+
+    def clear(self, rule_id, key):
+        self._conn().execute(
+            "delete from quota where rule_id=? and key=?", (rule_id, key)
+        )
+
+    def items(self):
+        yield from self._conn().execute(
+            "select rule_id, key, value from quota where value != 0"
+        )
+
+    def close(self):
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+            self._local = threading.local()
+        for conn in conns:
+            conn.close()
+
+
+class _Journal:
+    """Journal file of a JournalQuotaStore, and the records not yet written to it.
+
+    Records are numbered in append order: those up to `written` are on disk, those
+    up to `appended` are in `pending`, until a commit writes them.
+    """
+
+    __autodoc__ = False
+    __slots__ = ("path", "fd", "size", "pending", "appended", "written", "commit_lock")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.size = 0
+        self.pending = bytearray()
+        self.appended = 0
+        self.written = 0
+        self.commit_lock = threading.Lock()
+
+
+class JournalQuotaStore(MemoryQuotaStore):
+    """In-process store, made persistent by an append-only journal.
+
+    Counters live in memory.  Every change is appended to `<path>.journal`, and
+    the journal is periodically compacted into a `<path>.snapshot` of all counters.
+    On startup, the snapshot and the journal are replayed, via mmap.
+
+    Appends are group committed: with `sync`, incr() and clear() return once their
+    record is on disk, and the thread that writes and fsyncs the journal does so for
+    all records appended meanwhile, so the fsync cost is shared by concurrent
+    requests.  Without `sync`, records are written every `interval` seconds, by a
+    background thread: faster, but a crash loses the last interval of changes.
+    If writing fails, the error is raised, and the records are written again by
+    the next commit.  An incr() that raised is cancelled, and uses no quota.
+
+    Records are checksummed: a torn write at the end of the journal, from a crash,
+    is ignored on replay.  One process at a time may use a journal, use
+    `SqliteQuotaStore` to share counters among processes.
+    """
+
+    JOURNAL_MAGIC = b"AQJ1"
+    SNAPSHOT_MAGIC = b"AQN1"
+    INCR, CLEAR = 1, 2
+    # magic, generation
+    _HEADER = struct.Struct("<4sQ")
+    # crc32 of the rest, op, rule_id length, key length, amount
+    _RECORD = struct.Struct("<IBHHq")
+    # rule_id length, key length, value
+    _ENTRY = struct.Struct("<HHq")
+
+    def __init__(
+        self,
+        path: Union["Path", str],
+        *,
+        sync: bool = True,
+        interval: float = 0.05,
+        compact_bytes: int = 16 << 20,
+    ):
+        super().__init__()
+        self._snapshot_path = str(path) + ".snapshot"
+        self.sync = sync
+        self.compact_bytes = compact_bytes
+        self._closed = threading.Event()
+
+        self._journal = journal = _Journal(str(path) + ".journal")
+        if fcntl:
+            try:
+                fcntl.flock(journal.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as ex:
+                os.close(journal.fd)
+                raise ValueError(f"quota journal in use: {journal.path}") from ex
+        self.generation = self._replay()
+        journal.size = os.lseek(journal.fd, 0, os.SEEK_END)
+        if journal.size == 0:
+            self._write_header(journal.fd, self.generation)
+            journal.size = self._HEADER.size
+
+        self._thread: Optional[threading.Thread] = None
+        if not sync:
+            self._thread = threading.Thread(
+                target=self._flush_loop, args=(interval,), daemon=True
+            )
+            self._thread.start()
+
+    def _write_header(self, fd: int, generation: int):
+        os.write(fd, self._HEADER.pack(self.JOURNAL_MAGIC, generation))
+        os.fsync(fd)
+
+    @staticmethod
+    def _map(path: str) -> Optional[mmap.mmap]:
+        try:
+            with open(path, "rb") as fh:
+                if os.fstat(fh.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    def _replay(self) -> int:
+        """Load the snapshot and the journal, return the current generation."""
+        return self._replay_journal(self._replay_snapshot())
+
+    def _replay_snapshot(self) -> int:
+        """Load the snapshot, return its generation."""
+        data = self._map(self._snapshot_path)
+        if data is None:
+            return 0
+        with data:
+            magic, generation = self._HEADER.unpack_from(data)
+            (crc,) = struct.unpack_from("<I", data, len(data) - 4)
+            if magic != self.SNAPSHOT_MAGIC or crc != zlib.crc32(data[:-4]):
+                raise ValueError(f"corrupt quota snapshot: {self._snapshot_path}")
+            off = self._HEADER.size
+            end = len(data) - 4
+            while off < end:
+                id_len, key_len, value = self._ENTRY.unpack_from(data, off)
+                off += self._ENTRY.size
+                rule_id = data[off : off + id_len].decode()
+                key = data[off + id_len : off + id_len + key_len]
+                off += id_len + key_len
+                self._counts[(rule_id, key)] = value
+        return generation
+
+    def _replay_journal(self, generation: int) -> int:
+        """Apply the journal if it follows the snapshot, return its generation."""
+        path = self._journal.path
+        data = self._map(path)
+        if data is None:
+            return generation
+        size = len(data)
+        if size < self._HEADER.size:
+            # crashed while compacting, before the header of the new journal was
+            # written: the snapshot has all counters
+            data.close()
+            with open(path, "r+b") as fh:
+                fh.truncate(0)
+            return generation
+        with data:
+            magic, journal_gen = self._HEADER.unpack_from(data)
+            if magic != self.JOURNAL_MAGIC:
+                raise ValueError(f"not a quota journal: {path}")
+            if journal_gen < generation:
+                # compacted into the snapshot, but not yet replaced
+                with open(path, "r+b") as fh:
+                    fh.truncate(0)
+                return generation
+            off = self._HEADER.size
+            counts = self._counts
+            for off, op, rule_id, key, amount in self._records(data, off):
+                if op == self.INCR:
+                    counts[(rule_id, key)] = counts.get((rule_id, key), 0) + amount
+                else:
+                    counts.pop((rule_id, key), None)
+        if off < size:
+            # drop the torn tail, so new records follow valid ones
+            with open(path, "r+b") as fh:
+                fh.truncate(off)
+        return journal_gen
+
+    def _records(
+        self, data: mmap.mmap, off: int
+    ) -> Iterator[Tuple[int, int, str, bytes, int]]:
+        """Valid journal records from off, as (end, op, rule_id, key, amount)."""
+        size = len(data)
+        while off + self._RECORD.size <= size:
+            crc, op, id_len, key_len, amount = self._RECORD.unpack_from(data, off)
+            end = off + self._RECORD.size + id_len + key_len
+            if end > size or crc != zlib.crc32(data[off + 4 : end]):
+                log.warning(
+                    "ignoring %i bytes of torn quota journal %s",
+                    size - off,
+                    self._journal.path,
+                )
+                return
+            rule_id = data[off + self._RECORD.size : end - key_len].decode()
+            yield end, op, rule_id, data[end - key_len : end], amount
+            off = end
+
+    def _append(self, op: int, rule_id: str, key: bytes, amount: int) -> int:
+        """Append a record, with the lock held, and return its sequence number."""
+        journal = self._journal
+        rule_bytes = rule_id.encode()
+        body = self._RECORD.pack(0, op, len(rule_bytes), len(key), amount)[4:]
+        body += rule_bytes + key
+        journal.pending += struct.pack("<I", zlib.crc32(body)) + body
+        journal.appended += 1
+        return journal.appended
+
+    def _commit(self, seq: int):
+        """Write and fsync the journal up to record seq, and any appended since."""
+        journal = self._journal
+        with journal.commit_lock:
+            if journal.written >= seq:
+                # written by another thread's commit
+                return
+            with self._lock:
+                pending = bytes(journal.pending)
+                appended = journal.appended
+            if pending:
+                # records stay pending until on disk: if writing fails, the next
+                # commit writes them again, over whatever part was written
+                os.lseek(journal.fd, journal.size, os.SEEK_SET)
+                off = 0
+                while off < len(pending):
+                    off += os.write(journal.fd, pending[off:])
+                os.fsync(journal.fd)
+                with self._lock:
+                    del journal.pending[: len(pending)]
+                journal.size += len(pending)
+            journal.written = appended
+            if journal.size >= self.compact_bytes:
+                self._compact()
+
+    def _compact(self):
+        """Write a snapshot of all counters, and start a new, empty journal.
+
+        Called with the commit lock held.
+        """
+        journal = self._journal
+        generation = self.generation + 1
+        with self._lock:
+            counts = list(self._counts.items())
+            # records not yet written are part of the snapshot
+            journal.pending = bytearray()
+            appended = journal.appended
+        parts = [self._HEADER.pack(self.SNAPSHOT_MAGIC, generation)]
+        for (rule_id, key), value in counts:
+            if value:
+                rule_bytes = rule_id.encode()
+                parts.append(self._ENTRY.pack(len(rule_bytes), len(key), value))
+                parts.append(rule_bytes + key)
+        body = b"".join(parts)
+        # the snapshot takes effect when replaced, the old journal is then ignored
+        self._replace(self._snapshot_path, body + struct.pack("<I", zlib.crc32(body)))
+        journal.written = appended
+        # records appended since the snapshot go to the new journal
+        os.ftruncate(journal.fd, 0)
+        os.lseek(journal.fd, 0, os.SEEK_SET)
+        self._write_header(journal.fd, generation)
+        journal.size = self._HEADER.size
+        self.generation = generation
+
+    @staticmethod
+    def _replace(path: str, data: bytes):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+
+    def _flush_loop(self, interval: float):
+        while not self._closed.wait(interval):
+            try:
+                self.flush()
+            except OSError:
+                log.exception("writing quota journal %s", self._journal.path)
+
+    def flush(self):
+        """Write and fsync all changes."""
+        self._commit(self._journal.appended)
+
+    def compact(self):
+        """Write a snapshot of all counters now, and start a new journal."""
+        with self._journal.commit_lock:
+            self._compact()
+
+    def incr(self, rule_id, key, amount=1, limit=None):
+        with self._lock:
+            value = self._counts.get((rule_id, key), 0) + amount
+            if limit is not None and value > limit:
+                return False
+            self._counts[(rule_id, key)] = value
+            seq = self._append(self.INCR, rule_id, key, amount)
+        if self.sync:
+            try:
+                self._commit(seq)
+            except BaseException:
+                self._cancel(rule_id, key, amount)
+                raise
+        return True
+
+    def _cancel(self, rule_id: str, key: bytes, amount: int):
+        """Undo an increment whose commit failed.
+
+        Its record stays pending, or was written by another thread meanwhile, so a
+        record of the opposite amount follows it.
+        """
+        with self._lock:
+            value = self._counts.get((rule_id, key))
+            if value is None:
+                # cleared since, along with the increment
+                return
+            self._counts[(rule_id, key)] = value - amount
+            self._append(self.INCR, rule_id, key, -amount)
+
+    def clear(self, rule_id, key):
+        with self._lock:
+            if self._counts.pop((rule_id, key), None) is None:
+                return
+            seq = self._append(self.CLEAR, rule_id, key, 0)
+        if self.sync:
+            self._commit(seq)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        finally:
+            os.close(self._journal.fd)
+
+
+class QuotaRegistry:
+    """The unique rules of an engine implementing quota methods.
+
+    at_quota() and clear_quota() call each of these rules once, however many trees
+    and rulesets share it, and skip rules without quotas.
+    """
+
+    __autodoc__ = False
+
+    def __init__(self, rules: Iterable["RulePlugin"]):
+        methods = ("use_quota", "at_quota", "clear_quota", "quota_profiles")
+        self.rules: Tuple["RulePlugin", ...] = tuple(
+            rule for rule in rules if any(map(rule.overrides, methods))
+        )
+        self.at_quota_rules = tuple(
+            rule for rule in self.rules if rule.overrides("at_quota")
+        )
+        self.clear_quota_rules = tuple(
+            rule for rule in self.rules if rule.overrides("clear_quota")
+        )
+        self.by_id: Dict[str, List["RulePlugin"]] = defaultdict(list)
+        for rule in self.rules:
+            self.by_id[rule.rule_id].append(rule)
+        self.source: Tuple[int, Tuple["RuleTree", ...]] = (-1, ())
+        """What the rules were collected from, see `RuleEngine._quota_registry`."""
+
+    def at_quota(self, profile: ProfileInfo) -> bool:
+        """True if any rule is at quota for the profile, errors are logged."""
+        for rule in self.at_quota_rules:
+            try:
+                if rule.at_quota(profile):
+                    log.debug(
+                        "QuotaRegistry.at_quota: rule_id=%s profile=%s",
+                        rule.rule_id,
+                        profile.profile_id,
+                    )
+                    return True
+            except Exception as ex:
+                log.error("error in rule %s: %r", rule, ex)
+        return False
+
+    def clear_quota(self, profile: ProfileInfo):
+        """Clear the profile's quota in every rule implementing clear_quota."""
+        for rule in self.clear_quota_rules:
+            rule.clear_quota(profile)
+
+    def index(self, store: QuotaStore) -> Dict[bytes, Tuple["RulePlugin", ...]]:
+        """Reverse index of profile_id to the rules holding quota state for it.
+
+        Takes time proportional to the number of counters in the store, and of
+        profiles listed by `RulePlugin.quota_profiles`.
+        """
+        index: Dict[bytes, Dict[int, "RulePlugin"]] = defaultdict(dict)
+        by_id = self.by_id
+        for rule_id, key, _ in store.items():
+            for rule in by_id.get(rule_id, ()):
+                index[key][id(rule)] = rule
+        for rule in self.rules:
+            try:
+                listed = rule.quota_profiles()
+                for profile_id in listed if listed is not None else ():
+                    index[profile_id][id(rule)] = rule
+            except Exception as ex:
+                log.error("error in rule quota_profiles %s: %r", rule, ex)
+        return {pid: tuple(rules.values()) for pid, rules in index.items()}
+
+    @staticmethod
+    def _at_quota_many(
+        rule: "RulePlugin", profiles: List[ProfileInfo]
+    ) -> List[Optional[bool]]:
+        try:
+            results = rule.at_quota_many(profiles)
+            assert len(results) == len(profiles), "one result per profile"
+            return results
+        except Exception as ex:
+            log.error("error in rule at_quota_many %s: %r", rule, ex)
+        results = []
+        for profile in profiles:
+            try:
+                results.append(rule.at_quota(profile))
+            except Exception as ex:
+                log.error("error in rule %s: %r", rule, ex)
+                results.append(None)
+        return results
+
+    def report(
+        self, profiles: Optional[Iterable[ProfileInfo]], store: QuotaStore
+    ) -> Dict[bytes, List[str]]:
+        """Same as `RuleEngine.quota_report`."""
+        if profiles is None:
+            # each rule checks only the profiles it holds state for
+            held: Dict[int, List[ProfileInfo]] = defaultdict(list)
+            index = self.index(store)
+            for pid, rules in index.items():
+                profile = ProfileInfo(pid, [])
+                for rule in rules:
+                    held[id(rule)].append(profile)
+            report: Dict[bytes, List[str]] = {pid: [] for pid in index}
+            work = [(rule, held[id(rule)]) for rule in self.at_quota_rules]
+        else:
+            profiles = list(profiles)
+            report = {profile.profile_id: [] for profile in profiles}
+            work = [(rule, profiles) for rule in self.at_quota_rules]
+        for rule, batch in work:
+            if not batch:
+                continue
+            for profile, res in zip(batch, self._at_quota_many(rule, batch)):
+                if res:
+                    report[profile.profile_id].append(rule.rule_id)
+        return report
+
+
+__all__ = [
+    "QuotaStore",
+    "MemoryQuotaStore",
+    "MmapQuotaStore",
+    "SqliteQuotaStore",
+    "JournalQuotaStore",
+]
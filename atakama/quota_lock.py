@@ -0,0 +1,281 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Locks guarding the quota state of a RuleSet, striped by quota key."""
+
+import asyncio
+import threading
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Hashable, Iterable, List, Optional
+
+QUOTA_KEY_ALL = "*"
+"""Quota key meaning "all state held by the rule", locks the whole RuleSet."""
+
+
+class _Held(threading.local):
+    """Stripes of a QuotaLock held by the current thread, with their reentry count."""
+
+    def __init__(self):
+        super().__init__()
+        self.stripes: Dict[int, int] = {}
+
+
+class QuotaLock:
+    """Lock guarding the quota state of a RuleSet.
+
+    Evaluations that name the quota keys they touch only hold a striped lock
+    per key, and run in parallel with evaluations for other keys.
+
+    Evaluations that touch QUOTA_KEY_ALL hold the lock exclusively: they wait for
+    keyed holders to drain, and new keyed holders wait for them.
+
+    Like the RLock it replaces, acquire() is reentrant for the holder of the whole
+    lock, and for a keyed holder acquiring the same stripes again: a thread already
+    holding stripes is not stopped by an exclusive holder waiting for them.  A keyed
+    holder must not acquire the whole lock, or other stripes: it would wait for
+    itself, or for holders of those stripes waiting on it.
+
+    hold_async() holds the lock for a task rather than for the loop's thread, and is
+    not reentrant: other tasks, and synchronous callers in the loop's thread, wait
+    for the task like any other thread.
+    """
+
+    __autodoc__ = False
+
+    STRIPES = 64
+
+    def __init__(self, stripes: int = STRIPES):
+        # plain locks, so that the thread running a task holding them can't reenter:
+        # reentry of threads is tracked here, and in _held
+        self._exclusive = threading.Lock()
+        self._exclusive_owner: Optional[int] = None
+        self._exclusive_depth = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._shared = 0
+        self._stripes = [threading.Lock() for _ in range(stripes)]
+        self._held = _Held()
+
+    def stripes_for(self, keys: Iterable[Hashable]) -> List[int]:
+        """Sorted stripe indexes for keys, sorting prevents lock-order deadlocks."""
+        return sorted({hash(k) % len(self._stripes) for k in keys})
+
+    def acquire(self, stripes: Optional[List[int]]):
+        """Acquire the given stripes, or the whole lock if stripes is None.
+
+        An empty list of stripes touches no state, and acquires nothing.
+        """
+        if stripes is None:
+            me = threading.get_ident()
+            if self._exclusive_owner != me:
+                self._exclusive.acquire()  # pylint: disable=consider-using-with
+                self._drain()
+                self._exclusive_owner = me
+            self._exclusive_depth += 1
+            return
+        if not stripes or self._owns_exclusive():
+            # the whole lock covers all stripes
+            return
+        counts = self._held.stripes
+        if not counts:
+            # otherwise already counted in _shared: an exclusive waiter waits for us
+            with self._exclusive:
+                self._enter()
+        for i in stripes:
+            n = counts.get(i, 0)
+            if not n:
+                self._stripes[i].acquire()
+            counts[i] = n + 1
+
+    def try_acquire(self, stripes: Optional[List[int]]) -> bool:
+        """Same as acquire(), but return False rather than wait."""
+        if stripes is None:
+            me = threading.get_ident()
+            if self._exclusive_owner != me:
+                if not self._try_exclusive():
+                    return False
+                self._exclusive_owner = me
+            self._exclusive_depth += 1
+            return True
+        if not stripes or self._owns_exclusive():
+            return True
+        counts = self._held.stripes
+        entered = not counts
+        if entered and not self._try_enter():
+            return False
+        if not self._try_stripes(stripes, counts):
+            if entered:
+                self._leave()
+            return False
+        return True
+
+    def release(self, stripes: Optional[List[int]]):
+        """Release what acquire() or a successful try_acquire() acquired."""
+        if stripes is None:
+            self._exclusive_depth -= 1
+            if not self._exclusive_depth:
+                self._exclusive_owner = None
+                self._exclusive.release()
+            return
+        if not stripes or self._owns_exclusive():
+            return
+        counts = self._held.stripes
+        for i in reversed(stripes):
+            n = counts[i] - 1
+            if n:
+                counts[i] = n
+            else:
+                del counts[i]
+                self._stripes[i].release()
+        if not counts:
+            self._leave()
+
+    def _owns_exclusive(self) -> bool:
+        owner = self._exclusive_owner
+        return owner is not None and owner == threading.get_ident()
+
+    @asynccontextmanager
+    async def hold_async(
+        self, stripes: Optional[List[int]], executor: Optional[Executor] = None
+    ) -> AsyncIterator[None]:
+        """Hold the given stripes, or the whole lock, for the current task.
+
+        Never blocks the loop: while the lock is busy, a thread of the executor waits
+        for it, then the loop tries again.
+        """
+        loop = asyncio.get_running_loop()
+        while not self._try_task(stripes):
+            await loop.run_in_executor(executor, self._wait, stripes)
+        try:
+            yield
+        finally:
+            self._release_task(stripes)
+
+    def _wait(self, stripes: Optional[List[int]]):
+        self.acquire(stripes)
+        self.release(stripes)
+
+    def _try_task(self, stripes: Optional[List[int]]) -> bool:
+        # held by the task: no reentry, and nothing recorded for the thread
+        if stripes is None:
+            return self._try_exclusive()
+        if not stripes:
+            return True
+        if not self._try_enter():
+            return False
+        if not self._try_stripes(stripes):
+            self._leave()
+            return False
+        return True
+
+    def _release_task(self, stripes: Optional[List[int]]):
+        if stripes is None:
+            self._exclusive.release()
+            return
+        if not stripes:
+            return
+        for i in reversed(stripes):
+            self._stripes[i].release()
+        self._leave()
+
+    def _try_exclusive(self) -> bool:
+        # pylint: disable-next=consider-using-with
+        if not self._exclusive.acquire(blocking=False):
+            return False
+        if self._shared:
+            self._exclusive.release()
+            return False
+        return True
+
+    def _try_enter(self) -> bool:
+        # pylint: disable-next=consider-using-with
+        if not self._exclusive.acquire(blocking=False):
+            return False
+        try:
+            self._enter()
+        finally:
+            self._exclusive.release()
+        return True
+
+    def _try_stripes(
+        self, stripes: List[int], counts: Optional[Dict[int, int]] = None
+    ) -> bool:
+        """Acquire the stripes not in counts, without waiting, then count them all."""
+        taken = []
+        for i in stripes:
+            if counts and counts.get(i):
+                continue
+            if not self._stripes[i].acquire(blocking=False):
+                for j in reversed(taken):
+                    self._stripes[j].release()
+                return False
+            taken.append(i)
+        if counts is not None:
+            for i in stripes:
+                counts[i] = counts.get(i, 0) + 1
+        return True
+
+    def _drain(self):
+        # no new keyed holders while _exclusive is held, so _shared only drops
+        if self._shared:
+            with self._cond:
+                while self._shared:
+                    self._cond.wait()
+
+    def _enter(self):
+        with self._cond:
+            self._shared += 1
+
+    def _leave(self):
+        with self._cond:
+            self._shared -= 1
+            if not self._shared:
+                self._cond.notify_all()
+
+
+class AsyncQuotaLock:
+    """Asyncio version of QuotaLock, for evaluations awaiting in one event loop.
+
+    Orders the tasks of its loop only: see `RuleSet.async_lock`, which also holds the
+    RuleSet's QuotaLock for the task, excluding other threads and loops.
+    """
+
+    __autodoc__ = False
+
+    def __init__(self, stripes: int = QuotaLock.STRIPES):
+        self._exclusive = asyncio.Lock()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._shared = 0
+        self._stripes = [asyncio.Lock() for _ in range(stripes)]
+
+    @asynccontextmanager
+    async def hold(self, stripes: Optional[List[int]]) -> AsyncIterator[None]:
+        """Hold the given stripes, or the whole lock if stripes is None."""
+        if stripes is None:
+            async with self._exclusive:
+                while self._shared:
+                    await self._idle.wait()
+                yield
+            return
+        if not stripes:
+            yield
+            return
+        async with self._exclusive:
+            self._shared += 1
+            self._idle.clear()
+        held = []
+        try:
+            for i in stripes:
+                await self._stripes[i].acquire()
+                held.append(i)
+            yield
+        finally:
+            for i in reversed(held):
+                self._stripes[i].release()
+            self._shared -= 1
+            if not self._shared:
+                self._idle.set()
+
+
+__all__ = ["QUOTA_KEY_ALL", "QuotaLock", "AsyncQuotaLock"]
@@ -0,0 +1,306 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Rate limiting primitives for key server rules.
+
+Each limiter keeps a constant amount of state per key, and forgets keys once they
+have been idle long enough for their state to be indistinguishable from a new key.
+"""
+
+import abc
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional
+
+from atakama.rule_engine import RulePlugin, ApprovalRequest, ProfileInfo
+
+
+class _Keys:
+    """Per-key state of a RateLimiter with the lock guarding it, shared by adopt()."""
+
+    __autodoc__ = False
+    __slots__ = ("lock", "state")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [last use, *state], least recently used first
+        self.state: "OrderedDict[Hashable, List[float]]" = OrderedDict()
+
+
+class RateLimiter(abc.ABC):
+    """Allow `limit` uses per `period` seconds, for each key.  Thread safe."""
+
+    def __init__(
+        self,
+        limit: float,
+        period: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        assert limit > 0 and period > 0, "limit and period must be positive"
+        self.limit = limit
+        self.period = period
+        self._clock = clock
+        self._keys = _Keys()
+
+    @property
+    @abc.abstractmethod
+    def idle_expiry(self) -> float:
+        """Seconds after which an unused key's state is the same as a new key's."""
+
+    @abc.abstractmethod
+    def _new(self, now: float) -> List[float]:
+        """State of a new key."""
+
+    @abc.abstractmethod
+    def _available(self, state: List[float], now: float) -> float:
+        """Update state to now, and return the number of uses available."""
+
+    @abc.abstractmethod
+    def _use(self, state: List[float], amount: float):
+        """Record amount uses, in a state updated by _available().
+
+        A negative amount gives uses back, without exceeding the limit.
+        """
+
+    def _get(
+        self, shared: _Keys, key: Hashable, now: float, create: bool
+    ) -> Optional[List[float]]:
+        expired = now - self.idle_expiry
+        while shared.state:
+            oldest = next(iter(shared.state.values()))
+            if oldest[0] > expired:
+                break
+            shared.state.popitem(last=False)
+        state = shared.state.get(key)
+        if state is None and create:
+            state = shared.state[key] = self._new(now)
+        return state
+
+    def available(self, key: Hashable) -> float:
+        """Number of uses available for the key now."""
+        shared = self._keys
+        with shared.lock:
+            now = self._clock()
+            state = self._get(shared, key, now, False)
+            if state is None:
+                return self.limit
+            return self._available(state, now)
+
+    def allow(self, key: Hashable, amount: float = 1) -> bool:
+        """Return True if amount uses would be allowed now, without using them."""
+        return self.available(key) >= amount
+
+    def at_limit(self, key: Hashable) -> bool:
+        """Return True if the next use would be refused."""
+        return not self.allow(key)
+
+    def at_limit_many(self, keys: List[Hashable]) -> List[bool]:
+        """Same as at_limit() for each key, holding the lock once."""
+        shared = self._keys
+        with shared.lock:
+            now = self._clock()
+            ret = []
+            for key in keys:
+                state = self._get(shared, key, now, False)
+                available = self.limit if state is None else self._available(state, now)
+                ret.append(available < 1)
+            return ret
+
+    def consume(self, key: Hashable, amount: float = 1) -> bool:
+        """Atomically check and record amount uses, return False if over the limit."""
+        shared = self._keys
+        with shared.lock:
+            now = self._clock()
+            state = self._get(shared, key, now, True)
+            if self._available(state, now) < amount:
+                return False
+            self._use(state, amount)
+            state[0] = now
+            shared.state.move_to_end(key)
+            return True
+
+    def refund(self, key: Hashable, amount: float = 1):
+        """Give back amount uses recorded by consume()."""
+        shared = self._keys
+        with shared.lock:
+            now = self._clock()
+            state = self._get(shared, key, now, False)
+            if state is not None:
+                self._available(state, now)
+                self._use(state, -amount)
+
+    def clear(self, key: Hashable):
+        """Forget all uses of the key."""
+        shared = self._keys
+        with shared.lock:
+            shared.state.pop(key, None)
+
+    def keys(self) -> List[Hashable]:
+        """Keys with state, some of them possibly idle long enough to be forgotten."""
+        shared = self._keys
+        with shared.lock:
+            return list(shared.state)
+
+    def __len__(self):
+        """Number of keys with state."""
+        return len(self._keys.state)
+
+    def adopt(self, other: "RateLimiter"):
+        """Share the per-key state of another limiter of the same type."""
+        assert type(other) is type(self), "incompatible limiter"
+        # a single assignment: every call uses either its old state and lock, or
+        # the other's, never a mix of both
+        self._keys = other._keys  # pylint: disable=protected-access
+
+
+class TokenBucket(RateLimiter):
+    """Tokens refill continuously at limit/period per second, up to a burst of limit."""
+
+    @property
+    def idle_expiry(self):
+        return self.period
+
+    def _new(self, now):
+        # last use, tokens, last refill
+        return [now, self.limit, now]
+
+    def _available(self, state, now):
+        rate = self.limit / self.period
+        state[1] = min(self.limit, state[1] + (now - state[2]) * rate)
+        state[2] = now
+        return state[1]
+
+    def _use(self, state, amount):
+        state[1] = min(self.limit, state[1] - amount)
+
+
+class FixedWindow(RateLimiter):
+    """At most limit uses in each aligned window of period seconds."""
+
+    @property
+    def idle_expiry(self):
+        return self.period
+
+    def _new(self, now):
+        # last use, window start, count
+        return [now, now - now % self.period, 0]
+
+    def _available(self, state, now):
+        start = now - now % self.period
+        if start != state[1]:
+            state[1], state[2] = start, 0
+        return self.limit - state[2]
+
+    def _use(self, state, amount):
+        # uses of a previous window are not refunded to this one
+        state[2] = max(0, state[2] + amount)
+
+
+class SlidingWindow(RateLimiter):
+    """Approximate sliding window: the previous window's count is weighted by its
+    overlap with the last period seconds."""
+
+    @property
+    def idle_expiry(self):
+        return 2 * self.period
+
+    def _new(self, now):
+        # last use, window start, previous count, current count
+        return [now, now - now % self.period, 0, 0]
+
+    def _available(self, state, now):
+        start = now - now % self.period
+        if start != state[1]:
+            elapsed_windows = (start - state[1]) / self.period
+            state[2] = state[3] if elapsed_windows < 1.5 else 0
+            state[1], state[3] = start, 0
+        weight = 1 - (now - start) / self.period
+        return self.limit - (state[2] * weight + state[3])
+
+    def _use(self, state, amount):
+        state[3] = max(0, state[3] + amount)
+
+
+LIMITERS = {
+    "token_bucket": TokenBucket,
+    "fixed_window": FixedWindow,
+    "sliding_window": SlidingWindow,
+}
+
+
+class RateLimitRule(RulePlugin):
+    """
+    Base class for rules that limit the rate of approvals per profile or device.
+
+    Policy arguments:
+     - limit: number of approvals per period
+     - period: seconds
+     - algorithm: token_bucket (default), fixed_window or sliding_window
+     - per: profile (default) or device
+
+    Approvals are counted in use_quota(), so only requests approved by the whole
+    ruleset count, and requests for different keys are evaluated in parallel.
+    Subclasses must provide name(), and may override approve_request() to add
+    conditions, calling super().approve_request().
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        algorithm = args.get("algorithm", "token_bucket")
+        assert algorithm in LIMITERS, "unknown rate limit algorithm: " + algorithm
+        assert args.get("per", "profile") in ("profile", "device"), "invalid per"
+        self.limiter: RateLimiter = LIMITERS[algorithm](args["limit"], args["period"])
+        self.per_device = args.get("per") == "device"
+
+    def rate_key(self, request: ApprovalRequest) -> bytes:
+        if self.per_device:
+            return request.device_id
+        return request.profile.profile_id
+
+    def quota_key(self, request: ApprovalRequest) -> Hashable:
+        return self.rate_key(request)
+
+    def approve_request(self, request: ApprovalRequest) -> Optional[bool]:
+        return self.limiter.allow(self.rate_key(request))
+
+    def use_quota(self, request: ApprovalRequest):
+        return self.limiter.consume(self.rate_key(request))
+
+    def release_quota(self, request: ApprovalRequest):
+        self.limiter.refund(self.rate_key(request))
+
+    def at_quota(self, profile: ProfileInfo) -> Optional[bool]:
+        if self.per_device:
+            return None
+        return self.limiter.at_limit(profile.profile_id)
+
+    def at_quota_many(self, profiles: List[ProfileInfo]) -> List[Optional[bool]]:
+        if self.per_device:
+            return [None] * len(profiles)
+        return self.limiter.at_limit_many([p.profile_id for p in profiles])
+
+    def clear_quota(self, profile: ProfileInfo) -> None:
+        if not self.per_device:
+            self.limiter.clear(profile.profile_id)
+
+    def quota_profiles(self) -> List[bytes]:
+        if self.per_device:
+            return []
+        return self.limiter.keys()
+
+    def export_quota(self) -> RateLimiter:
+        return self.limiter
+
+    def import_quota(self, state: RateLimiter) -> None:
+        if type(state) is type(self.limiter):
+            self.limiter.adopt(state)
+
+
+__all__ = [
+    "RateLimiter",
+    "TokenBucket",
+    "FixedWindow",
+    "SlidingWindow",
+    "RateLimitRule",
+]
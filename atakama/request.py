@@ -0,0 +1,206 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Approval requests, as received by rules, and their immutable, hashable forms."""
+
+from dataclasses import dataclass
+from enum import Enum
+from typing import List, Tuple, Union, TYPE_CHECKING
+
+
+class RequestType(Enum):
+    DECRYPT = "decrypt"
+    SEARCH = "search"
+    CREATE_PROFILE = "create_profile"
+    CREATE_LOCATION = "create_location"
+    RENAME = "rename"
+    SECURE_EXPORT = "secure_export"
+    START_SESSION = "start_session"
+    CHANGE_PROFILE = "change_profile"
+
+
+@dataclass
+class ProfileInfo:
+    profile_id: bytes
+    """Requesting profile uuid"""
+    profile_words: List[str]
+    """Requesting profile 'words' mnemonic"""
+
+
+@dataclass
+class MetaInfo:
+    meta: str
+    """Typically the full mount-path of a file."""
+    complete: bool
+    """Whether the meta is complete (fully verified) or partial (missing components)"""
+
+
+@dataclass
+class ApprovalRequest:
+    """
+    Rule engine plugins receive this object upon request.
+
+    Members:
+     - request_type: RequestType
+     - device_id: bytes - *uuid for the device*
+     - profile: ProfileInfo - *user profile uuid and verification words*
+     - auth_meta: List[MetaInfo] - *typically a path to a file*
+     - cryptographic_id: bytes - *uuid for the file or data object**
+    """
+
+    request_type: RequestType
+    device_id: bytes
+    profile: ProfileInfo
+    auth_meta: List[MetaInfo]
+    cryptographic_id: bytes
+
+
+@dataclass(frozen=True)
+class FrozenProfileInfo:
+    """Immutable, hashable `ProfileInfo`, profile_words is a tuple."""
+
+    __slots__ = ("profile_id", "profile_words", "_hash")
+    profile_id: bytes
+    profile_words: Tuple[str, ...]
+    if TYPE_CHECKING:
+        # set by __post_init__, not a dataclass field
+        _hash: int
+
+    def __post_init__(self):
+        words = tuple(self.profile_words)
+        object.__setattr__(self, "profile_words", words)
+        object.__setattr__(self, "_hash", hash((self.profile_id, words)))
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return type(self), (self.profile_id, self.profile_words)
+
+    @classmethod
+    def from_profile(
+        cls, profile: Union[ProfileInfo, "FrozenProfileInfo"]
+    ) -> "FrozenProfileInfo":
+        if isinstance(profile, cls):
+            return profile
+        return cls(profile.profile_id, profile.profile_words)
+
+
+@dataclass(frozen=True)
+class FrozenMetaInfo:
+    """Immutable, hashable `MetaInfo`."""
+
+    __slots__ = ("meta", "complete", "_hash")
+    meta: str
+    complete: bool
+    if TYPE_CHECKING:
+        # set by __post_init__, not a dataclass field
+        _hash: int
+
+    def __post_init__(self):
+        object.__setattr__(self, "_hash", hash((self.meta, self.complete)))
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return type(self), (self.meta, self.complete)
+
+    @classmethod
+    def from_meta(cls, meta: Union[MetaInfo, "FrozenMetaInfo"]) -> "FrozenMetaInfo":
+        if isinstance(meta, cls):
+            return meta
+        return cls(meta.meta, meta.complete)
+
+
+@dataclass(frozen=True)
+class FrozenApprovalRequest:
+    """Immutable, hashable `ApprovalRequest`, with a precomputed hash.
+
+    Rules see the same members, with tuples instead of lists, and can be passed to
+    the engine in place of an ApprovalRequest.  Use them as cache or batch keys.
+    """
+
+    __slots__ = (
+        "request_type",
+        "device_id",
+        "profile",
+        "auth_meta",
+        "cryptographic_id",
+        "_hash",
+    )
+    request_type: RequestType
+    device_id: bytes
+    profile: FrozenProfileInfo
+    auth_meta: Tuple[FrozenMetaInfo, ...]
+    cryptographic_id: bytes
+    if TYPE_CHECKING:
+        # set by __post_init__, not a dataclass field
+        _hash: int
+
+    def __post_init__(self):
+        profile = FrozenProfileInfo.from_profile(self.profile)
+        auth_meta = tuple(FrozenMetaInfo.from_meta(meta) for meta in self.auth_meta)
+        object.__setattr__(self, "profile", profile)
+        object.__setattr__(self, "auth_meta", auth_meta)
+        object.__setattr__(
+            self,
+            "_hash",
+            hash(
+                (
+                    self.request_type,
+                    self.device_id,
+                    profile,
+                    auth_meta,
+                    self.cryptographic_id,
+                )
+            ),
+        )
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):
+        return type(self), (
+            self.request_type,
+            self.device_id,
+            self.profile,
+            self.auth_meta,
+            self.cryptographic_id,
+        )
+
+    @classmethod
+    def from_request(
+        cls, request: Union[ApprovalRequest, "FrozenApprovalRequest"]
+    ) -> "FrozenApprovalRequest":
+        """Frozen copy of a request, frozen requests are returned as is."""
+        if isinstance(request, cls):
+            return request
+        return cls(
+            request.request_type,
+            request.device_id,
+            request.profile,
+            request.auth_meta,
+            request.cryptographic_id,
+        )
+
+    def to_request(self) -> ApprovalRequest:
+        """Mutable copy of the request."""
+        return ApprovalRequest(
+            self.request_type,
+            self.device_id,
+            ProfileInfo(self.profile.profile_id, list(self.profile.profile_words)),
+            [MetaInfo(meta.meta, meta.complete) for meta in self.auth_meta],
+            self.cryptographic_id,
+        )
+
+
+__all__ = [
+    "RequestType",
+    "ProfileInfo",
+    "MetaInfo",
+    "ApprovalRequest",
+    "FrozenProfileInfo",
+    "FrozenMetaInfo",
+    "FrozenApprovalRequest",
+]
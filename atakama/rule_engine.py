@@ -6,18 +6,57 @@
 
 """Atakama keyserver ruleset library"""
 import abc
-import hashlib
-import json
+import asyncio
+import operator
 import threading
+import weakref
 from collections import defaultdict
-from dataclasses import dataclass
-from enum import Enum
-from typing import List, Dict, Union, TYPE_CHECKING, Optional, Any, Type
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import (
+    List,
+    Dict,
+    Union,
+    TYPE_CHECKING,
+    Optional,
+    Any,
+    Type,
+    Hashable,
+    Iterable,
+    Callable,
+    Tuple,
+    Sequence,
+    AsyncIterator,
+)
 import logging
 
 import yaml
 
 from atakama import Plugin
+from atakama.quota import QuotaStore, MemoryQuotaStore
+from atakama.quota import QuotaRegistry
+from atakama.policy_cache import PolicyCache
+from atakama.metrics import EngineMetrics
+from atakama.tracing import DecisionTracer, Explanation
+from atakama.evaluation_plan import compile_stripes, compile_use
+
+# pylint: disable=unused-import
+# re-exported: `atakama` exports these from here, where most of them were defined
+from atakama.quota import MmapQuotaStore, SqliteQuotaStore
+from atakama.request import (
+    RequestType,
+    ProfileInfo,
+    MetaInfo,
+    ApprovalRequest,
+    FrozenProfileInfo,
+    FrozenMetaInfo,
+    FrozenApprovalRequest,
+)
+from atakama.quota_lock import QUOTA_KEY_ALL, QuotaLock, AsyncQuotaLock
+from atakama.rule_ids import RULE_ID_HASHES, RuleIdGenerator, RuleReuse
+from atakama.evaluation_plan import EvaluationPlan, RuleStats
+
+# pylint: enable=unused-import
 
 if TYPE_CHECKING:
     from pathlib import Path
@@ -25,52 +64,8 @@ if TYPE_CHECKING:
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
-
-class RequestType(Enum):
-    DECRYPT = "decrypt"
-    SEARCH = "search"
-    CREATE_PROFILE = "create_profile"
-    CREATE_LOCATION = "create_location"
-    RENAME = "rename"
-    SECURE_EXPORT = "secure_export"
-    START_SESSION = "start_session"
-    CHANGE_PROFILE = "change_profile"
-
-
-@dataclass
-class ProfileInfo:
-    profile_id: bytes
-    """Requesting profile uuid"""
-    profile_words: List[str]
-    """Requesting profile 'words' mnemonic"""
-
-
-@dataclass
-class MetaInfo:
-    meta: str
-    """Typically the full mount-path of a file."""
-    complete: bool
-    """Whether the meta is complete (fully verified) or partial (missing components)"""
-
-
-@dataclass
-class ApprovalRequest:
-    """
-    Rule engine plugins receive this object upon request.
-
-    Members:
-     - request_type: RequestType
-     - device_id: bytes - *uuid for the device*
-     - profile: ProfileInfo - *user profile uuid and verification words*
-     - auth_meta: List[MetaInfo] - *typically a path to a file*
-     - cryptographic_id: bytes - *uuid for the file or data object**
-    """
-
-    request_type: RequestType
-    device_id: bytes
-    profile: ProfileInfo
-    auth_meta: List[MetaInfo]
-    cryptographic_id: bytes
+# libyaml's loader is an order of magnitude faster than the pure python one
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
 
 class RulePlugin(Plugin):
@@ -84,6 +79,24 @@ class RulePlugin(Plugin):
 
     In addition to standard arguments from the policy, file a unique
     `rule_id` is injected, if not present.
+
+    Within a single request, a compiled RuleEngine evaluates rules with identical
+    configuration only once, sharing the result among rulesets.  Rules that override
+    use_quota() are never shared.  Adaptive engines may also evaluate rules of a RuleSet
+    out of order.  Set `pure = False` on rules whose approve_request() is not a pure
+    function of the request, for example because it keeps counters.
+    """
+
+    pure = True
+
+    quota_store: Optional[QuotaStore] = None
+    """Counter storage shared by the rules of an engine, set by the RuleEngine."""
+
+    stores_quota = False
+    """True if the rule keeps all its quota state in the `quota_store`.
+
+    Rules with quotas kept in their own memory, such as `RateLimitRule`, count
+    separately in each process, and are refused by `WorkerPool`.
     """
 
     def __init__(self, args):
@@ -122,7 +135,54 @@ class RulePlugin(Plugin):
         Given that a request has already been authorized via approve_request(), indicate
         that this rule is being used for request approval and any internal counters
         should be incremented.
+
+        Return False if the quota can no longer be used, for example because another
+        process sharing the `quota_store` used it first: the request is then denied.
+        """
+
+    def release_quota(self, request: ApprovalRequest):
+        """
+        Undo use_quota() for a request that is denied after all, because a later rule
+        of the RuleSet could not use its quota.
+
+        Called in reverse order, under the same lock, for each rule whose use_quota()
+        succeeded, so a denied request uses no quota.  Rules counting in the
+        `quota_store` should decrement the counter incremented by use_quota().
+        """
+
+    def approve_requests(self, requests: List[ApprovalRequest]) -> List[Optional[bool]]:
+        """
+        Vectorized approve_request(), return one result per request, in order.
+
+        Override for rules that can evaluate many requests faster than one at a time.
+        Only called for stateless rules (see `is_stateless`) not preceded by stateful
+        rules in their RuleSet, for batches evaluated via `RuleEngine.approve_requests`
+        by engines that are not compiled.  If this raises, requests are retried singly.
+        """
+        return [self.approve_request(request) for request in requests]
+
+    def is_stateless(self) -> bool:
+        """True if approve_request() is pure, and the rule doesn't use quotas."""
+        return self.pure and not self.overrides("use_quota")
+
+    @classmethod
+    def overrides(cls, method: str) -> bool:
+        """True if the rule's class overrides the named RulePlugin method."""
+        return getattr(cls, method) is not getattr(RulePlugin, method)
+
+    def quota_key(  # pylint: disable=unused-argument
+        self, request: ApprovalRequest
+    ) -> Optional[Hashable]:
+        """
+        Return the key of the state read or written by approve_request() and use_quota().
+
+        Rules that keep per-profile counters should return `request.profile.profile_id`,
+        so that requests for unrelated profiles can be evaluated in parallel within a RuleSet.
+        Return None if the rule keeps no state for this request.
+
+        The default, QUOTA_KEY_ALL, serializes all requests evaluated by the RuleSet.
         """
+        return QUOTA_KEY_ALL
 
     def at_quota(self, profile: ProfileInfo) -> Optional[bool]:
         """
@@ -134,6 +194,16 @@ class RulePlugin(Plugin):
         reached any limits, quotas or other stateful things for reporting purposed.
         """
 
+    def at_quota_many(self, profiles: List[ProfileInfo]) -> List[Optional[bool]]:
+        """
+        Vectorized at_quota(), return one result per profile, in order.
+
+        Override for rules that can check many profiles faster than one at a time, for
+        example with one query to their store.  Used by `RuleEngine.quota_report`.  If
+        this raises, profiles are retried one by one.
+        """
+        return [self.at_quota(profile) for profile in profiles]
+
     def clear_quota(self, profile: ProfileInfo) -> None:
         """
         Reset or clear any limits, quotas, access counts, bytes-transferred for a given profile.
@@ -141,10 +211,48 @@ class RulePlugin(Plugin):
         Used by an administrator to "clear" or "reset" a user that has hit limits.
         """
 
+    def quota_profiles(self) -> Optional[Iterable[bytes]]:
+        """
+        Return the ids of the profiles for which this rule holds quota state, or None.
+
+        Used to index profiles with quota state, see `RuleEngine.quota_index`.  Counters
+        in the `quota_store` are indexed by the engine, with the key as profile_id, and
+        need not be listed.  Rules keeping other per-profile state should override
+        this: the default, None, means that state can't be listed.
+        """
+        return None
+
+    def export_quota(self) -> Any:
+        """
+        Return the quota state held by this rule, or None.
+
+        On policy reload, the state is passed to import_quota() of the new rule with
+        the same rule_id.  Return live objects rather than copies: requests in flight
+        on the old engine keep updating them.  State in the `quota_store` is carried
+        over with the store, and needs no export.
+        """
+        return None
+
+    def import_quota(self, state: Any) -> None:
+        """Adopt the state exported by the rule this one replaces, see export_quota()."""
+
+    def prepare(self, shared: Dict[str, Any]) -> None:
+        """
+        Called by each RuleEngine holding the rule, before it evaluates requests.
+
+        `shared` is the same dict for all rules of the engine: use it to build indexes
+        shared by rules of a type, for example `atakama.path_rule.PathIndex`.  Rules
+        reused by a reloaded engine are prepared again, with the new engine's dict.
+        """
+
     @classmethod
-    def from_dict(cls, data: dict, defaults=None) -> "RulePlugin":
+    def from_dict(
+        cls, data: dict, defaults=None, reuse: Optional["RuleReuse"] = None
+    ) -> "RulePlugin":
         """
         Factory function called with a dict from the rules yaml file.
+
+        If `reuse` holds a rule with the same configuration, that instance is returned.
         """
 
         assert type(data) is dict, "Rule entries must be dicts"
@@ -152,6 +260,10 @@ class RulePlugin(Plugin):
         pname = data.pop("rule")
         if pname in defaults:
             cls.set_args_defaults(data, defaults[pname])
+        if reuse is not None:
+            prev = reuse.find_rule(pname, data)
+            if prev is not None:
+                return prev
         p = RulePlugin.get_by_name(pname)(data)
         assert isinstance(p, RulePlugin), "Rule plugins must derive from RulePlugin"
         return p
@@ -161,62 +273,374 @@ class RulePlugin(Plugin):
         out["rule"] = self.name()
         return out
 
+    def reuse_key(self) -> Optional[str]:
+        """Hash of the full configuration, including rule_id, see `RuleReuse`."""
+        return RuleReuse.config_key(self.name(), self.args)
 
-class RuleIdGenerator:
-    """Manage unique rule id generation."""
+    def memo_key(self) -> Optional[str]:
+        """Content hash of the rule configuration, or None if results must not be shared."""
+        if not self.is_stateless():
+            return None
+        ent = self.to_dict()
+        ent.pop("rule_id", None)
+        try:
+            return RuleIdGenerator.content_hash(ent)
+        except (TypeError, ValueError):
+            return None
 
-    __autodoc__ = False
 
-    def __init__(self):
-        self._seen = defaultdict(lambda: 0)
+class AsyncRulePlugin(RulePlugin):
+    """
+    Base class for rules that await external state: directory lookups, quota stores.
 
-    def generate(self, ent: Any) -> str:
-        ent_data = json.dumps(ent, sort_keys=True, separators=(",", ":"))
-        ent_hash = hashlib.md5(ent_data.encode("utf8")).hexdigest()
-        # if the hash is enough, use it, that way it's relocatable and still consistent
-        if ent_hash in self._seen:
-            self._seen[ent_hash] += 1
-            # otherwise append a sequence
-            ent_hash += "." + str(self._seen[ent_hash])
-        self._seen[ent_hash] += 1
-        return ent_hash
+    Implement approve_request_async(), and optionally use_quota_async(): they are
+    awaited by `RuleEngine.approve_request_async`, without blocking other rulesets.
 
-    def inject_rule_id(self, ent: dict):
-        """
-        Modify the supplied dictionary to add a rule_id, but only if a rule_id is not present.
+    The synchronous approve_request() and use_quota() run the coroutines in a new event
+    loop, so that the rule also works with synchronous engines and batches.  Called from
+    a thread already running an event loop, they run the new loop in another thread.
+    """
 
-        Keeps track of rule id's and ensures uniqueness, while trying to maintain consistency.
-        """
+    @abc.abstractmethod
+    async def approve_request_async(self, request: ApprovalRequest) -> Optional[bool]:
+        """Same as `RulePlugin.approve_request`."""
+
+    async def use_quota_async(self, request: ApprovalRequest):
+        """Same as `RulePlugin.use_quota`."""
+
+    async def release_quota_async(self, request: ApprovalRequest):
+        """Same as `RulePlugin.release_quota`."""
 
-        rule_id = ent.get("rule_id")
-        if not rule_id:
-            ent_hash = self.generate(ent)
-            ent["rule_id"] = ent_hash
-        else:
-            self._seen[ent["rule_id"]] += 1
+    @staticmethod
+    def _run(coro) -> Any:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coro)
+        # asyncio.run() refuses to nest loops in one thread
+        with ThreadPoolExecutor(1) as executor:
+            return executor.submit(asyncio.run, coro).result()
 
+    def approve_request(self, request: ApprovalRequest) -> Optional[bool]:
+        return self._run(self.approve_request_async(request))
+
+    def use_quota(self, request: ApprovalRequest):
+        if type(self).use_quota_async is not AsyncRulePlugin.use_quota_async:
+            return self._run(self.use_quota_async(request))
+        return None
+
+    def release_quota(self, request: ApprovalRequest):
+        if type(self).release_quota_async is not AsyncRulePlugin.release_quota_async:
+            self._run(self.release_quota_async(request))
+
+    def is_stateless(self) -> bool:
+        return (
+            self.pure
+            and type(self).use_quota_async is AsyncRulePlugin.use_quota_async
+            and type(self).use_quota is AsyncRulePlugin.use_quota
+        )
+
+
+async def _finish(coro):
+    """Await coro to completion even if cancelled, then propagate the cancellation.
+
+    Used so quotas are never left half-used.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        await task
+        raise
+
+
+def _modifies(method: Callable) -> Callable:
+    def modified(self, *args):
+        _RuleList.modifications += 1
+        return method(self, *args)
+
+    modified.__name__ = method.__name__
+    modified.__doc__ = method.__doc__
+    return modified
+
+
+class _RuleList(list):
+    """List counting the modifications of all RuleSets and RuleTrees.
+
+    Indexes built from a rule map, such as `QuotaRegistry`, are rebuilt once the
+    count changes.
+    """
 
-class RuleSet(List[RulePlugin]):
+    __autodoc__ = False
+
+    modifications = 0
+
+    append = _modifies(list.append)
+    extend = _modifies(list.extend)
+    insert = _modifies(list.insert)
+    pop = _modifies(list.pop)
+    remove = _modifies(list.remove)
+    clear = _modifies(list.clear)
+    reverse = _modifies(list.reverse)
+    __setitem__ = _modifies(list.__setitem__)
+    __delitem__ = _modifies(list.__delitem__)
+    __iadd__ = _modifies(list.__iadd__)
+    __imul__ = _modifies(list.__imul__)
+
+    def sort(self, *, key=None, reverse=False):
+        _RuleList.modifications += 1
+        super().sort(key=key, reverse=reverse)
+
+
+class RuleSet(_RuleList, List[RulePlugin]):
     """A list of rules, can reply True, False, or None to an ApprovalRequest
 
     All rules must pass in a ruleset
 
     An empty ruleset always returns True
+
+    Evaluation and quota use are atomic per quota key, see `RulePlugin.quota_key`.
+
+    Set `ordered = True` if adaptive engines must evaluate the rules in list order.
     """
 
+    ordered = False
+
     def __init__(self, *args, **kws):
         super().__init__(*args, **kws)
 
-        self.__lock = threading.RLock()
+        self.__lock = QuotaLock()
+        self.__async_locks: Optional[
+            "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncQuotaLock]"
+        ] = None
+
+    def async_lock(self, request: ApprovalRequest):
+        """Async context manager, holding the lock needed to evaluate the request.
+
+        Excludes evaluations of the same quota keys in other tasks, other threads
+        and other event loops, synchronous or not.
+        """
+        return self._hold_async(self.lock_stripes(request))
+
+    @asynccontextmanager
+    async def _hold_async(self, stripes: Optional[List[int]]) -> AsyncIterator[None]:
+        loop = asyncio.get_running_loop()
+        if self.__async_locks is None:
+            self.__async_locks = weakref.WeakKeyDictionary()
+        # asyncio primitives belong to one loop, each loop gets its own
+        alock = self.__async_locks.get(loop)
+        if alock is None:
+            alock = self.__async_locks[loop] = AsyncQuotaLock()
+        # tasks of this loop wait on alock: the QuotaLock is then only contended
+        # by other threads and loops, it is held for the task, not the loop's thread
+        async with alock.hold(stripes), self.__lock.hold_async(stripes):
+            yield
+
+    @staticmethod
+    async def _call_async(
+        rule: RulePlugin,
+        method: str,
+        request: ApprovalRequest,
+        executor: Optional[Executor],
+    ) -> Any:
+        """Await the async version of rule.method, or run it in the executor."""
+        if isinstance(rule, AsyncRulePlugin):
+            return await getattr(rule, method + "_async")(request)
+        func = getattr(rule, method)
+        return await asyncio.get_running_loop().run_in_executor(executor, func, request)
+
+    async def check_async(
+        self, request: ApprovalRequest, executor: Optional[Executor] = None
+    ) -> bool:
+        """Return true if all rules approve, without using quotas.
+
+        Synchronous rules are run in the executor.  Hold async_lock() around the check
+        and the subsequent use_quota_async().
+        """
+        debug = log.isEnabledFor(logging.DEBUG)
+        for i, rule in enumerate(self):  # pylint: disable=not-an-iterable
+            try:
+                res = await self._call_async(rule, "approve_request", request, executor)
+                if debug:
+                    log.debug(
+                        "RuleSet.check_async[%s]: rule_id=%s i=%i res=%s",
+                        request.request_type,
+                        rule.rule_id,
+                        i,
+                        res,
+                    )
+                if res is None:
+                    log.error("unknown request type error in rule %s", rule)
+                if not res:
+                    return False
+            except Exception as ex:
+                log.error("error in rule %s: %r", rule, ex)
+                return False
+        return True
+
+    async def use_quota_async(
+        self, request: ApprovalRequest, executor: Optional[Executor] = None
+    ) -> bool:
+        """Use quotas of all rules, return False on error, releasing those used."""
+        used: List[RulePlugin] = []
+        for rule in self:  # pylint: disable=not-an-iterable
+            try:
+                res = await self._call_async(rule, "use_quota", request, executor)
+            except Exception as ex:
+                log.error("error in rule use_quota %s: %r", rule, ex)
+                res = False
+            else:
+                if res is False:
+                    log.debug("quota refused by rule %s", rule)
+            if res is False:
+                for prev in reversed(used):
+                    try:
+                        await self._call_async(prev, "release_quota", request, executor)
+                    except Exception as ex:
+                        log.error("error in rule release_quota %s: %r", prev, ex)
+                return False
+            used.append(rule)
+        return True
+
+    async def approve_request_async(
+        self, request: ApprovalRequest, executor: Optional[Executor] = None
+    ) -> bool:
+        """Async version of approve_request, see `RuleEngine.approve_request_async`."""
+        async with self.async_lock(request):
+            if not await self.check_async(request, executor):
+                return False
+            return await _finish(self.use_quota_async(request, executor))
+
+    def lock_stripes(self, request: ApprovalRequest) -> Optional[List[int]]:
+        """Return the lock stripes needed to evaluate the request, None for all of them."""
+        return self._lock_stripes([request])
+
+    def _lock_stripes(self, requests: List[ApprovalRequest]) -> Optional[List[int]]:
+        keys = set()
+        for rule in self:  # pylint: disable=not-an-iterable
+            for request in requests:
+                try:
+                    key = rule.quota_key(request)
+                except Exception as ex:
+                    log.error("error in rule quota_key %s: %r", rule, ex)
+                    return None
+                if key is QUOTA_KEY_ALL:
+                    return None
+                if key is not None:
+                    keys.add(key)
+        return self.__lock.stripes_for(keys)
 
     def approve_request(self, request: ApprovalRequest) -> bool:
         """Return true if all rules return true."""
         # Lock to prevent races between approve_request and use_quota
-        with self.__lock:
-            # Check if all rules approve
-            for i, rule in enumerate(self):  # pylint: disable=not-an-iterable
+        stripes = self.lock_stripes(request)
+        self.__lock.acquire(stripes)
+        try:
+            return self._approve_locked(request)
+        finally:
+            self.__lock.release(stripes)
+
+    def _stateless_prefix(self) -> int:
+        """Number of leading stateless rules.
+
+        Their results don't depend on other requests, so they can be evaluated ahead
+        of the rules that follow them, without changing any decision.
+        """
+        for i, rule in enumerate(self):  # pylint: disable=not-an-iterable
+            if not rule.is_stateless():
+                return i
+        return len(self)
+
+    def approve_requests(self, requests: List[ApprovalRequest]) -> List[bool]:
+        """Return, for each request, true if all rules return true.
+
+        Equivalent to calling approve_request for each request in order, while holding
+        the lock once for the whole batch.  The leading stateless rules are evaluated
+        first, for all requests at once via `RulePlugin.approve_requests`, then the
+        remaining rules, in order, one request at a time.
+        """
+        prefix = self._stateless_prefix()
+        rest = self[prefix:]
+
+        stripes = self._lock_stripes(requests)
+        self.__lock.acquire(stripes)
+        try:
+            pending = list(range(len(requests)))
+            for rule in self[:prefix]:
+                if not pending:
+                    break
+                batch = [requests[i] for i in pending]
                 try:
-                    res = rule.approve_request(request)
+                    results = rule.approve_requests(batch)
+                    if len(results) != len(batch):
+                        raise ValueError(
+                            f"{len(results)} results for {len(batch)} requests"
+                        )
+                except Exception as ex:
+                    log.error("error in rule approve_requests %s: %r", rule, ex)
+                    results = [self._approve_one(rule, req) for req in batch]
+                if None in results:
+                    log.error("unknown request type error in rule %s", rule)
+                pending = [i for i, res in zip(pending, results) if res]
+
+            ret = [False] * len(requests)
+            for i in pending:
+                ret[i] = self._approve_locked(requests[i], rest)
+            log.debug(
+                "RuleSet.approve_requests: n=%i approved=%i", len(requests), sum(ret)
+            )
+            return ret
+        finally:
+            self.__lock.release(stripes)
+
+    def check(
+        self, request: ApprovalRequest, abandon: Optional[threading.Event] = None
+    ) -> bool:
+        """Return true if the leading stateless rules approve, without locking.
+
+        Stops early, returning False, once `abandon` is set.
+        """
+        for rule in self[: self._stateless_prefix()]:
+            if abandon is not None and abandon.is_set():
+                return False
+            if not self._approve_one(rule, request):
+                return False
+        return True
+
+    def commit(self, request: ApprovalRequest) -> bool:
+        """Evaluate the rules after those of check(), and use quotas, under the lock.
+
+        Together with a successful check(), equivalent to approve_request().
+        """
+        rest = self[self._stateless_prefix() :]
+        stripes = self.lock_stripes(request)
+        self.__lock.acquire(stripes)
+        try:
+            return self._approve_locked(request, rest)
+        finally:
+            self.__lock.release(stripes)
+
+    @staticmethod
+    def _approve_one(rule: RulePlugin, request: ApprovalRequest) -> bool:
+        try:
+            res = rule.approve_request(request)
+            if res is None:
+                log.error("unknown request type error in rule %s", rule)
+            return bool(res)
+        except Exception as ex:
+            log.error("error in rule %s: %r", rule, ex)
+            return False
+
+    def _approve_locked(
+        self, request: ApprovalRequest, rules: Optional[List[RulePlugin]] = None
+    ) -> bool:
+        # Check if all rules approve
+        rules = self if rules is None else rules
+        debug = log.isEnabledFor(logging.DEBUG)
+        for i, rule in enumerate(rules):
+            try:
+                res = rule.approve_request(request)
+                if debug:
                     log.debug(
                         "RuleSet.approve_request[%s]: rule_id=%s i=%i res=%s",
                         request.request_type,
@@ -224,33 +648,146 @@ class RuleSet(List[RulePlugin]):
                         i,
                         res,
                     )
-                    if res is None:
-                        log.error("unknown request type error in rule %s", rule)
-                    if not res:
-                        return False
-                except Exception as ex:
-                    log.error("error in rule %s: %s", rule, repr(ex))
+                if res is None:
+                    log.error("unknown request type error in rule %s", rule)
+                if not res:
                     return False
+            except Exception as ex:
+                log.error("error in rule %s: %r", rule, ex)
+                return False
 
-            # Rule set succeeded, so now inc the quota counts
-            for i, rule in enumerate(self):  # pylint: disable=not-an-iterable
-                try:
-                    rule.use_quota(request)
-                except Exception as ex:
-                    log.error("error in rule use_quota %s: %s", rule, repr(ex))
+        # Rule set succeeded, so now inc the quota counts
+        for i, rule in enumerate(self):  # pylint: disable=not-an-iterable
+            try:
+                if rule.use_quota(request) is False:
+                    log.debug("quota refused by rule %s", rule)
+                    self._release_quota(request, self[:i])
                     return False
+            except Exception as ex:
+                log.error("error in rule use_quota %s: %r", rule, ex)
+                self._release_quota(request, self[:i])
+                return False
         return True
 
+    def _bind(self, bound: Dict[int, Tuple]) -> Tuple[RulePlugin, ...]:
+        """The rules, with their methods looked up in `bound`, see compile()."""
+        rules = tuple(self)  # pylint: disable=not-an-iterable
+        for rule in rules:
+            if id(rule) not in bound:
+                keyed = type(rule).quota_key is not RulePlugin.quota_key
+                bound[id(rule)] = (
+                    rule.approve_request,
+                    rule.use_quota,
+                    rule.quota_key if keyed else None,
+                )
+        return rules
+
+    @staticmethod
+    def _release_quota(request: ApprovalRequest, rules: Sequence[RulePlugin]):
+        """Release the quotas used by rules, in reverse order."""
+        for rule in reversed(rules):
+            try:
+                rule.release_quota(request)
+            except Exception as ex:
+                log.error("error in rule release_quota %s: %r", rule, ex)
+
+    def compile(
+        self,
+        bound: Optional[Dict[int, Tuple]] = None,
+        memo_keys: Optional[Dict[int, str]] = None,
+        order: Optional[Iterable[int]] = None,
+        wrap: Optional[Callable[[RulePlugin, Callable], Callable]] = None,
+        use_quota: bool = True,
+    ) -> Callable[[ApprovalRequest, Optional[dict]], bool]:
+        """Return a function equivalent to approve_request, for a snapshot of the rules.
+
+        Bound methods are looked up once, and shared via `bound` among rulesets holding
+        the same rule instance.  Recompile after modifying the ruleset.
+
+        The function takes an optional per-request `memo` dict: results of rules listed
+        in `memo_keys` (by rule instance id) are stored there, and reused by other
+        rulesets evaluating the same request.
+
+        Rules are approved in `order` (a permutation of rule indexes), quotas are
+        always used in list order.  `wrap(rule, approve_request)` may replace each
+        rule's approve_request, for instrumentation.  Without `use_quota`, the function
+        only checks the rules, like a dry run.
+        """
+        bound = {} if bound is None else bound
+        listed = self._bind(bound)
+        rules = listed if order is None else tuple(listed[i] for i in order)
+        memo_keys = memo_keys or {}
+        # (approve_request, memo key) of each rule
+        steps = tuple(
+            (
+                bound[id(r)][0] if wrap is None else wrap(r, bound[id(r)][0]),
+                memo_keys.get(id(r)),
+            )
+            for r in rules
+        )
+        stripes = compile_stripes(rules, bound, self.__lock.stripes_for)
+        use = compile_use(listed, bound, self._release_quota) if use_quota else None
+        acquire, release = self.__lock.acquire, self.__lock.release
+        is_debug = log.isEnabledFor
+
+        def approve(request: ApprovalRequest, memo: Optional[dict] = None) -> bool:
+            held = None if stripes is None else stripes(request)
+            acquire(held)
+            try:
+                debug = is_debug(logging.DEBUG)
+                for i, (approver, memo_key) in enumerate(steps):
+                    key = memo_key if memo is not None else None
+                    try:
+                        if key is None:
+                            res = approver(request)
+                        else:
+                            res = memo.get(key, memo)
+                            if res is memo:
+                                res = memo[key] = approver(request)
+                    except Exception as ex:
+                        log.error("error in rule %s: %r", rules[i], ex)
+                        if key is not None:
+                            memo[key] = False
+                        return False
+                    if debug:
+                        log.debug(
+                            "RuleSet.approve_request[%s]: rule_id=%s i=%i res=%s",
+                            request.request_type,
+                            rules[i].rule_id,
+                            i,
+                            res,
+                        )
+                    if not res:
+                        if res is None:
+                            log.error("unknown request type error in rule %s", rules[i])
+                        return False
+                return use is None or use(request)
+            finally:
+                release(held)
+
+        return approve
+
     @classmethod
     def from_list(
-        cls, ruledata: List[dict], rgen: RuleIdGenerator, defaults=None
+        cls,
+        ruledata: List[dict],
+        rgen: Optional[RuleIdGenerator],
+        defaults=None,
+        reuse: Optional[RuleReuse] = None,
     ) -> "RuleSet":
+        """Build a RuleSet from a list of rule entries, see `RuleEngine.from_dict`.
+
+        Rule ids are injected with "rgen", pass None if the entries already have them.
+        If `reuse` holds a RuleSet of the same rule instances, that set is returned.
+        """
         lst = []
         assert isinstance(ruledata, list), "Rulesets must be lists"
         for ent in ruledata:
-            rgen.inject_rule_id(ent)
-            lst.append(RulePlugin.from_dict(ent, defaults))
-        return RuleSet(lst)
+            if rgen is not None:
+                rgen.inject_rule_id(ent)
+            lst.append(RulePlugin.from_dict(ent, defaults, reuse))
+        prev = reuse.find_set(lst) if reuse is not None else None
+        return prev if prev is not None else RuleSet(lst)
 
     def to_list(self) -> List[Dict]:
         lst = []
@@ -259,6 +796,16 @@ class RuleSet(List[RulePlugin]):
             lst.append(ent.to_dict())
         return lst
 
+    @property
+    def stable_id(self) -> str:
+        """Identifier derived from the rule ids, the same in every process and restart.
+
+        Unlike the id() returned by approve_request, it can be used to join audit logs
+        across workers.  Changes if the rules of the set change.
+        """
+        # pylint: disable=not-an-iterable
+        return RuleIdGenerator.content_hash([rule.rule_id for rule in self])
+
     def at_quota(self, profile: ProfileInfo) -> bool:
         """Returns True if the given profile is at quota for any rule in the RuleSet."""
         for i, rule in enumerate(self):  # pylint: disable=not-an-iterable
@@ -273,7 +820,7 @@ class RuleSet(List[RulePlugin]):
                     )
                     return True
             except Exception as ex:
-                log.error("error in rule %s: %s", rule, repr(ex))
+                log.error("error in rule %s: %r", rule, ex)
                 continue
         return False
 
@@ -286,36 +833,165 @@ class RuleSet(List[RulePlugin]):
         return ret
 
 
-class RuleTree(List[RuleSet]):
+class RuleTree(_RuleList, List[RuleSet]):
     """A list of RuleSet objects.
 
     Return the ruleset id if *any* RuleSet returns True.
     Returns False if all RuleSets return False.
+
+    Set `ordered = False` if any approving RuleSet may be chosen, allowing adaptive
+    engines to try the rulesets out of order.
     """
 
+    ordered = True
+
     def approve_request(self, request: ApprovalRequest) -> Union[bool, int]:
         """Return the ruleset id if any ruleset returns true, otherwise False."""
+        debug = log.isEnabledFor(logging.DEBUG)
         for i, rset in enumerate(self):  # pylint: disable=not-an-iterable
             res = rset.approve_request(request)
-            log.debug(
-                "RuleTree.approve_request[%s]: set=%i res=%s",
-                request.request_type,
-                i,
-                res,
-            )
+            if debug:
+                log.debug(
+                    "RuleTree.approve_request[%s]: set=%i res=%s",
+                    request.request_type,
+                    i,
+                    res,
+                )
             if res:
                 return id(rset)
         return False
 
+    def approve_request_parallel(
+        self, request: ApprovalRequest, executor: Executor
+    ) -> Union[bool, int]:
+        """Same as approve_request, checking rulesets concurrently in the executor.
+
+        Stateless rules of every ruleset are checked in parallel.  Then, in list order,
+        the first ruleset that passed its check evaluates its stateful rules and uses
+        quotas under its lock (`RuleSet.commit`), so the result is the same ruleset the
+        sequential evaluation picks.  Remaining checks are abandoned once one commits.
+        """
+        abandon = threading.Event()
+        futures = [
+            executor.submit(rset.check, request, abandon)
+            if rset._stateless_prefix()  # pylint: disable=protected-access
+            else None
+            for rset in self  # pylint: disable=not-an-iterable
+        ]
+        try:
+            for i, (rset, fut) in enumerate(zip(self, futures)):
+                try:
+                    ok = fut is None or fut.result()
+                except Exception as ex:
+                    log.error("error in ruleset check %i: %r", i, ex)
+                    ok = False
+                res = ok and rset.commit(request)
+                log.debug(
+                    "RuleTree.approve_request_parallel[%s]: set=%i res=%s",
+                    request.request_type,
+                    i,
+                    res,
+                )
+                if res:
+                    return id(rset)
+            return False
+        finally:
+            abandon.set()
+            for fut in futures:
+                if fut is not None:
+                    fut.cancel()
+
+    async def approve_request_async(
+        self, request: ApprovalRequest, executor: Optional[Executor] = None
+    ) -> Union[bool, int]:
+        """Async version of approve_request, evaluating rulesets concurrently.
+
+        Returns the same ruleset as approve_request: the first one, in list order, that
+        approves.  Once a ruleset approves, later rulesets are cancelled, and only the
+        winner uses quotas.  Each ruleset holds its lock until it is either chosen or
+        discarded, so its check stays valid.
+        """
+        loop = asyncio.get_running_loop()
+        count = len(self)
+        checked = [loop.create_future() for _ in range(count)]
+        chosen = [loop.create_future() for _ in range(count)]
+
+        async def evaluate(i: int, rset: RuleSet) -> bool:
+            try:
+                async with rset.async_lock(request):
+                    ok = await rset.check_async(request, executor)
+                    checked[i].set_result(ok)
+                    if ok and await chosen[i]:
+                        return await _finish(rset.use_quota_async(request, executor))
+                    return False
+            finally:
+                if not checked[i].done():
+                    checked[i].set_result(False)
+
+        tasks = [
+            asyncio.ensure_future(evaluate(i, rset))
+            for i, rset in enumerate(self)  # pylint: disable=not-an-iterable
+        ]
+        try:
+            for i, rset in enumerate(self):  # pylint: disable=not-an-iterable
+                ok = await checked[i]
+                log.debug(
+                    "RuleTree.approve_request_async[%s]: set=%i res=%s",
+                    request.request_type,
+                    i,
+                    ok,
+                )
+                if not ok:
+                    continue
+                chosen[i].set_result(True)
+                if await tasks[i]:
+                    return id(rset)
+            return False
+        finally:
+            for i, task in enumerate(tasks):
+                if not chosen[i].done():
+                    chosen[i].set_result(False)
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def approve_requests(
+        self, requests: List[ApprovalRequest]
+    ) -> List[Union[bool, int]]:
+        """Return, for each request, the first approving ruleset id, otherwise False.
+
+        Each RuleSet evaluates the batch of requests not yet approved by earlier sets.
+        """
+        ret: List[Union[bool, int]] = [False] * len(requests)
+        pending = list(range(len(requests)))
+        for rset in self:  # pylint: disable=not-an-iterable
+            if not pending:
+                break
+            results = rset.approve_requests([requests[i] for i in pending])
+            rs_id = id(rset)
+            for i, res in zip(pending, results):
+                if res:
+                    ret[i] = rs_id
+            pending = [i for i, res in zip(pending, results) if not res]
+        return ret
+
     @classmethod
     def from_list(
-        cls, ruledefs: List[List[dict]], rgen: RuleIdGenerator, defaults=None
+        cls,
+        ruledefs: List[List[dict]],
+        rgen: Optional[RuleIdGenerator],
+        defaults=None,
+        reuse: Optional[RuleReuse] = None,
     ) -> "RuleTree":
+        """Build a RuleTree from a list of rulesets, see `RuleSet.from_list`.
+
+        If `reuse` holds a RuleTree of the same RuleSet instances, that tree is returned.
+        """
         ini = []
         for ent in ruledefs:
-            rset = RuleSet.from_list(ent, rgen, defaults)
+            rset = RuleSet.from_list(ent, rgen, defaults, reuse)
             ini.append(rset)
-        return RuleTree(ini)
+        prev = reuse.find_tree(ini) if reuse is not None else None
+        return prev if prev is not None else RuleTree(ini)
 
     def to_list(self) -> List[List[Dict]]:
         lst = []
@@ -337,13 +1013,93 @@ class RuleEngine:
     Given a request, will dispatch to the correct tree, and return the result.
 
     If no tree is available, will return None, so the caller can determine the default.
+
+    With a `tracer`, the engine is compiled, and approve_request records each
+    decision in the tracer's ring buffer, see `atakama.tracing`.  Without one, no
+    tracing code runs.  The other evaluation methods are not traced.
     """
 
-    def __init__(self, rule_map: Dict[RequestType, RuleTree]):
+    def __init__(
+        self,
+        rule_map: Dict[RequestType, RuleTree],
+        *,
+        quota_store: Optional[QuotaStore] = None,
+        tracer: Optional[DecisionTracer] = None,
+    ):
         self.map: Dict[RequestType, RuleTree] = rule_map
+        self.plan: Optional[EvaluationPlan] = None
+        self.tracer = tracer
+        self.quota_store: QuotaStore = quota_store or MemoryQuotaStore()
+        self.shared: Dict[str, Any] = {}
+        """State shared by the rules of the engine, see `RulePlugin.prepare`."""
+        for rule in self.rules():
+            if rule.quota_store is None:
+                rule.quota_store = self.quota_store
+            rule.prepare(self.shared)
+        self._rule_sets = self._index_rule_sets()
+        self._quotas = self._index_quotas()
+        if tracer is not None:
+            self.compile()
+
+    def _map_source(self) -> Tuple[int, Tuple[RuleTree, ...]]:
+        """What indexes of the rule map are built from, see `_RuleList`."""
+        return _RuleList.modifications, tuple(self.map.values())
+
+    def _is_current(self, source: Tuple[int, Tuple[RuleTree, ...]]) -> bool:
+        """True if the rule map was not modified since source was taken."""
+        modifications, trees = source
+        return (
+            modifications == _RuleList.modifications
+            and len(trees) == len(self.map)
+            and all(map(operator.is_, trees, self.map.values()))
+        )
+
+    def _index_rule_sets(
+        self,
+    ) -> Tuple[Tuple[int, Tuple[RuleTree, ...]], Dict[Union[int, str], RuleSet]]:
+        source = self._map_source()
+        index: Dict[Union[int, str], RuleSet] = {}
+        for tree in self.map.values():
+            for rset in tree:
+                index[id(rset)] = rset
+                index.setdefault(rset.stable_id, rset)
+        return source, index
+
+    def compile(
+        self,
+        *,
+        adaptive: bool = False,
+        metrics: Union[bool, EngineMetrics] = False,
+    ) -> EvaluationPlan:
+        """Flatten the rule map into an evaluation plan, used by subsequent requests.
+
+        The plan is a snapshot: call compile() again after modifying the rule map.
+
+        Adaptive plans sample rule latency and rejection rates, and reorder evaluation
+        to minimize expected cost, see `EvaluationPlan`.
+
+        With metrics, the plan counts and times evaluations, see `RuleEngine.metrics`.
+        Pass the EngineMetrics of a previous engine to keep counting after a reload.
+        """
+        if metrics is True:
+            metrics = EngineMetrics()
+        self._quotas = self._index_quotas()
+        self.plan = EvaluationPlan(
+            self.map, adaptive=adaptive, metrics=metrics or None, tracer=self.tracer
+        )
+        return self.plan
+
+    @property
+    def metrics(self) -> Optional[EngineMetrics]:
+        """Metrics collected by the compiled plan, if compiled with metrics."""
+        plan = self.plan
+        return plan.metrics if plan is not None else None
 
     def approve_request(self, request: ApprovalRequest) -> Optional[int]:
         """Returns the associated ruleset id, if any ruleset matches."""
+        plan = self.plan
+        if plan is not None:
+            return plan.approve_request(request)
         tree = self.map.get(request.request_type, None)
         if tree is None:
             log.debug(
@@ -352,28 +1108,175 @@ class RuleEngine:
             return None
         return tree.approve_request(request)
 
+    def explain(self, request: ApprovalRequest) -> Explanation:
+        """Evaluate the request as approve_request does, and return every step.
+
+        The explanation lists each ruleset tried, in evaluation order, with each rule's
+        result or exception, elapsed times, and the approving ruleset.  Quotas are not
+        used, so explaining a request doesn't change later decisions.  Each rule is
+        evaluated, even where approve_request would reuse the result of another set.
+
+        Evaluation goes through the compiled plan, with instrumented copies of its
+        ruleset functions, built on first use: requests not explained are unaffected.
+        Engines that are not compiled are explained with a temporary plan.
+        """
+        plan = self.plan
+        if plan is None:
+            plan = EvaluationPlan(self.map)
+        return plan.explain(request)
+
+    def approve_request_parallel(
+        self, request: ApprovalRequest, executor: Executor
+    ) -> Optional[int]:
+        """Same as approve_request, see `RuleTree.approve_request_parallel`."""
+        tree = self.map.get(request.request_type, None)
+        if tree is None:
+            log.debug(
+                "RuleEngine.approve_request_parallel: no tree for type %s",
+                request.request_type,
+            )
+            return None
+        return tree.approve_request_parallel(request, executor)
+
+    async def approve_request_async(
+        self, request: ApprovalRequest, executor: Optional[Executor] = None
+    ) -> Optional[int]:
+        """Async version of approve_request, see `RuleTree.approve_request_async`.
+
+        AsyncRulePlugin rules are awaited, synchronous rules are run in the executor
+        (default: the loop's default executor).
+        """
+        tree = self.map.get(request.request_type, None)
+        if tree is None:
+            log.debug(
+                "RuleEngine.approve_request_async: no tree for type %s",
+                request.request_type,
+            )
+            return None
+        return await tree.approve_request_async(request, executor)
+
+    def approve_requests(
+        self, requests: Iterable[ApprovalRequest]
+    ) -> List[Union[None, bool, int]]:
+        """Batch version of approve_request, returns one result per request, in order.
+
+        Requests are grouped by request type, and each tree evaluates its group in one
+        pass, see `RuleTree.approve_requests`.  Compiled engines evaluate each request
+        with their plan instead, to keep its shared results, ordering, metrics and
+        tracing.
+        """
+        plan = self.plan
+        if plan is not None:
+            return [plan.approve_request(request) for request in requests]
+        requests = list(requests)
+        ret: List[Union[None, bool, int]] = [None] * len(requests)
+        groups: Dict[RequestType, List[int]] = defaultdict(list)
+        for i, request in enumerate(requests):
+            groups[request.request_type].append(i)
+        for rtype, idxs in groups.items():
+            tree = self.map.get(rtype, None)
+            if tree is None:
+                log.debug("RuleEngine.approve_requests: no tree for type %s", rtype)
+                continue
+            for i, res in zip(idxs, tree.approve_requests([requests[i] for i in idxs])):
+                ret[i] = res
+        return ret
+
     @classmethod
     def from_yml_file(
-        cls, yml: Union["Path", str], *, defaults: Dict[str, Dict[str, Any]] = {}
+        cls,
+        yml: Union["Path", str],
+        *,
+        defaults: Dict[str, Dict[str, Any]] = {},
+        quota_store: Optional[QuotaStore] = None,
+        previous: Optional["RuleEngine"] = None,
+        cache_dir: Optional[Union["Path", str]] = None,
+        rgen: Optional[RuleIdGenerator] = None,
+        tracer: Optional[DecisionTracer] = None,
     ) -> "RuleEngine":
-        """Build a rule engine from a yml file, see `from_dict` for more info."""
+        """Build a rule engine from a yml file, see `from_dict` for more info.
+
+        Pass a "cache_dir" to keep the parsed policy, with rule ids injected, in a
+        `PolicyCache`: loading an unchanged file again skips yaml parsing and rule
+        id generation.
+
+        Pass "rgen" to generate rule ids with another `RuleIdGenerator` algorithm or
+        in a process pool.
+        """
         log.debug("from_yml_file loading %s", yml)
-        with open(yml, "r", encoding="utf8") as fh:
-            info: dict = yaml.safe_load(fh)
-            return cls.from_dict(info, defaults=defaults)
+        if cache_dir is None:
+            with open(yml, "r", encoding="utf8") as fh:
+                info: dict = yaml.load(fh, Loader=YamlLoader)
+            return cls.from_dict(
+                info,
+                defaults=defaults,
+                quota_store=quota_store,
+                previous=previous,
+                rgen=rgen,
+                tracer=tracer,
+            )
+
+        rgen = rgen or RuleIdGenerator()
+        cache = PolicyCache(cache_dir)
+        with open(yml, "rb") as fh:
+            data = fh.read()
+        key = cache.key(data, rgen.algorithm)
+        info = cache.load(yml, key)
+        if info is not None:
+            log.debug("from_yml_file cache hit %s", yml)
+            return cls.from_dict(
+                info,
+                defaults=defaults,
+                quota_store=quota_store,
+                previous=previous,
+                rgen=rgen,
+                tracer=tracer,
+            )
+
+        info = yaml.load(data.decode("utf8"), Loader=YamlLoader)
+        if isinstance(info, dict):
+            rgen.inject_policy(info)
+        # from_dict consumes the policy, and only valid policies are cached
+        payload = cache.dumps(info)
+        engine = cls.from_dict(
+            info,
+            defaults=defaults,
+            quota_store=quota_store,
+            previous=previous,
+            tracer=tracer,
+        )
+        if payload is not None:
+            cache.store(yml, key, payload)
+        return engine
 
     @classmethod
     def from_dict(
         cls,
         info: Dict[str, Union[Dict[str, Any], List[List[dict]]]],
         *,
-        defaults: Dict[str, Dict[str, Any]] = {}
+        defaults: Dict[str, Dict[str, Any]] = {},
+        quota_store: Optional[QuotaStore] = None,
+        previous: Optional["RuleEngine"] = None,
+        rgen: Optional[RuleIdGenerator] = None,
+        tracer: Optional[DecisionTracer] = None,
     ) -> "RuleEngine":
         """Build a rule engine from a dictionary:
 
         Pass a "defaults" dictionary which is used to set per-rule default values, if
         not present in the config.
 
+        Pass a "quota_store" to share quota counters among engines, or processes.
+
+        Pass the "previous" engine when reloading a policy: rules, rulesets and trees
+        whose configuration is unchanged are reused rather than constructed again,
+        see `RuleReuse`.  Quota state of reused rules is kept as is, and the new engine
+        uses the quota store of the previous one, unless another "quota_store" is
+        passed: rules are then not reused, they would keep counting in the old store.
+
+        Pass a "rgen" to choose how rule ids are generated, see `RuleIdGenerator`.
+
+        Pass a "tracer" to record decisions, see `RuleEngine`.
+
         Example:
         ```
         request_type:
@@ -385,28 +1288,104 @@ class RuleEngine:
               param: val1
         ```
         """
-        rgen = RuleIdGenerator()
+        rgen = rgen or RuleIdGenerator()
+        rgen.inject_policy(info)
+        reuse = None
+        if previous is not None:
+            if quota_store is None:
+                quota_store = previous.quota_store
+            if quota_store is previous.quota_store:
+                reuse = RuleReuse(previous)
         rule_map = {}
         for rtype, treedef in info.items():
             rtype = RequestType(rtype)
-            tree = RuleTree.from_list(treedef, rgen, defaults)
+            # rule ids were injected above, all at once
+            tree = RuleTree.from_list(treedef, None, defaults, reuse)
             rule_map[rtype] = tree
-        return cls(rule_map)
+        if reuse is not None:
+            log.debug("from_dict reused %i rules", reuse.reused)
+        return cls(rule_map, quota_store=quota_store, tracer=tracer)
+
+    def rules(self) -> Iterable[RulePlugin]:
+        """Iterate over unique rule instances."""
+        seen = set()
+        for tree in self.map.values():
+            for rset in tree:
+                for rule in rset:
+                    if id(rule) not in seen:
+                        seen.add(id(rule))
+                        yield rule
+
+    def import_quota(self, old: "RuleEngine") -> int:
+        """Carry quota state over from old rules with the same rule_id and type.
+
+        Returns the number of rules that received state.
+        """
+        old_rules = {rule.rule_id: rule for rule in old.rules()}
+        count = 0
+        for rule in self.rules():
+            prev = old_rules.get(rule.rule_id)
+            if prev is None or prev is rule or type(prev) is not type(rule):
+                continue
+            state = prev.export_quota()
+            if state is not None:
+                rule.import_quota(state)
+                count += 1
+        return count
+
+    def _index_quotas(self) -> QuotaRegistry:
+        source = self._map_source()
+        quotas = QuotaRegistry(self.rules())
+        quotas.source = source
+        return quotas
+
+    def _quota_registry(self) -> QuotaRegistry:
+        """The QuotaRegistry, indexed again if the rule map was modified since."""
+        if not self._is_current(self._quotas.source):
+            self._quotas = self._index_quotas()
+        return self._quotas
 
     def clear_quota(self, profile: ProfileInfo):
-        for rt in self.map.values():
-            for rs in rt:
-                for rule in rs:
-                    rule.clear_quota(profile)
+        """Clear the quota state of the profile, in each rule implementing quotas.
+
+        Rules are indexed once, and indexed again after the rule map is modified.
+        """
+        self._quota_registry().clear_quota(profile)
 
     def at_quota(self, profile: ProfileInfo) -> bool:
-        seen = set()
-        for tree in self.map.values():
-            if not id(tree) in seen:
-                if tree.at_quota(profile):
-                    return True
-                seen.add(id(tree))
-        return False
+        """Returns True if the profile is at quota for any rule, see clear_quota()."""
+        return self._quota_registry().at_quota(profile)
+
+    @property
+    def quota_rules(self) -> Tuple[RulePlugin, ...]:
+        """The unique rules implementing quota methods, see clear_quota()."""
+        return self._quota_registry().rules
+
+    def quota_index(self) -> Dict[bytes, Tuple[RulePlugin, ...]]:
+        """Map each profile_id with quota state to the rules holding that state.
+
+        Built from the `quota_store` counters of the engine's rules, and from
+        `RulePlugin.quota_profiles`, in time proportional to the stateful entries.
+        """
+        return self._quota_registry().index(self.quota_store)
+
+    def quota_report(
+        self, profiles: Optional[Iterable[ProfileInfo]] = None
+    ) -> Dict[bytes, List[str]]:
+        """Map each profile_id to the rule_ids at quota for the profile, in bulk.
+
+        Each rule implementing at_quota is called once, via `RulePlugin.at_quota_many`,
+        with all the profiles.  Without `profiles`, the profiles of the quota_index()
+        are reported, and each rule only checks those it holds state for: profiles
+        whose state can't be listed are not reported, see `RulePlugin.quota_profiles`.
+
+        Errors are logged, and the rule is then not at quota for the profile.
+        """
+        return self._quota_registry().report(profiles, self.quota_store)
+
+    def profiles_at_quota(self) -> List[bytes]:
+        """Ids of the profiles at quota for any rule, see quota_report()."""
+        return [pid for pid, rule_ids in self.quota_report().items() if rule_ids]
 
     def to_dict(self) -> Dict[str, List[List[Dict]]]:
         dct = {}
@@ -414,14 +1393,18 @@ class RuleEngine:
             dct[req.value] = ent.to_list()
         return dct
 
-    def get_rule_set(self, rs_id: int) -> RuleSet:
-        """Given a ruleset id, return the associated RuleSet.
+    def get_rule_set(self, rs_id: Union[int, str]) -> RuleSet:
+        """Given a ruleset id, or a `RuleSet.stable_id`, return the associated RuleSet.
 
         Raises IndexError if not found.
         """
-        for tree in self.map.values():
-            for rset in tree:
-                if id(rset) == rs_id:
-                    return rset
-
-        raise IndexError("invalid ruleset id")
+        source, index = self._rule_sets
+        if not self._is_current(source):
+            # the rule map was modified since: replaced at once, lookups never see
+            # a partial index
+            self._rule_sets = self._index_rule_sets()
+            index = self._rule_sets[1]
+        rset = index.get(rs_id)
+        if rset is None:
+            raise IndexError("invalid ruleset id")
+        return rset
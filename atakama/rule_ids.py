@@ -0,0 +1,168 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Rule ids, derived from the configuration of each rule, and rule reuse by id."""
+
+import hashlib
+import json
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from atakama.rule_engine import RuleEngine, RulePlugin, RuleSet, RuleTree
+
+# one encoder for all entries, json.dumps builds a new one per call with these options
+_canonical = json.JSONEncoder(sort_keys=True, separators=(",", ":")).encode
+
+RULE_ID_HASHES: Dict[str, Callable[[bytes], Any]] = {
+    "md5": hashlib.md5,
+    "blake2b": lambda data: hashlib.blake2b(data, digest_size=16),
+}
+"""Rule id hash algorithms, md5 ids are compatible with stored quota state."""
+
+
+def _hash_entries(algorithm: str, entries: List[Any]) -> List[str]:
+    new = RULE_ID_HASHES[algorithm]
+    return [new(_canonical(ent).encode("utf8")).hexdigest() for ent in entries]
+
+
+class RuleIdGenerator:
+    """Manage unique rule id generation.
+
+    The default "md5" algorithm produces the same ids as previous releases, "blake2b"
+    is faster.  Pass an executor, typically a ProcessPoolExecutor, to hash the entries
+    of large policies in parallel in inject_policy().
+    """
+
+    __autodoc__ = False
+
+    def __init__(
+        self,
+        algorithm: str = "md5",
+        executor: Optional[Executor] = None,
+        chunk_size: int = 2048,
+    ):
+        assert algorithm in RULE_ID_HASHES, "unknown rule id algorithm: " + algorithm
+        self.algorithm = algorithm
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self._seen: Dict[str, int] = {}
+
+    @staticmethod
+    def content_hash(ent: Any) -> str:
+        """Hash of the json-serializable entry, independent of key order."""
+        return hashlib.md5(_canonical(ent).encode("utf8")).hexdigest()
+
+    def hash_many(self, entries: List[Any]) -> List[str]:
+        """Content hashes of the entries, computed in the executor if there is one."""
+        if self.executor is None or len(entries) <= self.chunk_size:
+            return _hash_entries(self.algorithm, entries)
+        chunks = [
+            entries[i : i + self.chunk_size]
+            for i in range(0, len(entries), self.chunk_size)
+        ]
+        futures = [
+            self.executor.submit(_hash_entries, self.algorithm, chunk)
+            for chunk in chunks
+        ]
+        return [ent_hash for fut in futures for ent_hash in fut.result()]
+
+    def _unique(self, ent_hash: str) -> str:
+        seen = self._seen
+        # if the hash is enough, use it, that way it's relocatable and still consistent
+        if ent_hash in seen:
+            seen[ent_hash] += 1
+            # otherwise append a sequence
+            ent_hash += "." + str(seen[ent_hash])
+        seen[ent_hash] = seen.get(ent_hash, 0) + 1
+        return ent_hash
+
+    def generate(self, ent: Any) -> str:
+        return self._unique(_hash_entries(self.algorithm, [ent])[0])
+
+    def inject_rule_id(self, ent: dict):
+        """
+        Modify the supplied dictionary to add a rule_id, but only if a rule_id is not present.
+
+        Keeps track of rule id's and ensures uniqueness, while trying to maintain consistency.
+        """
+
+        rule_id = ent.get("rule_id")
+        if not rule_id:
+            ent_hash = self.generate(ent)
+            ent["rule_id"] = ent_hash
+        else:
+            self._seen[rule_id] = self._seen.get(rule_id, 0) + 1
+
+    def inject_policy(self, info: dict):
+        """Inject rule ids into all entries of a policy, in `RuleEngine.from_dict` order.
+
+        Same result as calling inject_rule_id() on each entry, but all entries are
+        hashed in one batch.  Entries that are not well-formed are left for from_dict
+        to report.
+        """
+        entries = []
+        for treedef in info.values():
+            if not isinstance(treedef, list):
+                continue
+            for ruledata in treedef:
+                if not isinstance(ruledata, list):
+                    continue
+                entries.extend(ent for ent in ruledata if isinstance(ent, dict))
+        missing = [ent for ent in entries if not ent.get("rule_id")]
+        hashes = iter(self.hash_many(missing) if missing else ())
+        seen = self._seen
+        for ent in entries:
+            rule_id = ent.get("rule_id")
+            if not rule_id:
+                ent["rule_id"] = self._unique(next(hashes))
+            else:
+                seen[rule_id] = seen.get(rule_id, 0) + 1
+
+
+class RuleReuse:
+    """Instances of a live engine, reused when building its replacement.
+
+    Rules are reused when their name and arguments, including defaults and rule_id,
+    are unchanged.  Rulesets and trees are reused when they hold the same instances
+    in the same order, so that their ids, locks and evaluation order are kept.
+    """
+
+    __autodoc__ = False
+
+    def __init__(self, engine: "RuleEngine"):
+        self.rules: Dict[str, "RulePlugin"] = {}
+        self.sets: Dict[Tuple[int, ...], "RuleSet"] = {}
+        self.trees: Dict[Tuple[int, ...], "RuleTree"] = {}
+        self.reused = 0
+        for rule in engine.rules():
+            key = rule.reuse_key()
+            if key is not None:
+                self.rules[key] = rule
+        for tree in engine.map.values():
+            self.trees[tuple(map(id, tree))] = tree
+            for rset in tree:
+                self.sets[tuple(map(id, rset))] = rset
+
+    @staticmethod
+    def config_key(name: str, args: Any) -> Optional[str]:
+        try:
+            return RuleIdGenerator.content_hash({"rule": name, "args": args})
+        except (TypeError, ValueError):
+            return None
+
+    def find_rule(self, name: str, args: dict) -> Optional["RulePlugin"]:
+        key = self.config_key(name, args)
+        rule = self.rules.get(key) if key is not None else None
+        if rule is not None:
+            self.reused += 1
+        return rule
+
+    def find_set(self, rules: List["RulePlugin"]) -> Optional["RuleSet"]:
+        return self.sets.get(tuple(map(id, rules)))
+
+    def find_tree(self, rsets: List["RuleSet"]) -> Optional["RuleTree"]:
+        return self.trees.get(tuple(map(id, rsets)))
+
+
+__all__ = ["RuleIdGenerator", "RuleReuse", "RULE_ID_HASHES"]
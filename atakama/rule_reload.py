@@ -0,0 +1,181 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Policy file hot reload for key servers."""
+
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Union, Tuple, TYPE_CHECKING
+
+from atakama.rule_engine import RuleEngine, RuleSet, ApprovalRequest, ProfileInfo
+from atakama.decision_cache import DecisionCache
+from atakama.metrics import EngineMetrics
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+class _Watch:
+    """Policy file watch state of a RuleEngineHolder."""
+
+    __autodoc__ = False
+    __slots__ = ("interval", "stat", "stop", "thread")
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # mtime and size of the policy file when last loaded
+        self.stat: Optional[Tuple[int, int]] = None
+        self.stop = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+
+class RuleEngineHolder:
+    """Holds the current RuleEngine for a policy file, and replaces it on change.
+
+    New engines are built and compiled off to the side, reusing unchanged rules of
+    the current engine (see `RuleEngine.from_dict`) and sharing its quota store.
+    Rules that are replaced receive the quota state of their predecessors (see
+    `RuleEngine.import_quota`), then the new engine replaces the current one with a
+    single reference assignment.  Requests never wait for a reload, and requests in
+    flight finish on the engine they started on.  If the new policy fails to load,
+    the current engine is kept.
+
+    Call start() to watch the file from a background thread, or reload() directly.
+
+    With a "cache_size", decisions are served from a `DecisionCache`, which is reset
+    on every reload.  With "metrics", engines are compiled with one `EngineMetrics`,
+    that keeps counting across reloads.
+    """
+
+    def __init__(
+        self,
+        path: Union["Path", str],
+        *,
+        defaults: Optional[Dict[str, Dict[str, Any]]] = None,
+        compile: bool = False,  # pylint: disable=redefined-builtin
+        poll_interval: float = 2.0,
+        cache_size: int = 0,
+        cache_ttl: float = 5.0,
+        metrics: bool = False,
+    ):
+        self.path = path
+        self.defaults = {} if defaults is None else defaults
+        self.compile = compile
+        self.metrics: Optional[EngineMetrics] = EngineMetrics() if metrics else None
+        self._reload_lock = threading.Lock()
+        self._watcher = _Watch(poll_interval)
+        self._watcher.stat = self._file_stat()
+        # the current engine, and the one it replaced, swapped together
+        self._engines: Tuple[RuleEngine, Optional[RuleEngine]] = (
+            self._build(None),
+            None,
+        )
+        self.cache: Optional[DecisionCache] = None
+        if cache_size:
+            self.cache = DecisionCache(self.engine, cache_size, cache_ttl)
+        self.generation = 0
+        """Incremented each time the engine is replaced."""
+
+    @property
+    def engine(self) -> RuleEngine:
+        """The current engine."""
+        return self._engines[0]
+
+    def _file_stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def _build(self, old: Optional[RuleEngine]) -> RuleEngine:
+        engine = RuleEngine.from_yml_file(
+            self.path,
+            defaults=self.defaults,
+            quota_store=old.quota_store if old else None,
+            previous=old,
+        )
+        if self.compile or self.metrics is not None:
+            engine.compile(metrics=self.metrics or False)
+        return engine
+
+    def reload(self) -> bool:
+        """Rebuild the engine from the policy file, return False if it failed to load."""
+        with self._reload_lock:
+            self._watcher.stat = self._file_stat()
+            old = self.engine
+            try:
+                new = self._build(old)
+            except Exception as ex:
+                log.error("policy reload failed, keeping current rules: %s", repr(ex))
+                return False
+            carried = new.import_quota(old)
+            self._engines = (new, old)
+            if self.cache is not None:
+                self.cache.reset(new)
+            self.generation += 1
+            log.info("policy reloaded, quota state carried for %i rules", carried)
+            return True
+
+    def check(self) -> bool:
+        """Reload if the policy file changed since the last load, return True if so."""
+        if self._file_stat() == self._watcher.stat:
+            return False
+        return self.reload()
+
+    def _watch(self):
+        watcher = self._watcher
+        while not watcher.stop.wait(watcher.interval):
+            try:
+                self.check()
+            except Exception as ex:  # pragma: no cover
+                log.error("policy watch error: %s", repr(ex))
+
+    def start(self):
+        """Start watching the policy file in a daemon thread."""
+        watcher = self._watcher
+        assert watcher.thread is None, "already started"
+        watcher.stop.clear()
+        watcher.thread = threading.Thread(
+            target=self._watch, name="policy-watch", daemon=True
+        )
+        watcher.thread.start()
+
+    def stop(self):
+        watcher = self._watcher
+        if watcher.thread is not None:
+            watcher.stop.set()
+            watcher.thread.join()
+            watcher.thread = None
+
+    def approve_request(self, request: ApprovalRequest) -> Optional[int]:
+        """Same as `RuleEngine.approve_request`, on the current engine."""
+        if self.cache is not None:
+            return self.cache.approve_request(request)
+        return self.engine.approve_request(request)
+
+    def get_rule_set(self, rs_id: Union[int, str]) -> RuleSet:
+        """Same as `RuleEngine.get_rule_set`, also finds rulesets of the engine replaced
+        by the last reload, for requests approved while it was current."""
+        engine, previous = self._engines
+        try:
+            return engine.get_rule_set(rs_id)
+        except IndexError:
+            if previous is None:
+                raise
+            return previous.get_rule_set(rs_id)
+
+    def at_quota(self, profile: ProfileInfo) -> bool:
+        return self.engine.at_quota(profile)
+
+    def clear_quota(self, profile: ProfileInfo):
+        if self.cache is not None:
+            self.cache.clear_quota(profile)
+        else:
+            self.engine.clear_quota(profile)
+
+
+__all__ = ["RuleEngineHolder"]
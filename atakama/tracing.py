@@ -0,0 +1,181 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Decision tracing: structured records of recent decisions, kept in a ring buffer.
+
+Tracing is chosen when the engine is built, see `RuleEngine`: engines without a
+tracer evaluate exactly as before, engines with one record every decision of
+approve_request, with the result of each rule evaluated, rather than logging them.
+
+For a single request, `RuleEngine.explain` returns a detailed `Explanation`.
+"""
+
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from atakama.rule_engine import ApprovalRequest, RulePlugin, RuleSet
+
+CACHED = "cached"
+"""rule_id of the only step of decisions served by a `DecisionCache`."""
+
+
+@dataclass(frozen=True)
+class DecisionTrace:
+    """One engine decision."""
+
+    time: float
+    request_type: str
+    profile_id: bytes
+    device_id: bytes
+    result: Any
+    """As returned by approve_request: ruleset id, False or None."""
+    ruleset: Optional[str]
+    """Stable id of the approving ruleset, if any."""
+    steps: Tuple[Tuple[str, str, Any], ...]
+    """(ruleset stable id, rule_id, result) of each rule evaluated, in order.
+
+    Rules whose result was reused from another ruleset are not repeated, and rules
+    that raised have the result "error".  Decisions served by a `DecisionCache` have
+    a single step, with the rule_id CACHED.
+    """
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class DecisionTracer:
+    """Ring buffer of the last `size` decisions of an engine.
+
+    A tracer can be shared by successive engines, such as reloads of the same policy.
+    """
+
+    def __init__(self, size: int = 1024, clock: Callable[[], float] = time.time):
+        self._traces: Deque[DecisionTrace] = deque(maxlen=size)
+        self._local = threading.local()
+        self._clock = clock
+
+    def __len__(self):
+        return len(self._traces)
+
+    def wrap_rule(
+        self, rset: "RuleSet", rule: "RulePlugin", approver: Callable
+    ) -> Callable:
+        """Return approver, recording its results in the current trace."""
+        step = (rset.stable_id, rule.rule_id)
+        local = self._local
+
+        def traced(request):
+            try:
+                res = approver(request)
+            except Exception:
+                local.steps.append(step + ("error",))
+                raise
+            local.steps.append(step + (res,))
+            return res
+
+        return traced
+
+    def trace(
+        self,
+        request: "ApprovalRequest",
+        approve: Callable[["ApprovalRequest"], Any],
+        rulesets: Dict[int, str],
+    ) -> Any:
+        """Call approve(request), record the decision, and return it.
+
+        `rulesets` maps the ids returned by approve to ruleset stable ids.
+        """
+        steps: List[Tuple[str, str, Any]] = []
+        self._local.steps = steps
+        result = approve(request)
+        self._record(request, result, rulesets.get(result) if result else None, steps)
+        return result
+
+    def trace_cached(
+        self, request: "ApprovalRequest", result: Any, ruleset: Optional[str]
+    ):
+        """Record a decision served from a cache, `ruleset` is its stable id."""
+        self._record(request, result, ruleset, [(ruleset or "", CACHED, result)])
+
+    def _record(
+        self,
+        request: "ApprovalRequest",
+        result: Any,
+        ruleset: Optional[str],
+        steps: List[Tuple[str, str, Any]],
+    ):
+        self._traces.append(
+            DecisionTrace(
+                time=self._clock(),
+                request_type=request.request_type.value,
+                profile_id=request.profile.profile_id,
+                device_id=request.device_id,
+                result=result,
+                ruleset=ruleset,
+                steps=tuple(steps),
+            )
+        )
+
+    def dump(self, profile_id: Optional[bytes] = None) -> List[DecisionTrace]:
+        """Recorded decisions, oldest first, optionally only those of one profile."""
+        traces = list(self._traces)
+        if profile_id is None:
+            return traces
+        return [trace for trace in traces if trace.profile_id == profile_id]
+
+    def clear(self):
+        self._traces.clear()
+
+
+@dataclass(frozen=True)
+class RuleResult:
+    """Evaluation of one rule."""
+
+    rule_id: str
+    result: Any
+    """As returned by approve_request, None if it raised."""
+    error: Optional[str]
+    """Repr of the exception raised, if any."""
+    elapsed: float
+
+
+@dataclass(frozen=True)
+class RulesetResult:
+    """Evaluation of one ruleset, stopping at the first rule that did not approve."""
+
+    ruleset: str
+    """Stable id of the ruleset."""
+    approved: bool
+    elapsed: float
+    rules: Tuple[RuleResult, ...]
+
+
+@dataclass(frozen=True)
+class Explanation:
+    """Evaluation path of a request, see `RuleEngine.explain`."""
+
+    request_type: str
+    result: Union[None, bool, int]
+    """As approve_request would return, quotas permitting."""
+    ruleset: Optional[str]
+    """Stable id of the approving ruleset, if any."""
+    rulesets: Tuple[RulesetResult, ...]
+    """Rulesets tried, in evaluation order."""
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+__all__ = [
+    "CACHED",
+    "DecisionTrace",
+    "DecisionTracer",
+    "RuleResult",
+    "RulesetResult",
+    "Explanation",
+]
@@ -0,0 +1,274 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Evaluate requests in forked worker processes, sharing one built RuleEngine.
+
+Rule evaluation holds the GIL, so one process approves on at most one core.  A
+`WorkerPool` forks workers after the policy is loaded: they share the engine's
+memory copy-on-write, rather than each parsing the policy and building its rules.
+Requests are sent over pipes, marshalled as plain tuples.
+"""
+
+import gc
+import itertools
+import logging
+import marshal
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from atakama.rule_engine import RuleEngine, RuleSet, ApprovalRequest, RequestType
+from atakama.rule_engine import ProfileInfo, MetaInfo
+
+log = logging.getLogger(__name__)
+
+_REQUEST_TYPES = tuple(RequestType)
+_TYPE_INDEX = {rtype: i for i, rtype in enumerate(_REQUEST_TYPES)}
+
+
+def encode_request(request: ApprovalRequest) -> tuple:
+    """Plain tuple of the request's members, for marshal."""
+    profile = request.profile
+    return (
+        _TYPE_INDEX[request.request_type],
+        request.device_id,
+        profile.profile_id,
+        tuple(profile.profile_words),
+        tuple((meta.meta, meta.complete) for meta in request.auth_meta),
+        request.cryptographic_id,
+    )
+
+
+def decode_request(data: tuple) -> ApprovalRequest:
+    rtype, device_id, profile_id, words, auth_meta, cryptographic_id = data
+    return ApprovalRequest(
+        request_type=_REQUEST_TYPES[rtype],
+        device_id=device_id,
+        profile=ProfileInfo(profile_id, list(words)),
+        auth_meta=[MetaInfo(meta, complete) for meta, complete in auth_meta],
+        cryptographic_id=cryptographic_id,
+    )
+
+
+def _serve(engine: RuleEngine, conn, inherited: List) -> None:
+    """Worker main loop: evaluate batches of requests until told to stop."""
+    for other in inherited:
+        # the parent's ends of the pipes
+        other.close()
+    engine.quota_store.after_fork()
+    approve = engine.approve_request
+    while True:
+        try:
+            msg = marshal.loads(conn.recv_bytes())
+        except EOFError:
+            break
+        if msg is None:
+            break
+        batch_id, requests = msg
+        try:
+            results = [approve(decode_request(req)) for req in requests]
+            reply = (batch_id, results, None)
+        except Exception as ex:
+            reply = (batch_id, None, repr(ex))
+        conn.send_bytes(marshal.dumps(reply))
+
+
+class _Worker:
+    __slots__ = ("process", "conn", "send_lock", "pending", "reader", "alive")
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.pending: Dict[int, Future] = {}
+        self.reader: Optional[threading.Thread] = None
+        self.alive = True
+
+
+class WorkerPool:
+    """Front end dispatching requests to `workers` forked copies of an engine.
+
+    Build the engine, then the pool: workers are forked from the calling process, so
+    create the pool before starting other threads.  Requires the fork start method,
+    available on Linux and macOS.
+
+    Quota counters are coordinated through the engine's `quota_store`, which must be
+    shared across processes (`QuotaStore.shared`, for example `MmapQuotaStore`) if
+    any rule implements quotas.  Rules with quotas must keep them in the store, and
+    say so with `RulePlugin.stores_quota`: others, such as
+    `atakama.rate_limit.RateLimitRule`, would count separately in each worker.
+
+    approve_request() is thread safe, and requests from concurrent callers are
+    evaluated in parallel.  approve_requests() splits a batch among the workers,
+    with one message per worker.  Results are the same as the engine's: the ids of
+    rulesets are valid in this process, see get_rule_set().
+    """
+
+    def __init__(self, engine: RuleEngine, workers: Optional[int] = None):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise RuntimeError("WorkerPool requires the fork start method")
+        local = {rule.name() for rule in engine.quota_rules if not rule.stores_quota}
+        if local:
+            raise ValueError(
+                f"rules keep quotas in process memory: {', '.join(sorted(local))}"
+            )
+        if engine.quota_rules and not engine.quota_store.shared:
+            raise ValueError(
+                "rules use quotas, and the quota store is not shared across processes"
+            )
+        self.engine = engine
+        self._batch_ids = itertools.count()
+        self._next = itertools.count()
+        self._closed = False
+        ctx = multiprocessing.get_context("fork")
+        count = workers or os.cpu_count() or 1
+
+        # objects allocated so far, such as the engine, are never collected: the gc
+        # would otherwise touch, and copy, every page of them in every worker
+        gc.freeze()
+        self._workers: List[_Worker] = []
+        try:
+            for _ in range(count):
+                parent_conn, child_conn = ctx.Pipe()
+                inherited = [parent_conn] + [w.conn for w in self._workers]
+                process = ctx.Process(
+                    target=_serve, args=(engine, child_conn, inherited), daemon=True
+                )
+                process.start()
+                child_conn.close()
+                self._workers.append(_Worker(process, parent_conn))
+        finally:
+            gc.unfreeze()
+
+        for i, worker in enumerate(self._workers):
+            worker.reader = threading.Thread(
+                target=self._read,
+                args=(worker,),
+                name=f"atakama-pool-{i}",
+                daemon=True,
+            )
+            worker.reader.start()
+
+    def __len__(self):
+        return len(self._workers)
+
+    def _read(self, worker: _Worker):
+        """Resolve the futures of a worker's replies, fail them if it exits."""
+        while True:
+            try:
+                batch_id, results, error = marshal.loads(worker.conn.recv_bytes())
+            except (EOFError, OSError):
+                break
+            fut = worker.pending.pop(batch_id)
+            if error is None:
+                fut.set_result(results)
+            else:
+                fut.set_exception(RuntimeError("worker error: " + error))
+        worker.alive = False
+        for batch_id in list(worker.pending):
+            fut = worker.pending.pop(batch_id, None)
+            if fut is not None:
+                fut.set_exception(RuntimeError("worker exited"))
+        if not self._closed:
+            log.error("pool worker %s exited", worker.process.pid)
+
+    def _alive(self) -> List[_Worker]:
+        if self._closed:
+            raise RuntimeError("pool is closed")
+        workers = [worker for worker in self._workers if worker.alive]
+        if not workers:
+            raise RuntimeError("all pool workers exited")
+        return workers
+
+    def _submit(self, worker: _Worker, requests: List[tuple]) -> Future:
+        fut: Future = Future()
+        batch_id = next(self._batch_ids)
+        # registered first, the reply may be read before send_bytes() returns
+        worker.pending[batch_id] = fut
+        try:
+            with worker.send_lock:
+                worker.conn.send_bytes(marshal.dumps((batch_id, requests)))
+        except BaseException:
+            # not sent, no reply will resolve it
+            worker.pending.pop(batch_id, None)
+            raise
+        return fut
+
+    def approve_request(
+        self, request: ApprovalRequest, timeout: Optional[float] = None
+    ) -> Union[None, bool, int]:
+        """Same as `RuleEngine.approve_request`, evaluated by the next worker.
+
+        Raises `concurrent.futures.TimeoutError` if the worker has not answered
+        within `timeout` seconds.
+        """
+        workers = self._alive()
+        worker = workers[next(self._next) % len(workers)]
+        return self._submit(worker, [encode_request(request)]).result(timeout)[0]
+
+    def approve_requests(
+        self, requests: Iterable[ApprovalRequest], timeout: Optional[float] = None
+    ) -> List[Union[None, bool, int]]:
+        """Approve each request, in order, as approve_request() would.
+
+        The batch is split in contiguous chunks, one per live worker.  Raises
+        `concurrent.futures.TimeoutError` if the whole batch is not answered within
+        `timeout` seconds.
+        """
+        encoded = [encode_request(request) for request in requests]
+        if not encoded:
+            return []
+        workers = self._alive()
+        size = -(-len(encoded) // len(workers))
+        futures = [
+            self._submit(workers[i // size], encoded[i : i + size])
+            for i in range(0, len(encoded), size)
+        ]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ret: List[Union[None, bool, int]] = []
+        for fut in futures:
+            if deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+            ret.extend(fut.result(timeout))
+        return ret
+
+    def get_rule_set(self, rs_id: Union[int, str]) -> RuleSet:
+        """Same as `RuleEngine.get_rule_set`, for the ids returned by workers."""
+        return self.engine.get_rule_set(rs_id)
+
+    def at_quota(self, profile: ProfileInfo) -> bool:
+        """Same as `RuleEngine.at_quota`, from the shared quota store."""
+        return self.engine.at_quota(profile)
+
+    def clear_quota(self, profile: ProfileInfo):
+        """Same as `RuleEngine.clear_quota`, in the shared quota store."""
+        self.engine.clear_quota(profile)
+
+    def close(self, timeout: Optional[float] = 5.0):
+        """Stop the workers, after they answer the requests already sent."""
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            if worker.alive:
+                with worker.send_lock:
+                    worker.conn.send_bytes(marshal.dumps(None))
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+                worker.process.join()
+            worker.reader.join()
+            worker.conn.close()
+
+    def __enter__(self) -> "WorkerPool":
+        return self
+
+    def __exit__(self, *exc: Any):
+        self.close()
+
+
+__all__ = ["WorkerPool", "encode_request", "decode_request"]
@@ -0,0 +1,4 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Rule engine benchmarks, run with `python -m bench.<name>`."""
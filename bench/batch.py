@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Large search: one approve_request per file vs RuleEngine.approve_requests.
+
+    python -m bench.batch --files 5000 --rulesets 20
+"""
+
+import argparse
+import time
+
+from atakama import RulePlugin, RuleEngine, ApprovalRequest, ProfileInfo, RequestType
+from atakama import MetaInfo
+
+
+class PrefixRule(RulePlugin):
+    """Approves paths under a prefix, vectorized for batches."""
+
+    @staticmethod
+    def name():
+        return "bench-prefix"
+
+    def approve_request(self, request):
+        return request.auth_meta[0].meta.startswith(self.args["prefix"])
+
+    def approve_requests(self, requests):
+        prefix = self.args["prefix"]
+        return [r.auth_meta[0].meta.startswith(prefix) for r in requests]
+
+
+def make_policy(rulesets):
+    return {
+        RequestType.SEARCH.value: [
+            [{"rule": "bench-prefix", "prefix": "/share%i/" % i}]
+            for i in range(rulesets)
+        ]
+    }
+
+
+def make_requests(files, rulesets):
+    profile = ProfileInfo(b"pid", ["w"] * 8)
+    return [
+        ApprovalRequest(
+            request_type=RequestType.SEARCH,
+            device_id=b"did",
+            profile=profile,
+            auth_meta=[MetaInfo("/share%i/file%i" % (i % rulesets, i), True)],
+            cryptographic_id=b"cid%i" % i,
+        )
+        for i in range(files)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--rulesets", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    engine = RuleEngine.from_dict(make_policy(args.rulesets))
+    requests = make_requests(args.files, args.rulesets)
+
+    start = time.perf_counter()
+    single = [engine.approve_request(r) for r in requests]
+    one = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = engine.approve_requests(requests)
+    many = time.perf_counter() - start
+
+    assert single == batch
+    print(f"per request: {one / args.files * 1e6:8.2f} us/file")
+    print(f"batched:     {many / args.files * 1e6:8.2f} us/file ({one / many:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
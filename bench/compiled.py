@@ -0,0 +1,76 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Per-request latency of RuleEngine.approve_request, walked vs compiled.
+
+    python -m bench.compiled --rulesets 300 --rules 3
+"""
+
+import argparse
+import time
+
+from atakama import RulePlugin, RuleEngine, ApprovalRequest, ProfileInfo, RequestType
+from atakama import MetaInfo
+
+
+class DeviceRule(RulePlugin):
+    """Cheap rule, approves a single device."""
+
+    @staticmethod
+    def name():
+        return "bench-device"
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.device_id = args["device"].encode()
+
+    def approve_request(self, request):
+        return request.device_id == self.device_id
+
+
+def make_policy(rulesets, rules):
+    return {
+        RequestType.DECRYPT.value: [
+            [{"rule": "bench-device", "device": "dev%i" % i} for _ in range(rules)]
+            for i in range(rulesets)
+        ]
+    }
+
+
+def timeit(engine, request, count):
+    approve = engine.approve_request
+    start = time.perf_counter()
+    for _ in range(count):
+        approve(request)
+    return (time.perf_counter() - start) / count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rulesets", type=int, default=300)
+    parser.add_argument("--rules", type=int, default=3)
+    parser.add_argument("--count", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    walked = RuleEngine.from_dict(make_policy(args.rulesets, args.rules))
+    compiled = RuleEngine.from_dict(make_policy(args.rulesets, args.rules))
+    compiled.compile()
+
+    # worst case: the last ruleset is the winner
+    request = ApprovalRequest(
+        request_type=RequestType.DECRYPT,
+        device_id=b"dev%i" % (args.rulesets - 1),
+        profile=ProfileInfo(b"pid", ["w"] * 8),
+        auth_meta=[MetaInfo("/meta", True)],
+        cryptographic_id=b"cid",
+    )
+    assert walked.approve_request(request) and compiled.approve_request(request)
+
+    slow = timeit(walked, request, args.count)
+    fast = timeit(compiled, request, args.count)
+    print(f"walked:   {slow * 1e6:10.1f} us/request")
+    print(f"compiled: {fast * 1e6:10.1f} us/request ({slow / fast:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""RuleSet lock contention benchmark: many threads, many profiles, one ruleset.
+
+Compares rules that lock the whole ruleset against rules declaring a per-profile quota key.
+
+    python -m bench.contention --threads 1 2 4 8 16 --profiles 64
+"""
+
+import argparse
+import time
+from multiprocessing.pool import ThreadPool
+
+from atakama import (
+    RulePlugin,
+    RuleSet,
+    ApprovalRequest,
+    ProfileInfo,
+    RequestType,
+    MetaInfo,
+)
+
+
+class GlobalQuotaRule(RulePlugin):
+    """Per-profile counter, with the default (whole ruleset) quota key."""
+
+    @staticmethod
+    def name():
+        return "bench-global-quota"
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.used = {}
+
+    def approve_request(self, request):
+        # simulate a directory or quota store lookup, which releases the gil
+        time.sleep(self.args["latency"])
+        return self.used.get(request.profile.profile_id, 0) < self.args["limit"]
+
+    def use_quota(self, request):
+        pid = request.profile.profile_id
+        self.used[pid] = self.used.get(pid, 0) + 1
+
+
+class KeyedQuotaRule(GlobalQuotaRule):
+    """Same counter, declaring the profile as its quota key."""
+
+    @staticmethod
+    def name():
+        return "bench-keyed-quota"
+
+    def quota_key(self, request):
+        return request.profile.profile_id
+
+
+def make_requests(count, profiles):
+    infos = [ProfileInfo(b"pid%i" % i, ["w"] * 8) for i in range(profiles)]
+    return [
+        ApprovalRequest(
+            request_type=RequestType.DECRYPT,
+            device_id=b"did",
+            profile=infos[i % profiles],
+            auth_meta=[MetaInfo("/meta", True)],
+            cryptographic_id=b"cid%i" % i,
+        )
+        for i in range(count)
+    ]
+
+
+def run(rule_cls, threads, requests, latency):
+    rule = rule_cls({"rule_id": "r", "latency": latency, "limit": len(requests)})
+    rs = RuleSet([rule])
+    pool = ThreadPool(threads)
+    start = time.perf_counter()
+    results = pool.map(rs.approve_request, requests)
+    elapsed = time.perf_counter() - start
+    pool.close()
+    assert all(results)
+    assert sum(rule.used.values()) == len(requests)
+    return len(requests) / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--profiles", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.0005)
+    args = parser.parse_args(argv)
+
+    requests = make_requests(args.requests, args.profiles)
+    print(f"{'threads':>8} {'global req/s':>14} {'keyed req/s':>14} {'speedup':>8}")
+    for threads in args.threads:
+        glob = run(GlobalQuotaRule, threads, requests, args.latency)
+        keyed = run(KeyedQuotaRule, threads, requests, args.latency)
+        print(f"{threads:>8} {glob:>14.0f} {keyed:>14.0f} {keyed / glob:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Synthetic policies and request workloads, shared by the benchmarks.
+
+Both generators are deterministic for a given seed, so that runs are comparable.
+"""
+
+import itertools
+import random
+from typing import Dict, Iterable, List, Optional
+
+from atakama import RulePlugin, ApprovalRequest, ProfileInfo, RequestType, MetaInfo
+from atakama.path_rule import PathRule
+
+# the policies use DeviceRule, "bench-device"
+from bench.compiled import DeviceRule
+
+
+class BenchPathRule(PathRule):
+    @staticmethod
+    def name():
+        return "bench-path"
+
+
+class BenchQuotaRule(RulePlugin):
+    """Per-profile request limit, counted in the engine's quota store."""
+
+    stores_quota = True
+
+    @staticmethod
+    def name():
+        return "bench-quota"
+
+    def quota_key(self, request):
+        return request.profile.profile_id
+
+    def approve_request(self, request):
+        used = self.quota_store.get(self.rule_id, request.profile.profile_id)
+        return used < self.args["limit"]
+
+    def use_quota(self, request):
+        return self.quota_store.incr(
+            self.rule_id, request.profile.profile_id, limit=self.args["limit"]
+        )
+
+    def release_quota(self, request):
+        self.quota_store.incr(self.rule_id, request.profile.profile_id, -1)
+
+    def at_quota(self, profile):
+        used = self.quota_store.get(self.rule_id, profile.profile_id)
+        return used >= self.args["limit"]
+
+
+TYPES = {
+    RequestType.DECRYPT: 0.8,
+    RequestType.SEARCH: 0.1,
+    RequestType.RENAME: 0.1,
+}
+"""Request types of the workload, and their weights, by default."""
+
+DEPTS = 20
+"""Files are spread over this many top level directories."""
+
+SHARED_RULES = [
+    {"rule": "bench-path", "paths": ["/share"]},
+    {"rule": "bench-path", "paths": ["/share/*.doc", "/share/*.xls"], "match": "any"},
+    {"rule": "bench-path", "paths": ["/share/dept*"]},
+    {"rule": "bench-path", "paths": ["/share"], "allow_partial": True},
+]
+"""Configurations repeated across rulesets, evaluated once per request when compiled."""
+
+
+def make_policy(
+    types: Iterable[RequestType] = tuple(TYPES),
+    rulesets: int = 100,
+    rules: int = 3,
+    shared: float = 0.3,
+    quota: float = 0.1,
+    limit: int = 1000,
+    seed: int = 0,
+) -> Dict[str, List[List[dict]]]:
+    """Policy with a tree for each of `types`, of `rulesets` rulesets each.
+
+    Ruleset i approves device "dev<i>", plus `rules - 1` path rules, in random order.
+    Each path rule is drawn from SHARED_RULES with probability `shared`, otherwise
+    it is specific to the ruleset.  A fraction `quota` of the rulesets also limits
+    each profile to `limit` approvals.
+    """
+    rng = random.Random(seed)
+    policy = {}
+    for rtype in types:
+        tree = []
+        for i in range(rulesets):
+            rset = [{"rule": "bench-device", "device": "dev%i" % i}]
+            for j in range(rules - 1):
+                if rng.random() < shared:
+                    rset.append(dict(rng.choice(SHARED_RULES)))
+                else:
+                    paths = ["/share/dept%i" % ((i + j) % DEPTS)]
+                    rset.append({"rule": "bench-path", "paths": paths})
+            rng.shuffle(rset)
+            if rng.random() < quota:
+                rset.append({"rule": "bench-quota", "limit": limit})
+            tree.append(rset)
+        policy[rtype.value] = tree
+    return policy
+
+
+def zipf_weights(count: int, s: float) -> List[float]:
+    """Cumulative weights of ranks 1..count, the k-th drawn with probability ~ k^-s."""
+    return list(itertools.accumulate(1 / k**s for k in range(1, count + 1)))
+
+
+def make_requests(
+    count: int,
+    devices: int = 110,
+    profiles: int = 1000,
+    hot_profiles: float = 0.01,
+    hot_share: float = 0.5,
+    files: int = 10000,
+    zipf: float = 1.1,
+    types: Optional[Dict[RequestType, float]] = None,
+    seed: int = 0,
+) -> List[ApprovalRequest]:
+    """Requests from devices "dev0".."dev<devices - 1>", with skewed profiles and files.
+
+    A fraction `hot_profiles` of the profiles makes a fraction `hot_share` of the
+    requests.  Each request names one to three files, by Zipf rank with exponent
+    `zipf`.  Request types are drawn by the weights of `types`, TYPES by default:
+    build the policy from the same types, so that every request has a tree.
+    """
+    rng = random.Random(seed)
+    types = types or TYPES
+    infos = [ProfileInfo(b"pid%i" % i, ["w%i" % i] * 8) for i in range(profiles)]
+    hot = infos[: max(1, int(profiles * hot_profiles))]
+    paths = ["/share/dept%i/file%i.doc" % (k % DEPTS, k) for k in range(files)]
+    file_weights = zipf_weights(files, zipf)
+    rtypes = list(types)
+    type_weights = list(itertools.accumulate(types.values()))
+
+    requests = []
+    for i in range(count):
+        profile = rng.choice(hot if rng.random() < hot_share else infos)
+        names = rng.choices(paths, cum_weights=file_weights, k=rng.randint(1, 3))
+        requests.append(
+            ApprovalRequest(
+                request_type=rng.choices(rtypes, cum_weights=type_weights)[0],
+                device_id=b"dev%i" % rng.randrange(devices),
+                profile=profile,
+                auth_meta=[MetaInfo(name, True) for name in names],
+                cryptographic_id=b"cid%i" % i,
+            )
+        )
+    return requests
@@ -0,0 +1,66 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Overhead of compiling an engine with metrics.
+
+    python -m bench.metrics --rulesets 20 --rules 3
+"""
+
+import argparse
+import time
+
+from atakama import RuleEngine, ApprovalRequest, ProfileInfo, RequestType, MetaInfo
+
+from bench.compiled import make_policy
+
+
+def timeit(engine, requests, count):
+    approve = engine.approve_request
+    best = float("inf")
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(count):
+            for request in requests:
+                approve(request)
+        best = min(best, time.perf_counter() - start)
+    return best / (count * len(requests))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rulesets", type=int, default=20)
+    parser.add_argument("--rules", type=int, default=3)
+    parser.add_argument("--count", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    plain = RuleEngine.from_dict(make_policy(args.rulesets, args.rules))
+    plain.compile()
+    measured = RuleEngine.from_dict(make_policy(args.rulesets, args.rules))
+    measured.compile(metrics=True)
+
+    # approved by the first, middle and last rulesets, and denied
+    requests = [
+        ApprovalRequest(
+            request_type=RequestType.DECRYPT,
+            device_id=b"dev%i" % i,
+            profile=ProfileInfo(b"pid", ["w"] * 8),
+            auth_meta=[MetaInfo("/meta", True)],
+            cryptographic_id=b"cid",
+        )
+        for i in (0, args.rulesets // 2, args.rulesets - 1, args.rulesets)
+    ]
+
+    base = timeit(plain, requests, args.count)
+    with_metrics = timeit(measured, requests, args.count)
+    print(f"without metrics: {base * 1e6:8.2f} us/request")
+    print(
+        f"with metrics:    {with_metrics * 1e6:8.2f} us/request "
+        f"(+{(with_metrics / base - 1) * 100:.0f}%)"
+    )
+    rules = sum(c.outcomes[0] + c.outcomes[1] for c in measured.metrics.rules.values())
+    decisions = sum(sum(c) for c in measured.metrics.decisions.values())
+    print(f"estimated rule evaluations per request: {rules / decisions:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Tail latency of sequential vs parallel RuleTree evaluation, with slow rules.
+
+Each ruleset holds one lookup rule with lognormal latency; the winning ruleset is
+drawn at random, so the sequential path pays for every failing set before it.
+
+    python -m bench.parallel --rulesets 8 --workers 8 --count 200
+"""
+
+import argparse
+import math
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from atakama import RulePlugin, RuleEngine, ApprovalRequest, ProfileInfo, RequestType
+from atakama import MetaInfo
+
+
+class LookupRule(RulePlugin):
+    """Directory lookup with a heavy-tailed latency."""
+
+    @staticmethod
+    def name():
+        return "bench-lookup"
+
+    def approve_request(self, request):
+        time.sleep(random.lognormvariate(self.args["mu"], 0.75))
+        return request.device_id == self.args["device"].encode()
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rulesets", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--median-ms", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    mu = math.log(args.median_ms / 1000)
+    policy = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "bench-lookup", "mu": mu, "device": "dev%i" % i}]
+            for i in range(args.rulesets)
+        ]
+    }
+    engine = RuleEngine.from_dict(policy)
+    profile = ProfileInfo(b"pid", ["w"] * 8)
+    requests = [
+        ApprovalRequest(
+            request_type=RequestType.DECRYPT,
+            device_id=b"dev%i" % random.randrange(args.rulesets),
+            profile=profile,
+            auth_meta=[MetaInfo("/meta", True)],
+            cryptographic_id=b"cid",
+        )
+        for _ in range(args.count)
+    ]
+
+    def measure(approve):
+        times = []
+        for request in requests:
+            start = time.perf_counter()
+            assert approve(request)
+            times.append((time.perf_counter() - start) * 1000)
+        return times
+
+    sequential = measure(engine.approve_request)
+    with ThreadPoolExecutor(args.workers) as executor:
+        parallel = measure(lambda r: engine.approve_request_parallel(r, executor))
+
+    print(f"{'':12} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for label, times in (("sequential", sequential), ("parallel", parallel)):
+        print(
+            f"{label:12} {percentile(times, 50):8.2f} {percentile(times, 99):8.2f}"
+            f" {max(times):8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Path rules: per-rule string scanning vs the shared PathIndex.
+
+    python -m bench.paths --rulesets 300 --patterns 5
+"""
+
+import argparse
+import time
+from fnmatch import fnmatchcase
+
+from atakama import RulePlugin, RuleEngine, ApprovalRequest, ProfileInfo, RequestType
+from atakama import MetaInfo
+from atakama.path_rule import PathRule, GLOB_CHARS
+
+
+class ScanningPathRule(RulePlugin):
+    """Each rule checks each path against each of its patterns."""
+
+    @staticmethod
+    def name():
+        return "bench-path-scan"
+
+    def approve_request(self, request):
+        for meta in request.auth_meta:
+            path = meta.meta.replace("\\", "/")
+            for pattern in self.args["paths"]:
+                if GLOB_CHARS.search(pattern):
+                    if fnmatchcase(path, pattern):
+                        break
+                elif path == pattern or path.startswith(pattern.rstrip("/") + "/"):
+                    break
+            else:
+                return False
+        return bool(request.auth_meta)
+
+
+class IndexedPathRule(PathRule):
+    @staticmethod
+    def name():
+        return "bench-path-index"
+
+
+def make_policy(rule, rulesets, patterns):
+    return {
+        RequestType.DECRYPT.value: [
+            [
+                {
+                    "rule": rule,
+                    "paths": [
+                        "/share/dept%i/team%i" % (i, j)
+                        if j % 2
+                        else "/share/dept%i/*.doc%i" % (i, j)
+                        for j in range(patterns)
+                    ],
+                }
+            ]
+            for i in range(rulesets)
+        ]
+    }
+
+
+def timeit(engine, request, count):
+    approve = engine.approve_request
+    start = time.perf_counter()
+    for _ in range(count):
+        approve(request)
+    return (time.perf_counter() - start) / count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rulesets", type=int, default=300)
+    parser.add_argument("--patterns", type=int, default=5)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--compile", action="store_true", help="compile the engines")
+    args = parser.parse_args(argv)
+
+    scanning = RuleEngine.from_dict(
+        make_policy("bench-path-scan", args.rulesets, args.patterns)
+    )
+    indexed = RuleEngine.from_dict(
+        make_policy("bench-path-index", args.rulesets, args.patterns)
+    )
+
+    if args.compile:
+        scanning.compile()
+        indexed.compile()
+
+    # worst case: the last ruleset matches
+    path = "/share/dept%i/team1/report.doc" % (args.rulesets - 1)
+    request = ApprovalRequest(
+        request_type=RequestType.DECRYPT,
+        device_id=b"dev",
+        profile=ProfileInfo(b"pid", ["w"] * 8),
+        auth_meta=[MetaInfo(path, True)],
+        cryptographic_id=b"cid",
+    )
+    assert scanning.approve_request(request) and indexed.approve_request(request)
+
+    slow = timeit(scanning, request, args.count)
+    fast = timeit(indexed, request, args.count)
+    print(f"patterns: {len(indexed.shared['path_index'])}")
+    print(f"scanning: {slow * 1e6:10.1f} us/request")
+    print(f"indexed:  {fast * 1e6:10.1f} us/request ({slow / fast:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Approvals per second of one engine vs a WorkerPool, by number of workers.
+
+    python -m bench.pool --rulesets 300 --workers 1,2,4,8
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from atakama import RuleEngine, ApprovalRequest, ProfileInfo, RequestType, MetaInfo
+from atakama.quota import MmapQuotaStore
+from atakama.worker_pool import WorkerPool
+
+from bench.compiled import make_policy
+
+
+def make_requests(rulesets, count):
+    # spread over the rulesets, some denied
+    return [
+        ApprovalRequest(
+            request_type=RequestType.DECRYPT,
+            device_id=b"dev%i" % (i % (rulesets + rulesets // 10 + 1)),
+            profile=ProfileInfo(b"pid%i" % (i % 1000), ["w"] * 8),
+            auth_meta=[MetaInfo("/share/file%i" % i, True)],
+            cryptographic_id=b"cid%i" % i,
+        )
+        for i in range(count)
+    ]
+
+
+def rate(approve_requests, requests, batch):
+    start = time.perf_counter()
+    for i in range(0, len(requests), batch):
+        approve_requests(requests[i : i + batch])
+    return len(requests) / (time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rulesets", type=int, default=300)
+    parser.add_argument("--rules", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=512)
+    parser.add_argument("--workers", default="1,2,4,%i" % (os.cpu_count() or 1))
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = MmapQuotaStore(os.path.join(tmp, "quota.mmap"))
+        engine = RuleEngine.from_dict(
+            make_policy(args.rulesets, args.rules), quota_store=store
+        )
+        engine.compile()
+        requests = make_requests(args.rulesets, args.requests)
+
+        def one_by_one(batch):
+            return [engine.approve_request(request) for request in batch]
+
+        base = rate(one_by_one, requests, args.batch)
+        print(f"cores: {os.cpu_count()}")
+        print(f"single engine: {base:10.0f} requests/s")
+        for workers in sorted({int(n) for n in args.workers.split(",")}):
+            with WorkerPool(engine, workers=workers) as pool:
+                # warm up the workers
+                pool.approve_requests(requests[: args.batch])
+                per_sec = rate(pool.approve_requests, requests, args.batch)
+            print(
+                f"pool, {workers:3} workers: {per_sec:10.0f} requests/s "
+                f"({per_sec / base:.2f}x)"
+            )
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
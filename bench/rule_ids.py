@@ -0,0 +1,88 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Rule id generation for a large policy, per entry vs bulk, md5 vs blake2b.
+
+    python -m bench.rule_ids --rules 100000 --workers 4
+"""
+
+import argparse
+import copy
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from atakama import RuleIdGenerator
+
+
+def make_policy(rules, per_set=4):
+    return {
+        "decrypt": [
+            [
+                {
+                    "rule": "bench-ids",
+                    "device": "dev%i" % (i // per_set),
+                    "paths": ["/share/%i/*" % i, "/home/%i" % (i % 97)],
+                    "limit": i % 50,
+                }
+                for i in range(start, min(start + per_set, rules))
+            ]
+            for start in range(0, rules, per_set)
+        ]
+    }
+
+
+def legacy(policy):
+    """Ids as generated before bulk mode: one json.dumps and md5 per entry."""
+    seen = {}
+    for ruleset in policy["decrypt"]:
+        for ent in ruleset:
+            data = json.dumps(ent, sort_keys=True, separators=(",", ":"))
+            ent_hash = hashlib.md5(data.encode("utf8")).hexdigest()
+            if ent_hash in seen:
+                seen[ent_hash] += 1
+                ent_hash += "." + str(seen[ent_hash])
+            seen[ent_hash] = seen.get(ent_hash, 0) + 1
+            ent["rule_id"] = ent_hash
+
+
+def timeit(fn, policy, count):
+    best = float("inf")
+    for _ in range(count):
+        copies = copy.deepcopy(policy)
+        start = time.perf_counter()
+        fn(copies)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--count", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    policy = make_policy(args.rules)
+    base = timeit(legacy, policy, args.count)
+    print(f"{args.rules} rules")
+    print(f"per entry md5:  {base * 1e3:8.1f} ms")
+
+    def report(label, rgen_factory):
+        took = timeit(lambda p: rgen_factory().inject_policy(p), policy, args.count)
+        print(f"{label:15s} {took * 1e3:8.1f} ms ({base / took:.2f}x)")
+
+    report("bulk md5:", RuleIdGenerator)
+    report("bulk blake2b:", lambda: RuleIdGenerator("blake2b"))
+    with ProcessPoolExecutor(args.workers) as executor:
+        # start the workers outside the timing
+        list(executor.map(abs, range(args.workers)))
+        report(
+            "pool blake2b:",
+            lambda: RuleIdGenerator("blake2b", executor, chunk_size=8192),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Startup time of RuleEngine.from_yml_file on a large policy.
+
+    python -m bench.startup --rules 10000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import yaml
+
+from atakama import RulePlugin, RuleEngine, RequestType
+from atakama import rule_engine
+
+
+class StartupRule(RulePlugin):
+    """Rule with a few typical arguments."""
+
+    @staticmethod
+    def name():
+        return "bench-startup"
+
+    def approve_request(self, request):
+        return request.device_id == self.args["device"].encode()
+
+
+def make_policy(rules, per_set):
+    return {
+        rtype.value: [
+            [
+                {
+                    "rule": "bench-startup",
+                    "device": "dev%i" % (i // per_set),
+                    "paths": ["/share/%i/*" % i, "/home/%i" % (i % 97)],
+                    "limit": i % 50,
+                }
+                for i in range(start, min(start + per_set, rules))
+            ]
+            for start in range(0, rules, per_set)
+        ]
+        for rtype in (RequestType.DECRYPT, RequestType.SEARCH)
+    }
+
+
+def timeit(fn, count):
+    best = float("inf")
+    for _ in range(count):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rules", type=int, default=10000, help="rules per type")
+    parser.add_argument("--per-set", type=int, default=4)
+    parser.add_argument("--count", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        yml = os.path.join(tmp, "rules.yml")
+        cache_dir = os.path.join(tmp, "cache")
+        with open(yml, "w", encoding="utf8") as fh:
+            yaml.safe_dump(make_policy(args.rules, args.per_set), fh)
+
+        def load(**kws):
+            return lambda: RuleEngine.from_yml_file(yml, **kws)
+
+        loader = rule_engine.YamlLoader
+        rule_engine.YamlLoader = yaml.SafeLoader
+        try:
+            pure = timeit(load(), args.count)
+        finally:
+            rule_engine.YamlLoader = loader
+        fast = timeit(load(), args.count)
+        load(cache_dir=cache_dir)()
+        cached = timeit(load(cache_dir=cache_dir), args.count)
+
+    print(f"policy: {2 * args.rules} rules")
+    print(f"pure python yaml: {pure * 1e3:10.1f} ms")
+    print(f"{loader.__name__ + ':':17s} {fast * 1e3:10.1f} ms ({pure / fast:.2f}x)")
+    print(f"cached:           {cached * 1e3:10.1f} ms ({pure / cached:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
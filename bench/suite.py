@@ -0,0 +1,245 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+"""Load test of RuleEngine: throughput, latency, lock contention and memory.
+
+Evaluates a synthetic workload, see `bench.generators`, against a synthetic policy,
+with the engine walked, compiled, and compiled adaptively, by 1 or more threads.
+
+Save a run with --save, and compare later runs with --baseline: the suite exits
+with status 1 if throughput or p99 latency regressed by more than --tolerance.
+
+    python -m bench.suite --rulesets 100 --threads 1,4 --save base.json
+    python -m bench.suite --rulesets 100 --threads 1,4 --baseline base.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+from atakama import RuleEngine, RuleSet, RequestType
+from atakama.quota_lock import QuotaLock
+
+from bench.generators import TYPES, make_policy, make_requests
+
+VARIANTS = ("walked", "compiled", "adaptive")
+
+
+class TimedQuotaLock(QuotaLock):
+    """QuotaLock recording the time spent acquiring it."""
+
+    def __init__(self):
+        super().__init__()
+        self.waits = []
+
+    def acquire(self, stripes):
+        start = time.perf_counter_ns()
+        super().acquire(stripes)
+        # list.append is atomic, no need for another lock
+        self.waits.append(time.perf_counter_ns() - start)
+
+
+def build(policy, variant, timed=False):
+    # from_dict modifies the policy
+    engine = RuleEngine.from_dict(json.loads(json.dumps(policy)))
+    locks = []
+    if timed:
+        # before compiling: compiled rulesets look their lock up once
+        for tree in engine.map.values():
+            for rset in tree:
+                lock = TimedQuotaLock()
+                setattr(rset, "_%s__lock" % RuleSet.__name__, lock)
+                locks.append(lock)
+    if variant != "walked":
+        engine.compile(adaptive=variant == "adaptive")
+    return engine, locks
+
+
+def run(engine, requests, threads):
+    """Approve requests from `threads` threads, return wall time and latencies (ns)."""
+    chunks = [requests[i::threads] for i in range(threads)]
+    latencies = [[] for _ in chunks]
+    ready = threading.Barrier(threads + 1)
+
+    def work(chunk, lat):
+        approve = engine.approve_request
+        clock = time.perf_counter_ns
+        ready.wait()
+        for request in chunk:
+            start = clock()
+            approve(request)
+            lat.append(clock() - start)
+
+    workers = [
+        threading.Thread(target=work, args=args) for args in zip(chunks, latencies)
+    ]
+    for worker in workers:
+        worker.start()
+    ready.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return elapsed, sorted(itertools.chain.from_iterable(latencies))
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def measure(policy, variant, requests, threads, warmup, repeat):
+    """Results of one variant, by thread count, and its memory use.
+
+    Throughput and latencies are those of the fastest of `repeat` runs.  Time in
+    locks includes uncontended acquisitions: compare it with the single thread run.
+    """
+    tracemalloc.start()
+    engine, _ = build(policy, variant)
+    engine_kib = tracemalloc.get_traced_memory()[0] / 1024
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    for request in requests[:warmup]:
+        engine.approve_request(request)
+    eval_kib = (tracemalloc.get_traced_memory()[1] - before) / 1024
+    tracemalloc.stop()
+
+    ret = {"engine_kib": engine_kib, "eval_peak_kib": eval_kib, "threads": {}}
+    for count in threads:
+        runs = []
+        for _ in range(repeat):
+            # fresh engines, so that quotas are used up the same way by each run
+            engine, _ = build(policy, variant)
+            run(engine, requests[:warmup], count)
+            runs.append(run(engine, requests, count))
+        elapsed, lat = min(runs)
+
+        # time in locks in a separate run, timing them slows every request down
+        engine, locks = build(policy, variant, timed=True)
+        run(engine, requests, count)
+        waits = list(itertools.chain.from_iterable(lock.waits for lock in locks))
+        ret["threads"][str(count)] = {
+            "throughput": len(requests) / elapsed,
+            "p50_us": percentile(lat, 0.5) / 1e3,
+            "p99_us": percentile(lat, 0.99) / 1e3,
+            "lock_wait_us": sum(waits) / len(requests) / 1e3,
+            "lock_max_us": max(waits, default=0) / 1e3,
+        }
+    return ret
+
+
+def report(results):
+    print(
+        f"{'variant':>9} {'threads':>7} {'req/s':>9} {'p50 us':>8} {'p99 us':>8} "
+        f"{'lock us/req':>11} {'lock max us':>11}"
+    )
+    for variant, res in results.items():
+        for count, row in res["threads"].items():
+            print(
+                f"{variant:>9} {count:>7} {row['throughput']:>9.0f} "
+                f"{row['p50_us']:>8.1f} {row['p99_us']:>8.1f} "
+                f"{row['lock_wait_us']:>11.2f} {row['lock_max_us']:>11.1f}"
+            )
+    print()
+    print(f"{'variant':>9} {'engine KiB':>10} {'eval peak KiB':>13}")
+    for variant, res in results.items():
+        print(f"{variant:>9} {res['engine_kib']:>10.0f} {res['eval_peak_kib']:>13.0f}")
+
+
+def compare(results, baseline, tolerance):
+    """Print and return the regressions of results against baseline."""
+    regressions = []
+    for variant, res in results.items():
+        for count, row in res["threads"].items():
+            base = baseline.get(variant, {}).get("threads", {}).get(count)
+            if base is None:
+                continue
+            slower = base["throughput"] / row["throughput"] - 1
+            later = row["p99_us"] / base["p99_us"] - 1
+            for name, change in (("throughput", slower), ("p99", later)):
+                if change > tolerance:
+                    regressions.append(
+                        f"{variant}, {count} threads: {name} {change * 100:.0f}% worse"
+                    )
+    for line in regressions:
+        print("REGRESSION", line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--types",
+        default=",".join("%s=%s" % (t.value, w) for t, w in TYPES.items()),
+        help="request types of the workload, with their weights",
+    )
+    parser.add_argument("--rulesets", type=int, default=100)
+    parser.add_argument("--rules", type=int, default=3)
+    parser.add_argument("--shared", type=float, default=0.3)
+    parser.add_argument("--quota", type=float, default=0.1)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--warmup", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--profiles", type=int, default=1000)
+    parser.add_argument("--hot-profiles", type=float, default=0.01)
+    parser.add_argument("--hot-share", type=float, default=0.5)
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--threads", default="1,4")
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare with results saved by --save")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    types = {}
+    for item in args.types.split(","):
+        name, weight = item.split("=")
+        types[RequestType(name)] = float(weight)
+
+    policy = make_policy(
+        types=types,
+        rulesets=args.rulesets,
+        rules=args.rules,
+        shared=args.shared,
+        quota=args.quota,
+        limit=args.limit,
+        seed=args.seed,
+    )
+    requests = make_requests(
+        args.requests,
+        # a tenth of the requests come from unknown devices, and are denied
+        devices=args.rulesets + args.rulesets // 10,
+        profiles=args.profiles,
+        hot_profiles=args.hot_profiles,
+        hot_share=args.hot_share,
+        files=args.files,
+        zipf=args.zipf,
+        types=types,
+        seed=args.seed,
+    )
+    threads = sorted({int(n) for n in args.threads.split(",")})
+
+    print(f"cores: {os.cpu_count()}")
+    results = {
+        variant: measure(policy, variant, requests, threads, args.warmup, args.repeat)
+        for variant in args.variants.split(",")
+    }
+    report(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
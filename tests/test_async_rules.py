@@ -0,0 +1,283 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from atakama import (
+    AsyncRulePlugin,
+    RulePlugin,
+    RuleEngine,
+    RequestType,
+)
+
+from atakama.quota_lock import QuotaLock
+
+from tests.test_rulesets import TestApprovalRequest, TestProfileInfo
+
+
+class FakeDirectory:
+    """Local stand-in for a slow directory/quota backend."""
+
+    def __init__(self):
+        self.users = {}
+        self.used = {}
+        self.lookups = 0
+        self.cancelled = 0
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def stop(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    async def lookup(self, key, delay):
+        self.lookups += 1
+        self.start()
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.stop()
+        return self.users.get(key)
+
+
+directory = FakeDirectory()
+
+
+class DirectoryRule(AsyncRulePlugin):
+    @staticmethod
+    def name():
+        return "async_directory"
+
+    async def approve_request_async(self, request):
+        group = await directory.lookup(request.device_id, self.args.get("delay", 0))
+        return group == self.args["group"]
+
+
+class DirectoryQuotaRule(AsyncRulePlugin):
+    @staticmethod
+    def name():
+        return "async_quota"
+
+    def quota_key(self, request):
+        return request.profile.profile_id
+
+    async def approve_request_async(self, request):
+        await directory.lookup(None, 0.001)
+        return directory.used.get(self.rule_id, 0) < self.args["limit"]
+
+    async def use_quota_async(self, request):
+        await directory.lookup(None, 0.001)
+        directory.used[self.rule_id] = directory.used.get(self.rule_id, 0) + 1
+
+
+class SyncSleepRule(RulePlugin):
+    @staticmethod
+    def name():
+        return "sync_sleep"
+
+    def approve_request(self, request):
+        directory.start()
+        try:
+            time.sleep(self.args["delay"])
+        finally:
+            directory.stop()
+        return True
+
+
+class SyncQuotaRule(RulePlugin):
+    @staticmethod
+    def name():
+        return "sync_quota"
+
+    def quota_key(self, request):
+        return request.profile.profile_id
+
+    def approve_request(self, request):
+        used = directory.used.get(self.rule_id, 0)
+        time.sleep(0.002)
+        return used < self.args["limit"]
+
+    def use_quota(self, request):
+        directory.used[self.rule_id] = directory.used.get(self.rule_id, 0) + 1
+
+
+def setup_function():
+    directory.__init__()
+    directory.users = {b"admin": "admins", b"user": "users"}
+
+
+def test_concurrent_rulesets():
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "async_directory", "group": "nobody", "delay": 0.1}],
+            [{"rule": "async_directory", "group": "users", "delay": 0.1}],
+            [{"rule": "async_directory", "group": "admins", "delay": 0.1}],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    tree = re.map[RequestType.DECRYPT]
+
+    res = asyncio.run(re.approve_request_async(TestApprovalRequest(device_id=b"admin")))
+    assert res == id(tree[2])
+    assert directory.lookups == 3
+    # rulesets were evaluated concurrently
+    assert directory.max_in_flight == 3
+
+    assert not asyncio.run(
+        re.approve_request_async(TestApprovalRequest(device_id=b"x"))
+    )
+    assert (
+        asyncio.run(
+            re.approve_request_async(
+                TestApprovalRequest(request_type=RequestType.SEARCH)
+            )
+        )
+        is None
+    )
+
+
+def test_first_in_order_wins_and_cancels_the_rest():
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "async_directory", "group": "admins", "delay": 0.05}],
+            [{"rule": "async_directory", "group": "admins", "delay": 0}],
+            [{"rule": "async_directory", "group": "admins", "delay": 10}],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    tree = re.map[RequestType.DECRYPT]
+
+    start = time.perf_counter()
+    res = asyncio.run(re.approve_request_async(TestApprovalRequest(device_id=b"admin")))
+    # same winner as the sequential engine, the slow ruleset is cancelled
+    assert res == id(tree[0])
+    assert res == re.approve_request(TestApprovalRequest(device_id=b"admin"))
+    assert time.perf_counter() - start < 1
+    assert directory.cancelled == 1
+
+
+def test_async_quota_is_atomic():
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "async_quota", "limit": 10}],
+            [{"rule": "async_quota", "limit": 5}],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    tree = re.map[RequestType.DECRYPT]
+
+    async def main():
+        return await asyncio.gather(
+            *(re.approve_request_async(TestApprovalRequest()) for _ in range(30))
+        )
+
+    results = asyncio.run(main())
+    assert results.count(id(tree[0])) == 10
+    assert results.count(id(tree[1])) == 5
+    assert results.count(False) == 15
+    assert sorted(directory.used.values()) == [5, 10]
+
+
+def test_mixed_sync_rules():
+    info = {
+        RequestType.DECRYPT.value: [
+            [
+                {"rule": "sync_sleep", "delay": 0.1},
+                {"rule": "async_directory", "group": "users"},
+            ],
+            [
+                {"rule": "sync_sleep", "delay": 0.1},
+                {"rule": "async_directory", "group": "admins"},
+            ],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    tree = re.map[RequestType.DECRYPT]
+
+    with ThreadPoolExecutor(4) as executor:
+        res = asyncio.run(
+            re.approve_request_async(TestApprovalRequest(device_id=b"admin"), executor)
+        )
+    assert res == id(tree[1])
+    # sync rules ran in parallel threads
+    assert directory.max_in_flight == 2
+
+    # async rules also work in synchronous engines
+    assert re.approve_request(
+        TestApprovalRequest(device_id=b"admin", profile=TestProfileInfo())
+    ) == id(tree[1])
+
+    # and from a running loop, in another thread
+    async def nested():
+        return re.approve_request(TestApprovalRequest(device_id=b"admin"))
+
+    assert asyncio.run(nested()) == id(tree[1])
+
+
+def test_async_excludes_threads():
+    re = RuleEngine.from_dict(
+        {RequestType.DECRYPT.value: [[{"rule": "sync_quota", "limit": 5}]]}
+    )
+    rs_id = id(re.map[RequestType.DECRYPT][0])
+
+    async def main(executor):
+        loop = asyncio.get_running_loop()
+        sync = [
+            loop.run_in_executor(executor, re.approve_request, TestApprovalRequest())
+            for _ in range(10)
+        ]
+        tasks = [re.approve_request_async(TestApprovalRequest()) for _ in range(10)]
+        return await asyncio.gather(*sync, *tasks)
+
+    with ThreadPoolExecutor(4) as executor:
+        results = asyncio.run(main(executor))
+    assert results.count(rs_id) == 5
+    assert list(directory.used.values()) == [5]
+
+
+def test_async_engine_reused_by_loops():
+    re = RuleEngine.from_dict(
+        {RequestType.DECRYPT.value: [[{"rule": "async_quota", "limit": 100}]]}
+    )
+    rs_id = id(re.map[RequestType.DECRYPT][0])
+
+    async def main():
+        return await asyncio.gather(
+            *(re.approve_request_async(TestApprovalRequest()) for _ in range(5))
+        )
+
+    # the lock's asyncio primitives are contended in both loops
+    assert asyncio.run(main()) == [rs_id] * 5
+    assert asyncio.run(main()) == [rs_id] * 5
+
+
+def test_async_lock_held_by_task():
+    lock = QuotaLock()
+    stripes = lock.stripes_for([b"pid"])
+
+    async def main():
+        async with lock.hold_async(stripes):
+            # the loop's thread does not own the stripes held by the task
+            assert not lock.try_acquire(stripes)
+            assert not lock.try_acquire(None)
+            # other threads wait for the task
+            other = await asyncio.get_running_loop().run_in_executor(
+                None, lock.try_acquire, stripes
+            )
+            assert not other
+        assert lock.try_acquire(stripes)
+        lock.release(stripes)
+
+    asyncio.run(main())
@@ -0,0 +1,179 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import yaml
+
+from atakama import RuleEngine, RequestType, RulePlugin, MetaInfo, FrozenApprovalRequest
+from atakama.decision_cache import DecisionCache
+from atakama.rule_reload import RuleEngineHolder
+from atakama.tracing import CACHED, DecisionTracer
+
+from tests.test_rate_limit import Clock
+from tests.test_rulesets import TestApprovalRequest, TestProfileInfo
+
+
+class CountingRule(RulePlugin):
+    calls = 0
+
+    @staticmethod
+    def name():
+        return "cache_device"
+
+    def approve_request(self, request):
+        CountingRule.calls += 1
+        return request.device_id == self.args["device"].encode()
+
+
+class QuotaRule(RulePlugin):
+    @staticmethod
+    def name():
+        return "cache_quota"
+
+    def approve_request(self, request):
+        return self.quota_store.get(self.rule_id, request.profile.profile_id) < 1
+
+    def use_quota(self, request):
+        self.quota_store.incr(self.rule_id, request.profile.profile_id)
+
+    def clear_quota(self, profile):
+        self.quota_store.clear(self.rule_id, profile.profile_id)
+
+
+def make_engine(*rulesets, search=None):
+    info = {RequestType.DECRYPT.value: list(rulesets)}
+    if search:
+        info[RequestType.SEARCH.value] = search
+    return RuleEngine.from_dict(info)
+
+
+def test_decision_cache():
+    CountingRule.calls = 0
+    clock = Clock()
+    engine = make_engine(
+        [{"rule": "cache_device", "device": "a"}],
+        [{"rule": "cache_quota"}],
+        [{"rule": "cache_device", "device": "b"}],
+        search=[[{"rule": "cache_quota"}]],
+    )
+    cache = DecisionCache(engine, maxsize=2, ttl=10, clock=clock)
+    req_a = TestApprovalRequest(device_id=b"a")
+
+    rs_id = cache.approve_request(req_a)
+    assert rs_id == id(engine.map[RequestType.DECRYPT][0])
+    assert cache.approve_request(TestApprovalRequest(device_id=b"a")) == rs_id
+    assert (cache.hits, cache.misses, cache.bypassed) == (1, 1, 0)
+    assert CountingRule.calls == 1
+
+    # other auth meta is another request
+    other = TestApprovalRequest(device_id=b"a", auth_meta=[MetaInfo("/x", True)])
+    assert cache.approve_request(other) == rs_id
+    assert cache.misses == 2
+
+    # approvals after a quota ruleset are not cached, nor are rejections
+    req_b = TestApprovalRequest(device_id=b"b")
+    assert cache.approve_request(req_b) == id(engine.map[RequestType.DECRYPT][1])
+    assert cache.approve_request(req_b) == id(engine.map[RequestType.DECRYPT][2])
+    assert cache.bypassed == 2
+
+    # requests whose first ruleset uses quota skip the cache
+    search = TestApprovalRequest(
+        request_type=RequestType.SEARCH, profile=TestProfileInfo(b"quota")
+    )
+    assert cache.approve_request(search)
+    assert not cache.approve_request(search)
+    assert cache.bypassed == 4
+    cache.clear_quota(search.profile)
+    assert cache.approve_request(search)
+
+    # request types without rules are cached
+    assert cache.approve_request(TestApprovalRequest(RequestType.RENAME)) is None
+    assert cache.misses == 3
+    assert len(cache) == 2
+
+    # lru eviction, the request for "a" was least recently used
+    calls = CountingRule.calls
+    cache.approve_request(other)
+    assert cache.hits == 2
+    cache.approve_request(req_a)
+    assert CountingRule.calls == calls + 1
+
+    # ttl expiry
+    clock.now += 11
+    cache.approve_request(req_a)
+    assert CountingRule.calls == calls + 2
+
+    # clear_quota drops the profile's decisions
+    cache.clear_quota(req_a.profile)
+    cache.approve_request(
+        TestApprovalRequest(device_id=b"a", profile=TestProfileInfo(b"other"))
+    )
+    assert len(cache) == 1
+
+    cache.reset(make_engine([{"rule": "cache_device", "device": "x"}]))
+    assert len(cache) == 0
+    assert not cache.approve_request(req_a)
+
+
+def test_cache_hits_observed():
+    tracer = DecisionTracer()
+    engine = RuleEngine.from_dict(
+        {RequestType.DECRYPT.value: [[{"rule": "cache_device", "device": "a"}]]},
+        tracer=tracer,
+    )
+    engine.compile(metrics=True)
+    cache = DecisionCache(engine)
+    rset = engine.map[RequestType.DECRYPT][0]
+
+    for device_id in (b"a", b"a", b"x", b"x"):
+        cache.approve_request(TestApprovalRequest(device_id=device_id))
+    assert cache.hits == 2
+
+    approved, approved_hit, denied, denied_hit = tracer.dump()
+    assert approved.steps == ((rset.stable_id, rset[0].rule_id, True),)
+    assert approved_hit.result == id(rset)
+    assert approved_hit.ruleset == rset.stable_id
+    assert approved_hit.steps == ((rset.stable_id, CACHED, id(rset)),)
+    assert denied_hit.result is False
+    assert denied_hit.steps == (("", CACHED, False),)
+    assert denied.steps != denied_hit.steps
+
+    snap = engine.metrics.snapshot()
+    assert snap["decisions"] == {"decrypt": {"approved": 2, "denied": 2, "none": 0}}
+    assert snap["cache_hits"] == {"decrypt": 2}
+    assert (
+        'atakama_decision_cache_hits_total{request_type="decrypt"} 2'
+        in engine.metrics.prometheus()
+    )
+
+
+def test_holder_cache_reset(tmp_path):
+    policy = tmp_path / "policy.yml"
+
+    def write(device):
+        rules = [[{"rule": "cache_device", "device": device}]]
+        policy.write_text(yaml.safe_dump({RequestType.DECRYPT.value: rules}))
+
+    write("a")
+    holder = RuleEngineHolder(policy, cache_size=16)
+    req = TestApprovalRequest(device_id=b"a")
+    assert holder.approve_request(req)
+    assert holder.approve_request(req)
+    assert holder.cache.hits == 1
+
+    write("b")
+    assert holder.reload()
+    assert not holder.approve_request(req)
+    assert holder.cache.engine is holder.engine
+
+
+def test_frozen_request_keys():
+    engine = make_engine([{"rule": "cache_device", "device": "a"}])
+    cache = DecisionCache(engine)
+    frozen = FrozenApprovalRequest.from_request(TestApprovalRequest(device_id=b"a"))
+    assert cache.approve_request(frozen)
+    assert cache.approve_request(
+        FrozenApprovalRequest.from_request(TestApprovalRequest(device_id=b"a"))
+    )
+    assert cache.hits == 1
+    cache.clear_quota(frozen.profile)
+    assert len(cache) == 0
@@ -0,0 +1,99 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import yaml
+
+from atakama import RuleEngine, RequestType, RulePlugin
+from atakama.metrics import Histogram, EngineMetrics
+from atakama.rule_reload import RuleEngineHolder
+
+from tests.test_rulesets import TestApprovalRequest
+
+
+class MetricsRule(RulePlugin):
+    @staticmethod
+    def name():
+        return "metrics_device"
+
+    def approve_request(self, request):
+        if request.device_id == b"err":
+            raise ValueError
+        if request.device_id == b"none":
+            return None
+        return request.device_id == self.args["device"].encode()
+
+
+def test_histogram():
+    hist = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        hist.observe(value)
+    assert hist.cumulative() == [(0.1, 2), (1.0, 3), (float("inf"), 4)]
+    assert hist.count == 4
+    assert hist.sum == 2.65
+
+
+def test_engine_metrics():
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "metrics_device", "device": "a", "rule_id": "ra"}],
+            [{"rule": "metrics_device", "device": "b", "rule_id": "rb"}],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    assert re.metrics is None
+    re.compile(metrics=EngineMetrics(sample_every=1))
+    tree = re.map[RequestType.DECRYPT]
+
+    for did in (b"a", b"b", b"b", b"err", b"none"):
+        re.approve_request(TestApprovalRequest(device_id=did))
+    re.approve_request(TestApprovalRequest(request_type=RequestType.SEARCH))
+
+    snap = re.metrics.snapshot()
+    rule_a = snap["rules"]["ra"]
+    assert rule_a["name"] == "metrics_device"
+    outcomes = [rule_a[k] for k in ("approved", "denied", "none", "error")]
+    assert outcomes == [1, 2, 1, 1]
+    assert rule_a["latency"]["count"] == 5
+    assert snap["rules"]["rb"]["approved"] == 2
+    set_b = snap["rulesets"][tree[1].stable_id]
+    assert (set_b["approved"], set_b["denied"]) == (2, 2)
+    assert snap["decisions"] == {
+        "decrypt": {"approved": 3, "denied": 2, "none": 0},
+        "search": {"approved": 0, "denied": 0, "none": 1},
+    }
+
+    text = re.metrics.prometheus()
+    assert "# TYPE atakama_rule_latency_seconds histogram" in text
+    assert (
+        'atakama_rule_evaluations_total{rule_id="ra",rule="metrics_device",'
+        'result="error"} 1' in text
+    )
+    labels = 'rule_id="rb",rule="metrics_device"'
+    assert "atakama_rule_latency_seconds_count{%s} 4" % labels in text
+    assert (
+        'atakama_ruleset_latency_seconds_bucket{ruleset="%s",le="+Inf"} 4'
+        % tree[1].stable_id
+        in text
+    )
+    assert 'atakama_decisions_total{request_type="decrypt",result="approved"} 3' in text
+
+    # sampled evaluations count sample_every times, decisions are exact
+    metrics = EngineMetrics(sample_every=8)
+    re.compile(adaptive=True, metrics=metrics)
+    for _ in range(20):
+        re.approve_request(TestApprovalRequest(device_id=b"a"))
+    assert metrics.rules["ra"].outcomes[0] == 16
+    assert metrics.rules["ra"].latency.count == 2
+    assert metrics.decisions["decrypt"][0] == 20
+
+
+def test_holder_metrics(tmp_path):
+    policy = tmp_path / "policy.yml"
+    rules = [[{"rule": "metrics_device", "device": "a", "rule_id": "ra"}]]
+    policy.write_text(yaml.safe_dump({RequestType.DECRYPT.value: rules}))
+    holder = RuleEngineHolder(policy, metrics=True)
+    holder.approve_request(TestApprovalRequest(device_id=b"a"))
+    assert holder.reload()
+    holder.approve_request(TestApprovalRequest(device_id=b"a"))
+    assert holder.engine.metrics is holder.metrics
+    assert holder.metrics.decisions["decrypt"][0] == 2
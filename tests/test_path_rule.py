@@ -0,0 +1,84 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import pytest
+
+from atakama import RuleEngine, RequestType, MetaInfo
+from atakama.path_rule import PathIndex, PathRule
+
+from tests.test_rulesets import TestApprovalRequest
+
+
+class ExamplePathRule(PathRule):
+    @staticmethod
+    def name():
+        return "example_path"
+
+
+def path_request(*paths, complete=True):
+    return TestApprovalRequest(auth_meta=[MetaInfo(p, complete) for p in paths])
+
+
+def test_path_index():
+    index = PathIndex()
+    share = index.add("/share")
+    docs = index.add("/share/*.docx")
+    root = index.add("/")
+    anywhere = index.add("*.pdf")
+    nested = index.add("/home/*/private")
+    assert index.add("/share") == share
+    assert len(index) == 5
+
+    assert index.match("/share/a.docx") == {share, docs, root}
+    assert index.match("/share") == {share, root}
+    assert index.match("/shared/a.docx") == {root}
+    assert index.match("/share/sub/a.pdf") == {share, root, anywhere}
+    assert index.match("\\share\\b.docx") == {share, docs, root}
+    assert index.match("/home/bob/private") == {root, nested}
+    assert index.match("/home/bob/public") == {root}
+
+    # adding patterns invalidates cached results
+    extra = index.add("/home/bob")
+    assert index.match("/home/bob/public") == {root, extra}
+
+    # relative patterns and paths are absolute, for globs as well as prefixes
+    relative = index.add("share/*.txt")
+    assert index.match("/share/a.txt") == {share, root, relative}
+    assert index.match("share\\a.txt") == {share, root, relative}
+    assert index.match("//share/a.txt") == {share, root, relative}
+    assert index.match("home/bob/private") == {root, nested, extra}
+    assert index.match("/shared/a.txt") == {root}
+
+
+def test_path_rule():
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "example_path", "paths": ["/share", "*.txt"]}],
+            [{"rule": "example_path", "paths": ["/home/*"], "match": "any"}],
+            [{"rule": "example_path", "paths": ["/tmp"], "allow_partial": True}],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    tree = re.map[RequestType.DECRYPT]
+
+    # all rules share one index
+    index = re.shared["path_index"]
+    assert all(rset[0]._index[0] is index for rset in tree)
+    assert len(index) == 4
+
+    assert re.approve_request(path_request("/share/a")) == id(tree[0])
+    assert re.approve_request(path_request("/x/a.txt", "/share/b")) == id(tree[0])
+    assert re.approve_request(path_request("/home/x", "/other")) == id(tree[1])
+    assert not re.approve_request(path_request("/other"))
+    assert not re.approve_request(path_request())
+
+    # incomplete paths only match rules that allow them
+    assert not re.approve_request(path_request("/share/a", complete=False))
+    assert re.approve_request(path_request("/tmp/a", complete=False)) == id(tree[2])
+
+    # usable without an engine
+    rule = ExamplePathRule({"rule_id": "r", "paths": ["/a"]})
+    assert rule.approve_request(path_request("/a/b"))
+
+    with pytest.raises(AssertionError):
+        ExamplePathRule({"rule_id": "r", "paths": "/a"})
@@ -0,0 +1,502 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+from atakama import RulePlugin, RuleEngine, RequestType, ProfileInfo, RuleSet, RuleTree
+from atakama.quota import MemoryQuotaStore, MmapQuotaStore, SqliteQuotaStore
+from atakama.quota import JournalQuotaStore
+from atakama.rate_limit import RateLimitRule
+
+from tests.test_rulesets import TestApprovalRequest, TestProfileInfo
+
+
+def make_store(kind, path):
+    if kind == "memory":
+        return MemoryQuotaStore()
+    if kind == "mmap":
+        return MmapQuotaStore(path / "quota.mmap", slots=1024)
+    if kind == "journal":
+        return JournalQuotaStore(path / "quota")
+    return SqliteQuotaStore(path / "quota.db")
+
+
+@pytest.fixture(params=["memory", "mmap", "sqlite", "journal"])
+def store(request, tmp_path):
+    store = make_store(request.param, tmp_path)
+    yield store
+    store.close()
+
+
+def test_store_basics(store):
+    assert store.get("r1", b"p1") == 0
+    assert store.incr("r1", b"p1", limit=2)
+    assert store.incr("r1", b"p1", limit=2)
+    assert not store.incr("r1", b"p1", limit=2)
+    assert store.incr("r1", b"p2", 5)
+    assert not store.incr("r2", b"p1", 3, limit=2)
+    assert store.get("r1", b"p1") == 2
+    assert sorted(store.items()) == [("r1", b"p1", 2), ("r1", b"p2", 5)]
+
+    store.clear("r1", b"p1")
+    store.clear("r3", b"nope")
+    assert store.get("r1", b"p1") == 0
+    assert list(store.items()) == [("r1", b"p2", 5)]
+
+
+def test_store_threads(store):
+    def incr(_):
+        return store.incr("r", b"p", limit=250)
+
+    with ThreadPool(8) as pool:
+        assert sum(pool.map(incr, range(400))) == 250
+    assert store.get("r", b"p") == 250
+
+
+def _incr_in_process(args):
+    kind, path = args
+    store = make_store(kind, path)
+    try:
+        return sum(store.incr("r", b"p", limit=150) for _ in range(50))
+    finally:
+        store.close()
+
+
+@pytest.mark.parametrize("kind", ["mmap", "sqlite"])
+def test_store_processes(kind, tmp_path):
+    make_store(kind, tmp_path).close()
+    with multiprocessing.Pool(4) as pool:
+        assert sum(pool.map(_incr_in_process, [(kind, tmp_path)] * 4)) == 150
+    assert make_store(kind, tmp_path).get("r", b"p") == 150
+
+
+def test_mmap_store_limits(tmp_path):
+    store = MmapQuotaStore(tmp_path / "quota.mmap", slots=2)
+    store.incr("r", b"1")
+    store.incr("r", b"2")
+    with pytest.raises(ValueError):
+        store.incr("r", b"3")
+    with pytest.raises(ValueError):
+        store.get("r", b"x" * 100)
+    store.close()
+
+    # the existing table size wins
+    store = MmapQuotaStore(tmp_path / "quota.mmap", slots=100)
+    assert store.slots == 2
+    assert store.get("r", b"2") == 1
+    store.close()
+
+
+def test_sqlite_store_close(tmp_path):
+    store = SqliteQuotaStore(tmp_path / "quota.db")
+    used = threading.Event()
+    closed = threading.Event()
+
+    def user():
+        store.incr("r", b"p")
+        used.set()
+        closed.wait(5)
+
+    thread = threading.Thread(target=user)
+    thread.start()
+    used.wait(5)
+    store.close()
+    # the last connection to close removes the write-ahead log
+    assert not (tmp_path / "quota.db-wal").exists()
+    closed.set()
+    thread.join()
+
+
+@pytest.mark.parametrize("sync", [True, False])
+def test_journal_store(tmp_path, sync):
+    path = tmp_path / "quota"
+    store = JournalQuotaStore(path, sync=sync, interval=0.01)
+    assert store.incr("r1", b"p1", limit=2)
+    assert store.incr("r1", b"p1", limit=2)
+    assert not store.incr("r1", b"p1", limit=2)
+    assert store.incr("r1", b"p2", 5)
+    store.clear("r1", b"p2")
+    assert store.incr("r2", b"p1")
+    with pytest.raises(ValueError):
+        JournalQuotaStore(path)
+    store.close()
+
+    store = JournalQuotaStore(path, compact_bytes=200)
+    assert sorted(store.items()) == [("r1", b"p1", 2), ("r2", b"p1", 1)]
+    for i in range(10):
+        store.incr("r3", b"p%i" % i)
+    # compacted into a snapshot, and a new journal
+    assert store.generation >= 1
+    assert os.path.getsize(str(path) + ".journal") < 200
+    store.incr("r3", b"p0")
+    store.close()
+
+    store = JournalQuotaStore(path)
+    assert store.get("r3", b"p0") == 2
+    assert store.get("r1", b"p1") == 2
+    assert len(list(store.items())) == 12
+    store.close()
+
+
+def test_journal_crash(tmp_path):
+    path = tmp_path / "quota"
+    store = JournalQuotaStore(path)
+    store.incr("r", b"p", 3)
+    store.compact()
+    store.incr("r", b"p")
+    store.incr("r", b"q")
+    store.close()
+    journal = str(path) + ".journal"
+
+    # a torn record at the end is ignored, and dropped
+    size = os.path.getsize(journal)
+    with open(journal, "r+b") as fh:
+        fh.truncate(size - 3)
+    store = JournalQuotaStore(path)
+    assert (store.get("r", b"p"), store.get("r", b"q")) == (4, 0)
+    store.incr("r", b"q")
+    store.close()
+    store = JournalQuotaStore(path)
+    assert (store.get("r", b"p"), store.get("r", b"q")) == (4, 1)
+
+    # crash after the snapshot was replaced, before the journal was: the journal of
+    # the previous generation is already in the snapshot
+    with open(journal, "rb") as fh:
+        old_journal = fh.read()
+    store.compact()
+    store.close()
+    with open(journal, "wb") as fh:
+        fh.write(old_journal)
+    store = JournalQuotaStore(path)
+    assert (store.get("r", b"p"), store.get("r", b"q")) == (4, 1)
+
+    # crash while compacting, with the new journal shorter than its header
+    store.compact()
+    store.close()
+    with open(journal, "wb") as fh:
+        fh.write(JournalQuotaStore.JOURNAL_MAGIC)
+    store = JournalQuotaStore(path)
+    assert (store.get("r", b"p"), store.get("r", b"q")) == (4, 1)
+    store.incr("r", b"q")
+    store.close()
+    store = JournalQuotaStore(path)
+    assert (store.get("r", b"p"), store.get("r", b"q")) == (4, 2)
+    store.close()
+
+
+def test_journal_write_error(tmp_path, monkeypatch):
+    path = tmp_path / "quota"
+    store = JournalQuotaStore(path)
+    store.incr("r", b"p")
+    write = os.write
+    writes = []
+
+    def full_disk(fd, data):
+        # part of the first write, then no space left
+        if writes:
+            raise OSError(28, "No space left on device")
+        writes.append(data)
+        return write(fd, data[:5])
+
+    monkeypatch.setattr(os, "write", full_disk)
+    with pytest.raises(OSError):
+        store.incr("r", b"p")
+    with pytest.raises(OSError):
+        store.incr("r", b"q")
+    monkeypatch.setattr(os, "write", write)
+    # failed increments are cancelled
+    assert (store.get("r", b"p"), store.get("r", b"q")) == (1, 0)
+
+    # written by the next commit, over the partial write, with their cancellations
+    store.incr("r", b"q")
+    assert (store.get("r", b"p"), store.get("r", b"q")) == (1, 1)
+    store.close()
+    store = JournalQuotaStore(path)
+    assert (store.get("r", b"p"), store.get("r", b"q")) == (1, 1)
+    store.close()
+
+
+def test_journal_group_commit(tmp_path, monkeypatch):
+    store = JournalQuotaStore(tmp_path / "quota")
+    fsync = os.fsync
+    fsyncs = []
+
+    def slow_fsync(fd):
+        fsyncs.append(fd)
+        # long enough for the other threads to append their records meanwhile
+        time.sleep(0.1)
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+    ready = threading.Barrier(8)
+
+    def work(i):
+        ready.wait()
+        assert store.incr("r", b"p%i" % i)
+
+    with ThreadPool(8) as pool:
+        pool.map(work, range(8))
+    # the first commit, then one for the records appended while it was syncing
+    assert len(fsyncs) <= 2
+    monkeypatch.setattr(os, "fsync", fsync)
+    store.close()
+    store = JournalQuotaStore(tmp_path / "quota")
+    assert len(list(store.items())) == 8
+    store.close()
+
+
+class StoreQuotaRule(RulePlugin):
+    stores_quota = True
+
+    @staticmethod
+    def name():
+        return "store_quota"
+
+    def quota_key(self, request):
+        return request.profile.profile_id
+
+    def approve_request(self, request):
+        return (
+            self.quota_store.get(self.rule_id, request.profile.profile_id)
+            < self.args["limit"]
+        )
+
+    def use_quota(self, request):
+        return self.quota_store.incr(
+            self.rule_id, request.profile.profile_id, limit=self.args["limit"]
+        )
+
+    def at_quota(self, profile: ProfileInfo):
+        used = self.quota_store.get(self.rule_id, profile.profile_id)
+        return used >= self.args["limit"]
+
+    def at_quota_many(self, profiles):
+        used = self.quota_store.get_many(self.rule_id, [p.profile_id for p in profiles])
+        return [count >= self.args["limit"] for count in used]
+
+    def clear_quota(self, profile: ProfileInfo):
+        self.quota_store.clear(self.rule_id, profile.profile_id)
+
+    def release_quota(self, request):
+        self.quota_store.incr(self.rule_id, request.profile.profile_id, -1)
+
+
+class ReserveQuotaRule(StoreQuotaRule):
+    """Only checks its limit when using it, as if another process raced us."""
+
+    @staticmethod
+    def name():
+        return "reserve_quota"
+
+    def approve_request(self, request):
+        return True
+
+
+@pytest.mark.parametrize("mode", ["walked", "compiled", "async"])
+def test_quota_rollback(store, mode):
+    info = {
+        RequestType.DECRYPT.value: [
+            [
+                {"rule": "store_quota", "limit": 5, "rule_id": "first"},
+                {"rule": "reserve_quota", "limit": 2, "rule_id": "second"},
+            ]
+        ]
+    }
+    re = RuleEngine.from_dict(info, quota_store=store)
+    if mode == "compiled":
+        re.compile()
+    req = TestApprovalRequest()
+    for _ in range(4):
+        if mode == "async":
+            asyncio.run(re.approve_request_async(req))
+        else:
+            re.approve_request(req)
+    pid = req.profile.profile_id
+    # the second rule refused twice, the first rule's counts were released
+    assert store.get("second", pid) == 2
+    assert store.get("first", pid) == 2
+
+
+def test_engines_share_store(tmp_path):
+    info = {RequestType.DECRYPT.value: [[{"rule": "store_quota", "limit": 3}]]}
+    store = SqliteQuotaStore(tmp_path / "quota.db")
+    # two "workers", with their own engines and connections
+    re1 = RuleEngine.from_dict(json.loads(json.dumps(info)), quota_store=store)
+    re2 = RuleEngine.from_dict(
+        info, quota_store=SqliteQuotaStore(tmp_path / "quota.db")
+    )
+    pi = TestProfileInfo(profile_id=b"pid1")
+    req = TestApprovalRequest(profile=pi)
+
+    assert re1.approve_request(req)
+    assert re2.approve_request(req)
+    assert not re1.at_quota(pi)
+    assert re1.approve_request(req)
+    assert re2.at_quota(pi)
+    assert not re2.approve_request(req)
+    assert not re1.approve_request(req)
+
+    re2.clear_quota(pi)
+    assert not re1.at_quota(pi)
+    assert re1.approve_request(req)
+
+    # a quota used up by another process between check and use denies the request
+    rule = re1.map[RequestType.DECRYPT][0][0]
+    store.incr(rule.rule_id, b"pid2", 3)
+    assert (
+        rule.use_quota(TestApprovalRequest(profile=TestProfileInfo(b"pid2"))) is False
+    )
+
+
+def test_default_store():
+    re = RuleEngine.from_dict(
+        {RequestType.DECRYPT.value: [[{"rule": "store_quota", "limit": 1}]]}
+    )
+    assert isinstance(re.quota_store, MemoryQuotaStore)
+    assert re.approve_request(TestApprovalRequest())
+    assert not re.approve_request(TestApprovalRequest())
+
+
+def test_reload_keeps_store():
+    info = {RequestType.DECRYPT.value: [[{"rule": "store_quota", "limit": 1}]]}
+    old = RuleEngine.from_dict(json.loads(json.dumps(info)))
+    assert old.approve_request(TestApprovalRequest())
+
+    re = RuleEngine.from_dict(json.loads(json.dumps(info)), previous=old)
+    (rule,) = re.rules()
+    assert rule is next(old.rules())
+    assert re.quota_store is old.quota_store
+    # the reused rule and the engine's index count in the same store
+    assert re.at_quota(TestProfileInfo())
+    assert re.quota_report() == {TestProfileInfo().profile_id: [rule.rule_id]}
+
+    # with another store, rules are not reused, they would count in the old one
+    re = RuleEngine.from_dict(
+        json.loads(json.dumps(info)), quota_store=MemoryQuotaStore(), previous=old
+    )
+    (rule,) = re.rules()
+    assert rule.quota_store is re.quota_store
+    assert not re.at_quota(TestProfileInfo())
+    assert re.quota_report() == {}
+
+
+class CountingQuotaRule(StoreQuotaRule):
+    checked = 0
+
+    @staticmethod
+    def name():
+        return "counting_quota"
+
+    def at_quota(self, profile: ProfileInfo):
+        CountingQuotaRule.checked += 1
+        return super().at_quota(profile)
+
+    def at_quota_many(self, profiles):
+        CountingQuotaRule.checked += len(profiles)
+        return super().at_quota_many(profiles)
+
+
+class IndexRateRule(RateLimitRule):
+    @staticmethod
+    def name():
+        return "index_rate"
+
+
+def test_quota_index():
+    shared = CountingQuotaRule({"rule_id": "shared", "limit": 1})
+    rate = IndexRateRule({"rule_id": "rate", "limit": 1, "period": 3600})
+    other = StoreQuotaRule({"rule_id": "other", "limit": 2})
+    re = RuleEngine(
+        {
+            RequestType.DECRYPT: RuleTree([RuleSet([shared, rate]), RuleSet([other])]),
+            RequestType.SEARCH: RuleTree([RuleSet([shared])]),
+        }
+    )
+    # the store holds counters of rules from other engines too
+    re.quota_store.incr("foreign", b"pid9")
+    # the shared rule is registered, and asked, once
+    assert [r.rule_id for r in re._quotas.rules].count("shared") == 1
+    CountingQuotaRule.checked = 0
+    assert not re.at_quota(TestProfileInfo(b"pid1"))
+    assert CountingQuotaRule.checked == 1
+    assert re.quota_index() == {}
+
+    for pid in (b"pid1", b"pid2"):
+        assert re.approve_request(TestApprovalRequest(profile=TestProfileInfo(pid)))
+    assert re.approve_request(
+        TestApprovalRequest(RequestType.SEARCH, profile=TestProfileInfo(b"pid3"))
+    )
+    assert re.approve_request(TestApprovalRequest(profile=TestProfileInfo(b"pid1")))
+
+    index = re.quota_index()
+    assert set(index) == {b"pid1", b"pid2", b"pid3"}
+    assert set(index[b"pid1"]) == {shared, rate, other}
+    assert index[b"pid3"] == (shared,)
+
+    CountingQuotaRule.checked = 0
+    assert sorted(re.profiles_at_quota()) == [b"pid1", b"pid2", b"pid3"]
+    assert CountingQuotaRule.checked == 3
+
+    re.clear_quota(TestProfileInfo(b"pid3"))
+    assert b"pid3" not in re.quota_index()
+
+    # rules added to the map later are indexed too
+    late = IndexRateRule({"rule_id": "late", "limit": 1, "period": 3600})
+    late.limiter.consume(b"pid4")
+    re.map[RequestType.SEARCH][0].append(late)
+    assert re.at_quota(TestProfileInfo(b"pid4"))
+    rule = IndexRateRule({"rule_id": "tree", "limit": 1, "period": 3600})
+    rule.limiter.consume(b"pid5")
+    tree = RuleTree([RuleSet([rule])])
+    re.map[RequestType.RENAME] = tree
+    assert re.at_quota(TestProfileInfo(b"pid5"))
+    assert {r.rule_id for r in re.quota_rules} >= {"late", "tree"}
+
+
+class FailingQuotaRule(CountingQuotaRule):
+    @staticmethod
+    def name():
+        return "failing_quota"
+
+    def at_quota_many(self, profiles):
+        raise ValueError
+
+    def at_quota(self, profile: ProfileInfo):
+        if profile.profile_id == b"bad":
+            raise ValueError
+        return super().at_quota(profile)
+
+
+def test_quota_report(store):
+    failing = FailingQuotaRule({"rule_id": "failing", "limit": 1})
+    rate = IndexRateRule({"rule_id": "rate", "limit": 1, "period": 3600})
+    other = StoreQuotaRule({"rule_id": "other", "limit": 2})
+    re = RuleEngine(
+        {RequestType.DECRYPT: RuleTree([RuleSet([failing, rate]), RuleSet([other])])},
+        quota_store=store,
+    )
+    for pid in (b"pid1", b"pid1", b"pid2", b"bad"):
+        assert re.approve_request(TestApprovalRequest(profile=TestProfileInfo(pid)))
+    assert store.get_many("other", [b"pid1", b"pid2", b"none"]) == [1, 0, 0]
+
+    profiles = [TestProfileInfo(pid) for pid in (b"pid1", b"pid2", b"pid3", b"bad")]
+    assert re.quota_report(profiles) == {
+        b"pid1": ["failing", "rate"],
+        b"pid2": ["failing", "rate"],
+        b"pid3": [],
+        b"bad": ["rate"],
+    }
+    assert re.quota_report() == {
+        b"pid1": ["failing", "rate"],
+        b"pid2": ["failing", "rate"],
+        b"bad": ["rate"],
+    }
+    assert sorted(re.profiles_at_quota()) == [b"bad", b"pid1", b"pid2"]
@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+from multiprocessing.pool import ThreadPool
+
+import pytest
+
+from atakama import RuleEngine, RequestType
+from atakama.rate_limit import TokenBucket, FixedWindow, SlidingWindow, RateLimitRule
+
+from tests.test_rulesets import TestApprovalRequest, TestProfileInfo
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = Clock()
+    tb = TokenBucket(3, 30, clock=clock)
+    assert all(tb.consume(b"p") for _ in range(3))
+    assert not tb.consume(b"p")
+    assert tb.at_limit(b"p")
+    assert tb.allow(b"other")
+
+    # one token per 10 seconds
+    clock.now += 10
+    assert tb.allow(b"p")
+    assert tb.consume(b"p")
+    assert not tb.consume(b"p")
+
+    tb.clear(b"p")
+    assert tb.available(b"p") == 3
+
+    # refunds never exceed the burst
+    assert tb.consume(b"p")
+    tb.refund(b"p")
+    tb.refund(b"p")
+    assert tb.available(b"p") == 3
+
+
+def test_fixed_window():
+    clock = Clock()
+    fw = FixedWindow(2, 60, clock=clock)
+    assert fw.consume(b"p") and fw.consume(b"p")
+    assert not fw.consume(b"p")
+    fw.refund(b"p")
+    assert fw.consume(b"p")
+    # next aligned window, uses of the previous one are not refunded
+    clock.now += 60 - clock.now % 60
+    assert fw.consume(b"p")
+    fw.refund(b"p")
+    fw.refund(b"p")
+    assert fw.available(b"p") == 2
+
+
+def test_sliding_window():
+    clock = Clock()
+    clock.now = 6000.0
+    sw = SlidingWindow(10, 60, clock=clock)
+    assert sum(sw.consume(b"p") for _ in range(12)) == 10
+
+    # half way into the next window, half of the previous one still counts
+    clock.now += 90
+    assert sw.available(b"p") == pytest.approx(5)
+    assert sum(sw.consume(b"p") for _ in range(10)) == 5
+
+    # two windows later, everything is forgotten
+    clock.now += 120
+    assert sw.available(b"p") == 10
+
+
+@pytest.mark.parametrize("cls", [TokenBucket, FixedWindow, SlidingWindow])
+def test_idle_keys_expire(cls):
+    clock = Clock()
+    lim = cls(5, 10, clock=clock)
+    for i in range(1000):
+        lim.consume(i)
+    assert len(lim) == 1000
+    clock.now += lim.idle_expiry + 1
+    lim.consume(b"new")
+    assert len(lim) == 1
+
+
+def test_limiter_threads():
+    fw = FixedWindow(100, 3600)
+    with ThreadPool(8) as pool:
+        assert sum(pool.map(lambda _: fw.consume(b"p"), range(500))) == 100
+
+
+class ExampleRateRule(RateLimitRule):
+    @staticmethod
+    def name():
+        return "example_rate"
+
+
+def test_rate_limit_rule():
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "example_rate", "limit": 2, "period": 3600}],
+            [
+                {
+                    "rule": "example_rate",
+                    "limit": 1,
+                    "period": 3600,
+                    "algorithm": "fixed_window",
+                    "per": "device",
+                }
+            ],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    tree = re.map[RequestType.DECRYPT]
+    pi1, pi2 = TestProfileInfo(b"pid1"), TestProfileInfo(b"pid2")
+
+    assert re.approve_request(TestApprovalRequest(profile=pi1)) == id(tree[0])
+    assert re.approve_request(TestApprovalRequest(profile=pi1)) == id(tree[0])
+    assert re.at_quota(pi1)
+    assert not re.at_quota(pi2)
+    # falls through to the per-device ruleset
+    assert re.approve_request(TestApprovalRequest(profile=pi1)) == id(tree[1])
+    assert not re.approve_request(TestApprovalRequest(profile=pi1))
+    assert re.approve_request(TestApprovalRequest(profile=pi1, device_id=b"d2"))
+
+    re.clear_quota(pi1)
+    assert not re.at_quota(pi1)
+    assert re.approve_request(TestApprovalRequest(profile=pi1)) == id(tree[0])
+
+    with pytest.raises(AssertionError):
+        ExampleRateRule({"rule_id": "x", "limit": 1, "period": 1, "algorithm": "?"})
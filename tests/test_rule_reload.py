@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import threading
+import time
+
+import yaml
+
+from atakama import RequestType, RulePlugin
+from atakama.rate_limit import RateLimitRule
+from atakama.rule_reload import RuleEngineHolder
+
+from tests.test_rulesets import TestApprovalRequest
+
+
+class ReloadRateRule(RateLimitRule):
+    @staticmethod
+    def name():
+        return "reload_rate"
+
+
+class ReloadDeviceRule(RulePlugin):
+    @staticmethod
+    def name():
+        return "reload_device"
+
+    def approve_request(self, request):
+        return request.device_id == self.args["device"].encode()
+
+
+def write_policy(path, *rulesets):
+    with path.open("w") as f:
+        yaml.safe_dump({RequestType.DECRYPT.value: list(rulesets)}, f)
+
+
+RATE = [{"rule": "reload_rate", "limit": 2, "period": 3600}]
+
+
+def test_reload_carries_quota(tmp_path):
+    policy = tmp_path / "policy.yml"
+    write_policy(policy, RATE)
+    holder = RuleEngineHolder(policy, compile=True)
+    req = TestApprovalRequest()
+    assert holder.approve_request(req)
+
+    # unchanged rule keeps its count, new rulesets apply
+    write_policy(policy, RATE, [{"rule": "reload_device", "device": "dev"}])
+    old = holder.engine
+    assert holder.check()
+    assert holder.engine is not old
+    assert holder.engine.plan is not None
+    assert holder.engine.quota_store is old.quota_store
+    assert holder.generation == 1
+
+    assert holder.approve_request(req)
+    assert not holder.approve_request(req)
+    assert holder.approve_request(TestApprovalRequest(device_id=b"dev"))
+
+    # requests in flight on the old engine share the carried state
+    assert not old.approve_request(req)
+
+    # changed rules start over
+    write_policy(policy, [{"rule": "reload_rate", "limit": 3, "period": 3600}])
+    assert holder.reload()
+    assert holder.approve_request(req)
+
+    assert not holder.check()
+
+
+def test_bad_policy_keeps_engine(tmp_path):
+    policy = tmp_path / "policy.yml"
+    write_policy(policy, RATE)
+    holder = RuleEngineHolder(policy)
+    engine = holder.engine
+    policy.write_text("decrypt: [[{rule: no_such_rule}]]")
+    assert not holder.reload()
+    assert holder.engine is engine
+    assert holder.approve_request(TestApprovalRequest())
+
+
+def test_watch_and_swap_under_load(tmp_path):
+    policy = tmp_path / "policy.yml"
+    write_policy(policy, [{"rule": "reload_device", "device": "a"}])
+    holder = RuleEngineHolder(policy, poll_interval=0.01)
+    holder.start()
+    errors = []
+    done = threading.Event()
+
+    def hammer():
+        while not done.is_set():
+            try:
+                res = holder.approve_request(TestApprovalRequest(device_id=b"a"))
+                assert res is not None
+            except Exception as ex:  # pragma: no cover
+                errors.append(ex)
+
+    threads = [threading.Thread(target=hammer) for _ in range(4)]
+    for t in threads:
+        t.start()
+    try:
+        for i in range(5):
+            generation = holder.generation
+            devices = [{"rule": "reload_device", "device": "a"} for _ in range(i + 2)]
+            write_policy(policy, devices)
+            deadline = time.monotonic() + 5
+            while holder.generation == generation and time.monotonic() < deadline:
+                time.sleep(0.01)
+            assert holder.generation > generation
+    finally:
+        done.set()
+        for t in threads:
+            t.join()
+        holder.stop()
+
+    assert not errors
+    assert len(holder.engine.map[RequestType.DECRYPT][0]) == 6
+
+
+def test_reload_rule_set_lookup(tmp_path):
+    policy = tmp_path / "policy.yml"
+    device = [{"rule": "reload_device", "device": "dev"}]
+    write_policy(policy, device, [{"rule": "reload_device", "device": "other"}])
+    holder = RuleEngineHolder(policy)
+    rs_id = holder.approve_request(TestApprovalRequest(device_id=b"dev"))
+    gone_id = holder.approve_request(TestApprovalRequest(device_id=b"other"))
+    stable_id = holder.get_rule_set(rs_id).stable_id
+
+    write_policy(policy, device)
+    assert holder.reload()
+    # unchanged rulesets are reused, removed ones are found in the previous engine
+    assert holder.engine.get_rule_set(rs_id).stable_id == stable_id
+    assert holder.get_rule_set(gone_id).to_list()[0]["device"] == "other"
+
+    # stable ids are the same after a restart
+    restarted = RuleEngineHolder(policy)
+    assert restarted.get_rule_set(stable_id).to_list()[0]["device"] == "dev"
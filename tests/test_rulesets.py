@@ -1,7 +1,13 @@
 # SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
 # SPDX-License-Identifier: LGPL-3.0-or-later
 
+import dataclasses
+import hashlib
 import json
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from multiprocessing.pool import ThreadPool
 from typing import Optional
 
@@ -18,7 +24,12 @@ from atakama import (
     RuleTree,
     MetaInfo,
     RuleIdGenerator,
+    QUOTA_KEY_ALL,
+    EvaluationPlan,
+    FrozenApprovalRequest,
 )
+from atakama.quota_lock import QuotaLock
+from atakama.tracing import DecisionTracer
 
 
 class TestMetaInfo(MetaInfo):
@@ -458,6 +469,130 @@ def test_atomic_ruleset_evaluation(tmp_path):
     assert approvals == 50
 
 
+def test_keyed_ruleset_evaluation():
+    class ExampleRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "keyed"
+
+        def __init__(self, args):
+            super().__init__(args)
+            self.used = {}
+            self.active = 0
+            self.max_active = 0
+            self.active_lock = threading.Lock()
+
+        def quota_key(self, request):
+            return request.profile.profile_id
+
+        def approve_request(self, request):
+            with self.active_lock:
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            time.sleep(0.001)
+            with self.active_lock:
+                self.active -= 1
+            return self.used.get(request.profile.profile_id, 0) < 5
+
+        def use_quota(self, request):
+            pid = request.profile.profile_id
+            self.used[pid] = self.used.get(pid, 0) + 1
+
+    class ExampleStatelessRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "stateless"
+
+        def quota_key(self, request):
+            return None
+
+        def approve_request(self, request):
+            return True
+
+    rule = ExampleRule({"rule_id": "1"})
+    rs = RuleSet([rule, ExampleStatelessRule({"rule_id": "2"})])
+    profiles = [TestProfileInfo(profile_id=b"pid%i" % i) for i in range(8)]
+
+    def make_req(i):
+        return rs.approve_request(TestApprovalRequest(profile=profiles[i % 8]))
+
+    thread_pool = ThreadPool(16)
+    results = thread_pool.map(make_req, range(160))
+
+    # atomic per profile
+    assert results.count(True) == 40
+    assert all(rule.used[p.profile_id] == 5 for p in profiles)
+    # unrelated profiles were evaluated in parallel
+    assert rule.max_active > 1
+
+    # a rule touching all state makes the set exclusive again
+    class ExampleGlobalRule(ExampleStatelessRule):
+        @staticmethod
+        def name():
+            return "global"
+
+        def quota_key(self, request):
+            return QUOTA_KEY_ALL
+
+    rule = ExampleRule({"rule_id": "1"})
+    rs = RuleSet([rule, ExampleGlobalRule({"rule_id": "3"})])
+    thread_pool.map(make_req, range(32))
+    assert rule.max_active == 1
+
+    # keyed holders may reenter for the same key
+    class ReentrantRule(ExampleStatelessRule):
+        @staticmethod
+        def name():
+            return "reentrant"
+
+        def quota_key(self, request):
+            return request.profile.profile_id
+
+        def approve_request(self, request):
+            return request.device_id == b"inner" or rs.approve_request(
+                TestApprovalRequest(device_id=b"inner", profile=request.profile)
+            )
+
+    rs = RuleSet([ReentrantRule({"rule_id": "4"})])
+    assert rs.approve_request(TestApprovalRequest())
+
+
+def test_quota_lock_reentry():
+    lock = QuotaLock()
+    stripes = lock.stripes_for([b"pid"])
+    exclusive = threading.Event()
+
+    def exclusive_waiter():
+        lock.acquire(None)
+        exclusive.set()
+        lock.release(None)
+
+    def keyed_holder():
+        lock.acquire(stripes)
+        waiter = threading.Thread(target=exclusive_waiter)
+        waiter.start()
+        # let the waiter start waiting for us to drain
+        time.sleep(0.05)
+        assert not exclusive.is_set()
+        # reentry is not held up by the exclusive waiter
+        lock.acquire(stripes)
+        assert lock.try_acquire(stripes)
+        lock.release(stripes)
+        lock.release(stripes)
+        assert not exclusive.is_set()
+        lock.release(stripes)
+        waiter.join()
+
+    holder = threading.Thread(target=keyed_holder, daemon=True)
+    holder.start()
+    holder.join(5)
+    assert not holder.is_alive(), "deadlocked"
+    assert exclusive.is_set()
+    # the exclusive holder was able to drain keyed holders
+    assert lock.try_acquire(None)
+    lock.release(None)
+
+
 def test_rule_id_return():
     # noinspection PyUnusedLocal
     class ExampleRule(RulePlugin):
@@ -531,3 +666,643 @@ def test_rule_engine_defaults():
     re = RuleEngine.from_dict(info, defaults={"example_loader": {"poppy": 4}})
     rs = next(iter(re.map[RequestType.DECRYPT]))
     assert rs.find_rules(ExampleRule)[0].args["poppy"] == 4
+
+
+def test_compiled_engine():
+    class ExampleRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "compiled"
+
+        def approve_request(self, request):
+            if request.device_id == b"err":
+                raise ValueError
+            if request.device_id == b"none":
+                return None
+            return request.device_id == bytes.fromhex(self.args["param"])
+
+        def use_quota(self, request):
+            used.append(self.rule_id)
+
+    used = []
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "compiled", "param": b"1".hex()}],
+            [{"rule": "compiled", "param": b"2".hex()}],
+        ],
+        RequestType.SEARCH.value: [[{"rule": "compiled", "param": b"2".hex()}]],
+    }
+
+    plain = RuleEngine.from_dict(json.loads(json.dumps(info)))
+    re = RuleEngine.from_dict(info)
+    plan = re.compile()
+    assert len(plan.rules) == 3
+
+    for rtype in (RequestType.DECRYPT, RequestType.SEARCH, RequestType.RENAME):
+        for did in (b"1", b"2", b"3", b"err", b"none"):
+            req = TestApprovalRequest(request_type=rtype, device_id=did)
+            expect = plain.approve_request(req)
+            got = re.approve_request(req)
+            if expect:
+                assert (
+                    re.get_rule_set(got).to_list()
+                    == plain.get_rule_set(expect).to_list()
+                )
+            else:
+                assert got is expect
+
+    # only the winning ruleset uses quota
+    assert used[::2] == used[1::2]
+    assert len(used) == 6
+
+    # rules shared among rulesets and trees are compiled once
+    shared = ExampleRule({"rule_id": "s", "param": b"1".hex()})
+    tree = RuleTree([RuleSet([shared]), RuleSet([shared])])
+    re = RuleEngine({RequestType.DECRYPT: tree, RequestType.SEARCH: tree})
+    assert re.compile().rules == (shared,)
+    assert re.approve_request(TestApprovalRequest(device_id=b"1")) == id(tree[0])
+
+
+def test_shared_rule_memoization():
+    class ExampleRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "lookup"
+
+        def approve_request(self, request):
+            calls.append(self.rule_id)
+            return request.device_id == bytes.fromhex(self.args["param"])
+
+    class ExampleImpureRule(ExampleRule):
+        pure = False
+
+        @staticmethod
+        def name():
+            return "impure_lookup"
+
+    class ExampleDeviceRule(ExampleRule):
+        @staticmethod
+        def name():
+            return "device"
+
+    calls = []
+    info = {
+        RequestType.DECRYPT.value: [
+            [
+                {"rule": "lookup", "param": b"1".hex()},
+                {"rule": "device", "param": b"1".hex()},
+            ],
+            [
+                {"rule": "lookup", "param": b"1".hex()},
+                {"rule": "device", "param": b"2".hex()},
+            ],
+            [{"rule": "impure_lookup", "param": b"2".hex()}],
+            [{"rule": "impure_lookup", "param": b"2".hex()}],
+            [{"rule": "lookup", "param": b"1".hex()}],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    re.compile()
+    tree = re.map[RequestType.DECRYPT]
+
+    # the shared lookup is evaluated once, the impure rule each time
+    assert re.approve_request(TestApprovalRequest(device_id=b"3")) is False
+    assert len(calls) == 3
+    assert calls.count(tree[0][0].rule_id) == 1
+    assert calls[1:] == [tree[2][0].rule_id, tree[3][0].rule_id]
+
+    # memoized results still approve
+    calls.clear()
+    assert re.approve_request(TestApprovalRequest(device_id=b"1")) == id(tree[0])
+    assert len(calls) == 2
+
+    # the memo does not outlive the request
+    calls.clear()
+    assert re.approve_request(TestApprovalRequest(device_id=b"1")) == id(tree[0])
+    assert len(calls) == 2
+
+
+def test_adaptive_rule_ordering(monkeypatch):
+    class ExampleRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "adaptive"
+
+        def approve_request(self, request):
+            calls.append(self.rule_id)
+            if self.args.get("slow"):
+                time.sleep(0.001)
+            return request.device_id in self.args["devices"]
+
+        def use_quota(self, request):
+            used.append(self.rule_id)
+
+    calls, used = [], []
+    monkeypatch.setattr(EvaluationPlan, "SAMPLE_EVERY", 1)
+    monkeypatch.setattr(EvaluationPlan, "REORDER_EVERY", 8)
+
+    def make_rs(ordered=False):
+        rs = RuleSet(
+            [
+                ExampleRule({"rule_id": "slow", "slow": True, "devices": b"12"}),
+                ExampleRule({"rule_id": "cheap", "devices": b"1"}),
+            ]
+        )
+        rs.ordered = ordered
+        return rs
+
+    re = RuleEngine({RequestType.DECRYPT: RuleTree([make_rs()])})
+    re.compile(adaptive=True)
+    for _ in range(8):
+        assert not re.approve_request(TestApprovalRequest(device_id=b"2"))
+
+    # the cheap, rejecting rule is now evaluated first
+    calls.clear()
+    assert not re.approve_request(TestApprovalRequest(device_id=b"2"))
+    assert calls == ["cheap"]
+    # quotas are still used in declared order, only on approval
+    assert not used
+    assert re.approve_request(TestApprovalRequest(device_id=b"1"))
+    assert used == ["slow", "cheap"]
+
+    # declared ordering is kept
+    re = RuleEngine({RequestType.DECRYPT: RuleTree([make_rs(ordered=True)])})
+    re.compile(adaptive=True)
+    for _ in range(8):
+        re.approve_request(TestApprovalRequest(device_id=b"2"))
+    calls.clear()
+    re.approve_request(TestApprovalRequest(device_id=b"2"))
+    assert calls == ["slow", "cheap"]
+
+    # unordered trees try cheap, approving rulesets first
+    slow = RuleSet([ExampleRule({"rule_id": "slow", "slow": True, "devices": b""})])
+    cheap = RuleSet([ExampleRule({"rule_id": "cheap", "devices": b"1"})])
+    tree = RuleTree([slow, cheap])
+    re = RuleEngine({RequestType.DECRYPT: tree})
+    re.compile(adaptive=True)
+    for _ in range(8):
+        assert re.approve_request(TestApprovalRequest(device_id=b"1")) == id(cheap)
+    calls.clear()
+    re.approve_request(TestApprovalRequest(device_id=b"1"))
+    assert calls == ["slow", "cheap"]
+
+    tree.ordered = False
+    re.compile(adaptive=True)
+    for _ in range(8):
+        assert re.approve_request(TestApprovalRequest(device_id=b"1")) == id(cheap)
+    calls.clear()
+    assert re.approve_request(TestApprovalRequest(device_id=b"1")) == id(cheap)
+    assert calls == ["cheap"]
+
+
+def test_batch_approval():
+    class ExamplePathRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "batch_path"
+
+        def approve_request(self, request):
+            singles.append(request)
+            if request.auth_meta[0].meta == "/err":
+                raise ValueError
+            return request.auth_meta[0].meta.startswith(self.args["prefix"])
+
+        def approve_requests(self, requests):
+            batches.append(len(requests))
+            if any(r.auth_meta[0].meta == "/err" for r in requests):
+                raise ValueError
+            return [
+                r.auth_meta[0].meta.startswith(self.args["prefix"]) for r in requests
+            ]
+
+    class ExampleQuotaRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "batch_quota"
+
+        def approve_request(self, request):
+            return self.used.get(request.profile.profile_id, 0) < self.args["limit"]
+
+        def use_quota(self, request):
+            pid = request.profile.profile_id
+            self.used[pid] = self.used.get(pid, 0) + 1
+
+        def quota_key(self, request):
+            return request.profile.profile_id
+
+        def __init__(self, args):
+            super().__init__(args)
+            self.used = {}
+
+    singles, batches = [], []
+    info = {
+        RequestType.SEARCH.value: [
+            [
+                {"rule": "batch_path", "prefix": "/a"},
+                {"rule": "batch_quota", "limit": 2},
+            ],
+            [{"rule": "batch_path", "prefix": "/b"}],
+        ]
+    }
+    profiles = [TestProfileInfo(profile_id=b"pid%i" % i) for i in range(3)]
+    requests = [
+        TestApprovalRequest(
+            request_type=RequestType.SEARCH,
+            profile=profiles[(i // 3) % 3],
+            auth_meta=[TestMetaInfo(["/a", "/b", "/c"][i % 3])],
+        )
+        for i in range(30)
+    ]
+    requests.append(TestApprovalRequest(request_type=RequestType.DECRYPT))
+
+    sequential = RuleEngine.from_dict(json.loads(json.dumps(info)))
+    batch = RuleEngine.from_dict(info)
+    expect = [sequential.approve_request(r) for r in requests]
+    singles.clear()
+    got = batch.approve_requests(requests)
+
+    tree = batch.map[RequestType.SEARCH]
+    assert [batch.get_rule_set(x).to_list() if x else x for x in got] == [
+        sequential.get_rule_set(x).to_list() if x else x for x in expect
+    ]
+    assert got.count(id(tree[0])) == 6
+    assert got.count(id(tree[1])) == 10
+    assert got[-1] is None
+    # one vectorized call per ruleset
+    assert batches == [30, 24]
+    assert not singles
+
+    # vectorized errors are retried one by one
+    batches.clear()
+    requests[0] = TestApprovalRequest(
+        request_type=RequestType.SEARCH, auth_meta=[TestMetaInfo("/err")]
+    )
+    assert batch.approve_requests(requests[:2]) == [False, id(tree[1])]
+    assert len(singles) == 4
+
+    # rules after a stateful rule are evaluated in declared order, one by one
+    batches.clear()
+    singles.clear()
+    info = {
+        RequestType.SEARCH.value: [
+            [
+                {"rule": "batch_quota", "limit": 1},
+                {"rule": "batch_path", "prefix": "/a"},
+            ]
+        ]
+    }
+    batch = RuleEngine.from_dict(json.loads(json.dumps(info)))
+    rs_id = id(batch.map[RequestType.SEARCH][0])
+    assert batch.approve_requests(requests[1:7]) == [False, False, rs_id] * 2
+    assert not batches
+    assert len(singles) == 4
+
+    # compiled engines evaluate batches with their plan
+    tracer = DecisionTracer()
+    compiled = RuleEngine.from_dict(info, tracer=tracer)
+    assert compiled.approve_requests(requests[:2]) == [False, False]
+    assert len(tracer) == 2
+
+
+def test_parallel_tree_evaluation():
+    class ExampleSlowRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "parallel_slow"
+
+        def approve_request(self, request):
+            calls.append(self.rule_id)
+            time.sleep(self.args["delay"])
+            return request.device_id in self.args["devices"].encode()
+
+    class ExampleQuotaRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "parallel_quota"
+
+        def approve_request(self, request):
+            return used.get(self.rule_id, 0) < self.args["limit"]
+
+        def use_quota(self, request):
+            used[self.rule_id] = used.get(self.rule_id, 0) + 1
+
+    used, calls = {}, []
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "parallel_slow", "delay": 0.05, "devices": "x"}],
+            [
+                {"rule": "parallel_slow", "delay": 0.05, "devices": "ab"},
+                {"rule": "parallel_quota", "limit": 2},
+            ],
+            [{"rule": "parallel_slow", "delay": 0.05, "devices": "a"}],
+            [{"rule": "parallel_slow", "delay": 0.5, "devices": "a"}],
+        ]
+    }
+    re = RuleEngine.from_dict(info)
+    tree = re.map[RequestType.DECRYPT]
+
+    with ThreadPoolExecutor(4) as executor:
+        start = time.perf_counter()
+        assert re.approve_request_parallel(
+            TestApprovalRequest(device_id=b"a"), executor
+        ) == id(tree[1])
+        # the slow ruleset is not waited for
+        assert time.perf_counter() - start < 0.4
+
+        assert re.approve_request_parallel(
+            TestApprovalRequest(device_id=b"b"), executor
+        ) == id(tree[1])
+        # quota for set 1 is exhausted, same as the sequential engine
+        assert re.approve_request_parallel(
+            TestApprovalRequest(device_id=b"a"), executor
+        ) == id(tree[2])
+        assert not re.approve_request_parallel(
+            TestApprovalRequest(device_id=b"b"), executor
+        )
+        assert list(used.values()) == [2]
+        assert (
+            re.approve_request_parallel(
+                TestApprovalRequest(request_type=RequestType.SEARCH), executor
+            )
+            is None
+        )
+
+        # rules after a stateful rule are evaluated in order, after it approves
+        info = {
+            RequestType.DECRYPT.value: [
+                [
+                    {"rule": "parallel_quota", "limit": 0},
+                    {
+                        "rule": "parallel_slow",
+                        "delay": 0,
+                        "devices": "a",
+                        "rule_id": "r",
+                    },
+                ]
+            ]
+        }
+        re = RuleEngine.from_dict(info)
+        calls.clear()
+        assert not re.approve_request_parallel(
+            TestApprovalRequest(device_id=b"a"), executor
+        )
+        assert not calls
+
+
+def test_incremental_reload():
+    class ExampleRule(RulePlugin):
+        def __init__(self, args):
+            super().__init__(args)
+            built.append(args["param"])
+
+        @staticmethod
+        def name():
+            return "incremental"
+
+        def approve_request(self, request):
+            return request.device_id == self.args["param"].encode()
+
+    built = []
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "incremental", "param": "a"}],
+            [
+                {"rule": "incremental", "param": "b"},
+                {"rule": "incremental", "param": "c"},
+            ],
+        ],
+        RequestType.SEARCH.value: [[{"rule": "incremental", "param": "d"}]],
+    }
+    defaults = {"incremental": {"extra": 1}}
+    old = RuleEngine.from_dict(json.loads(json.dumps(info)), defaults=defaults)
+    assert sorted(built) == ["a", "b", "c", "d"]
+
+    info[RequestType.DECRYPT.value][1][1]["param"] = "e"
+    built.clear()
+    new = RuleEngine.from_dict(
+        json.loads(json.dumps(info)), defaults=defaults, previous=old
+    )
+    # only the changed rule is constructed
+    assert built == ["e"]
+
+    # same policy as a full rebuild
+    full = RuleEngine.from_dict(json.loads(json.dumps(info)), defaults=defaults)
+    assert new.to_dict() == full.to_dict()
+
+    # unchanged rules, rulesets and trees are the same instances
+    old_dec, new_dec = old.map[RequestType.DECRYPT], new.map[RequestType.DECRYPT]
+    assert new_dec is not old_dec
+    assert new_dec[0] is old_dec[0]
+    assert new_dec[1] is not old_dec[1]
+    assert new_dec[1][0] is old_dec[1][0]
+    assert new.map[RequestType.SEARCH] is old.map[RequestType.SEARCH]
+    assert new.approve_request(TestApprovalRequest(device_id=b"a")) == id(old_dec[0])
+    assert new.approve_request(TestApprovalRequest(device_id=b"c")) is False
+
+    # defaults are part of the configuration
+    built.clear()
+    RuleEngine.from_dict(
+        json.loads(json.dumps(info)),
+        defaults={"incremental": {"extra": 2}},
+        previous=new,
+    )
+    assert len(built) == 4
+
+
+def test_policy_cache(tmp_path, monkeypatch):
+    class ExampleRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "example_cached"
+
+        def approve_request(self, request):
+            return request.device_id == self.args["device"].encode()
+
+    rule_yml = tmp_path / "rules.yml"
+    cache_dir = tmp_path / "cache"
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "example_cached", "device": "a"}],
+            [{"rule": "example_cached", "device": "a"}],
+        ]
+    }
+    rule_yml.write_text(yaml.safe_dump(info))
+
+    plain = RuleEngine.from_yml_file(rule_yml)
+    cold = RuleEngine.from_yml_file(rule_yml, cache_dir=cache_dir)
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # warm loads skip yaml parsing and rule id generation
+    def fail(*_args, **_kwargs):
+        raise AssertionError("not cached")
+
+    with monkeypatch.context() as m:
+        m.setattr(yaml, "load", fail)
+        m.setattr(RuleIdGenerator, "generate", fail)
+        m.setattr(RuleIdGenerator, "hash_many", fail)
+        warm = RuleEngine.from_yml_file(rule_yml, cache_dir=cache_dir)
+    assert plain.to_dict() == cold.to_dict() == warm.to_dict()
+    assert warm.approve_request(TestApprovalRequest(device_id=b"a"))
+
+    # changes invalidate the cache entry
+    info[RequestType.DECRYPT.value][0][0]["device"] = "b"
+    rule_yml.write_text(yaml.safe_dump(info))
+    changed = RuleEngine.from_yml_file(rule_yml, cache_dir=cache_dir)
+    assert changed.approve_request(TestApprovalRequest(device_id=b"b"))
+    assert len(list(cache_dir.iterdir())) == 1
+
+    # corrupt entries are ignored
+    next(cache_dir.iterdir()).write_bytes(b"garbage")
+    assert RuleEngine.from_yml_file(rule_yml, cache_dir=cache_dir).to_dict() == (
+        changed.to_dict()
+    )
+
+
+def test_rule_id_algorithms():
+    # noinspection PyUnusedLocal
+    class ExampleRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "example_ids"
+
+        def approve_request(self, request):
+            return True
+
+    def legacy(ent):
+        data = json.dumps(ent, sort_keys=True, separators=(",", ":"))
+        return hashlib.md5(data.encode("utf8")).hexdigest()
+
+    ents = [{"rule": "example_ids", "n": i % 5, "name": "\u00e9"} for i in range(20)]
+    ents[3]["rule_id"] = legacy(ents[0])
+    info = {"decrypt": [ents[:10], ents[10:]], "search": [[dict(ents[0])]]}
+
+    # compatible with ids from previous releases
+    compat = json.loads(json.dumps(info))
+    RuleIdGenerator().inject_policy(compat)
+    expect = json.loads(json.dumps(info))
+    rgen = RuleIdGenerator()
+    for ruleset in expect["decrypt"] + expect["search"]:
+        for ent in ruleset:
+            rgen.inject_rule_id(ent)
+    assert compat == expect
+    assert compat["decrypt"][0][0]["rule_id"] == legacy(ents[0])
+    # the explicit id in entry 3 counts as a use
+    assert compat["decrypt"][0][5]["rule_id"] == legacy(ents[0]) + ".3"
+
+    fast = json.loads(json.dumps(info))
+    RuleIdGenerator("blake2b").inject_policy(fast)
+    ids = [ent["rule_id"] for ruleset in fast["decrypt"] for ent in ruleset]
+    assert len(set(ids)) == len(ids)
+    assert fast["decrypt"][0][0]["rule_id"] != legacy(ents[0])
+
+    # same ids when hashed in a process pool
+    pooled = json.loads(json.dumps(info))
+    with ProcessPoolExecutor(2) as executor:
+        RuleIdGenerator("blake2b", executor, chunk_size=3).inject_policy(pooled)
+    assert pooled == fast
+
+    re = RuleEngine.from_dict(pooled, rgen=RuleIdGenerator("blake2b"))
+    assert (
+        re.to_dict()
+        == RuleEngine.from_dict(
+            json.loads(json.dumps(info)), rgen=RuleIdGenerator("blake2b")
+        ).to_dict()
+    )
+
+    # from_dict registers each id once: the generator continues their sequence
+    rgen = RuleIdGenerator()
+    RuleEngine.from_dict(json.loads(json.dumps(info)), rgen=rgen)
+    again = dict(ents[1])
+    rgen.inject_rule_id(again)
+    assert again["rule_id"] == legacy(ents[1]) + ".5"
+
+
+def test_rule_set_index():
+    class ExampleRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "example_index"
+
+        def approve_request(self, request):
+            return request.device_id == self.args["device"].encode()
+
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "example_index", "device": "a"}],
+            [{"rule": "example_index", "device": "b"}],
+        ],
+        RequestType.SEARCH.value: [[{"rule": "example_index", "device": "a"}]],
+    }
+    re = RuleEngine.from_dict(json.loads(json.dumps(info)))
+    rs_id = re.approve_request(TestApprovalRequest(device_id=b"b"))
+    rset = re.get_rule_set(rs_id)
+    assert rset is re.map[RequestType.DECRYPT][1]
+    assert re.get_rule_set(rset.stable_id) is rset
+
+    # stable ids don't depend on the process, and differ per ruleset
+    again = RuleEngine.from_dict(json.loads(json.dumps(info)))
+    assert again.get_rule_set(rset.stable_id).to_list() == rset.to_list()
+    stable_ids = [rs.stable_id for tree in re.map.values() for rs in tree]
+    assert len(set(stable_ids)) == 3
+
+    with pytest.raises(IndexError):
+        re.get_rule_set(0)
+    with pytest.raises(IndexError):
+        re.get_rule_set("nope")
+
+    # rulesets added after construction are found
+    added = RuleSet([ExampleRule({"rule_id": "added", "device": "c"})])
+    re.map[RequestType.DECRYPT].append(added)
+    assert re.get_rule_set(id(added)) is added
+
+    # and removed ones are not
+    re.map[RequestType.DECRYPT].remove(rset)
+    with pytest.raises(IndexError):
+        re.get_rule_set(rs_id)
+    with pytest.raises(IndexError):
+        re.get_rule_set(rset.stable_id)
+    # nor those of replaced trees
+    search = re.map[RequestType.SEARCH][0]
+    assert re.get_rule_set(id(search)) is search
+    re.map[RequestType.SEARCH] = RuleTree([added])
+    with pytest.raises(IndexError):
+        re.get_rule_set(id(search))
+
+
+def test_frozen_requests():
+    class ExampleRule(RulePlugin):
+        @staticmethod
+        def name():
+            return "example_frozen"
+
+        def approve_request(self, request):
+            return (
+                request.device_id == b"ok"
+                and request.auth_meta[0].meta == "/meta"
+                and "w1" in request.profile.profile_words
+            )
+
+    req = TestApprovalRequest(device_id=b"ok")
+    frozen = FrozenApprovalRequest.from_request(req)
+    assert FrozenApprovalRequest.from_request(frozen) is frozen
+    assert dataclasses.asdict(frozen.to_request()) == dataclasses.asdict(req)
+    assert frozen == FrozenApprovalRequest.from_request(
+        TestApprovalRequest(device_id=b"ok")
+    )
+    assert len({frozen, FrozenApprovalRequest.from_request(req)}) == 1
+    assert frozen != FrozenApprovalRequest.from_request(TestApprovalRequest())
+    assert pickle.loads(pickle.dumps(frozen)) == frozen
+    assert hash(pickle.loads(pickle.dumps(frozen))) == hash(frozen)
+    assert isinstance(frozen.profile.profile_words, tuple)
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        frozen.device_id = b"other"
+    assert not hasattr(frozen, "__dict__")
+
+    info = {RequestType.DECRYPT.value: [[{"rule": "example_frozen"}]]}
+    re = RuleEngine.from_dict(info)
+    rs_id = re.approve_request(req)
+    assert rs_id
+    assert re.approve_request(frozen) == rs_id
+    assert re.approve_requests([frozen, req]) == [rs_id, rs_id]
+    re.compile()
+    assert re.approve_request(frozen) == rs_id
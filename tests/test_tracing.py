@@ -0,0 +1,128 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import json
+
+from atakama import RuleEngine, RequestType, RulePlugin
+from atakama.metrics import EngineMetrics
+from atakama.tracing import DecisionTracer
+
+from tests.test_rulesets import TestApprovalRequest, TestProfileInfo
+
+
+class TraceRule(RulePlugin):
+    @staticmethod
+    def name():
+        return "trace_device"
+
+    def approve_request(self, request):
+        if request.device_id == b"err":
+            raise ValueError
+        return request.device_id == self.args["device"].encode()
+
+
+INFO = {
+    RequestType.DECRYPT.value: [
+        [{"rule": "trace_device", "device": "a", "rule_id": "ra"}],
+        [
+            {"rule": "trace_device", "device": "b", "rule_id": "rb"},
+            {"rule": "trace_device", "device": "b", "rule_id": "rb2"},
+        ],
+    ]
+}
+
+
+def test_tracing():
+    tracer = DecisionTracer(size=3, clock=lambda: 1.0)
+    re = RuleEngine.from_dict(json.loads(json.dumps(INFO)), tracer=tracer)
+    assert re.plan is not None and re.plan.tracer is tracer
+    set_a, set_b = (rset.stable_id for rset in re.map[RequestType.DECRYPT])
+
+    re.approve_request(TestApprovalRequest(device_id=b"b"))
+    re.approve_request(
+        TestApprovalRequest(device_id=b"err", profile=TestProfileInfo(b"other"))
+    )
+    re.approve_request(TestApprovalRequest(request_type=RequestType.SEARCH))
+
+    first, err, search = tracer.dump()
+    assert first.result == id(re.map[RequestType.DECRYPT][1])
+    assert first.ruleset == set_b
+    assert first.steps == (
+        (set_a, "ra", False),
+        (set_b, "rb", True),
+        (set_b, "rb2", True),
+    )
+    assert err.steps == ((set_a, "ra", "error"), (set_b, "rb", "error"))
+    assert err.result is False and err.ruleset is None
+    assert search.result is None and search.steps == ()
+    assert search.to_dict()["request_type"] == "search"
+
+    assert tracer.dump(b"other") == [err]
+
+    # ring buffer
+    re.approve_request(TestApprovalRequest(device_id=b"a"))
+    assert len(tracer) == 3
+    assert tracer.dump()[0] is err
+
+    # recompiling keeps tracing, metrics still count
+    metrics = EngineMetrics(sample_every=1)
+    re.compile(adaptive=True, metrics=metrics)
+    tracer.clear()
+    re.approve_request(TestApprovalRequest(device_id=b"a"))
+    assert tracer.dump()[0].steps == ((set_a, "ra", True),)
+    assert metrics.rules["ra"].outcomes[0] == 1
+
+
+def test_no_tracing():
+    re = RuleEngine.from_dict(json.loads(json.dumps(INFO)))
+    assert re.tracer is None and re.plan is None
+    re.compile()
+    assert not re.plan._observed
+
+
+class QuotaTraceRule(RulePlugin):
+    @staticmethod
+    def name():
+        return "trace_quota"
+
+    def approve_request(self, request):
+        return self.quota_store.get(self.rule_id, request.profile.profile_id) < 1
+
+    def use_quota(self, request):
+        self.quota_store.incr(self.rule_id, request.profile.profile_id)
+
+
+def test_explain():
+    info = json.loads(json.dumps(INFO))
+    info[RequestType.DECRYPT.value].append([{"rule": "trace_quota", "rule_id": "rq"}])
+    re = RuleEngine.from_dict(info)
+    set_a, set_b, set_q = (rset.stable_id for rset in re.map[RequestType.DECRYPT])
+
+    expl = re.explain(TestApprovalRequest(device_id=b"b"))
+    assert expl.result == id(re.map[RequestType.DECRYPT][1])
+    assert expl.ruleset == set_b
+    assert [r.ruleset for r in expl.rulesets] == [set_a, set_b]
+    assert [r.approved for r in expl.rulesets] == [False, True]
+    assert [(r.rule_id, r.result) for r in expl.rulesets[1].rules] == [
+        ("rb", True),
+        ("rb2", True),
+    ]
+    assert all(r.elapsed >= 0 for r in expl.rulesets[1].rules)
+
+    err = re.explain(TestApprovalRequest(device_id=b"err"))
+    rule = err.rulesets[0].rules[0]
+    assert (rule.result, rule.error) == (None, "ValueError()")
+    assert err.to_dict()["rulesets"][2]["rules"][0]["rule_id"] == "rq"
+
+    # explaining uses no quota, compiled plans are explained in their order
+    req = TestApprovalRequest(device_id=b"c")
+    re.compile()
+    for _ in range(3):
+        assert re.explain(req).ruleset == set_q
+    assert re.approve_request(req)
+    expl = re.explain(req)
+    assert expl.result is False and expl.ruleset is None
+    assert expl.rulesets[2].rules[0].result is False
+
+    search = TestApprovalRequest(request_type=RequestType.SEARCH)
+    assert re.explain(search).result is None
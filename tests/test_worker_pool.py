@@ -0,0 +1,122 @@
+# SPDX-FileCopyrightText: © Atakama, Inc <support@atakama.com>
+# SPDX-License-Identifier: LGPL-3.0-or-later
+
+import dataclasses
+import json
+import os
+import time
+from concurrent.futures import TimeoutError
+
+import pytest
+
+from atakama import RuleEngine, RequestType, RulePlugin, MetaInfo
+from atakama.quota import MmapQuotaStore
+from atakama.worker_pool import WorkerPool, encode_request, decode_request
+
+from tests.test_quota import StoreQuotaRule
+
+# the policies use ExampleRateRule, "example_rate"
+from tests.test_rate_limit import ExampleRateRule
+from tests.test_rulesets import TestApprovalRequest, TestProfileInfo
+
+
+class PoolRule(RulePlugin):
+    @staticmethod
+    def name():
+        return "pool_device"
+
+    def approve_request(self, request):
+        if request.device_id == b"exit":
+            os._exit(1)
+        if request.device_id == b"slow":
+            time.sleep(0.5)
+        return request.device_id == self.args["device"].encode()
+
+
+INFO = {
+    RequestType.DECRYPT.value: [
+        [{"rule": "pool_device", "device": "a"}],
+        [{"rule": "pool_device", "device": "b"}, {"rule": "store_quota", "limit": 5}],
+    ]
+}
+
+
+def test_request_encoding():
+    req = TestApprovalRequest(
+        device_id=b"d", auth_meta=[MetaInfo("/a", True), MetaInfo("/b", False)]
+    )
+    decoded = decode_request(encode_request(req))
+    assert dataclasses.asdict(decoded) == dataclasses.asdict(req)
+
+
+def test_worker_pool(tmp_path):
+    with pytest.raises(ValueError):
+        WorkerPool(RuleEngine.from_dict(json.loads(json.dumps(INFO))))
+
+    store = MmapQuotaStore(tmp_path / "quota.mmap", slots=64)
+    engine = RuleEngine.from_dict(json.loads(json.dumps(INFO)), quota_store=store)
+    tree = engine.map[RequestType.DECRYPT]
+    assert isinstance(tree[1][1], StoreQuotaRule)
+    with WorkerPool(engine, workers=3) as pool:
+        assert len(pool) == 3
+        rs_id = pool.approve_request(TestApprovalRequest(device_id=b"a"))
+        assert pool.get_rule_set(rs_id) is tree[0]
+        assert (
+            pool.approve_request(TestApprovalRequest(request_type=RequestType.SEARCH))
+            is None
+        )
+
+        # the quota is shared by all workers
+        requests = [TestApprovalRequest(device_id=b"b") for _ in range(9)]
+        results = pool.approve_requests(requests)
+        assert results.count(id(tree[1])) == 5 and results.count(False) == 4
+        profile = TestProfileInfo()
+        assert pool.at_quota(profile)
+        pool.clear_quota(profile)
+        assert pool.approve_request(TestApprovalRequest(device_id=b"b"))
+        assert pool.approve_requests([]) == []
+
+        # timeouts, the late replies are dropped
+        with pytest.raises(TimeoutError):
+            pool.approve_request(TestApprovalRequest(device_id=b"slow"), timeout=0.05)
+        requests = [TestApprovalRequest(device_id=b"slow")] * 3
+        with pytest.raises(TimeoutError):
+            pool.approve_requests(requests, timeout=0.05)
+        requests = [TestApprovalRequest(device_id=b"a")] * 3
+        assert pool.approve_requests(requests, timeout=5) == [id(tree[0])] * 3
+
+        # a batch that was not sent is not left pending
+        worker = pool._workers[0]
+        send_bytes = worker.conn.send_bytes
+
+        def broken(data):
+            raise BrokenPipeError()
+
+        worker.conn.send_bytes = broken
+        with pytest.raises(BrokenPipeError):
+            pool.approve_requests([TestApprovalRequest(device_id=b"a")] * 3)
+        assert not worker.pending
+        worker.conn.send_bytes = send_bytes
+
+        # a worker that dies fails its requests, not the others
+        with pytest.raises(RuntimeError):
+            pool.approve_requests([TestApprovalRequest(device_id=b"exit")])
+        requests = [TestApprovalRequest(device_id=b"a")] * 4
+        assert pool.approve_requests(requests) == [id(tree[0])] * 4
+
+    with pytest.raises(RuntimeError):
+        pool.approve_request(TestApprovalRequest(device_id=b"a"))
+
+
+def test_worker_pool_local_quotas(tmp_path):
+    # limiters in each worker's memory would each allow the whole limit
+    info = {
+        RequestType.DECRYPT.value: [
+            [{"rule": "example_rate", "limit": 5, "period": 3600}],
+        ]
+    }
+    store = MmapQuotaStore(tmp_path / "quota.mmap", slots=64)
+    engine = RuleEngine.from_dict(info, quota_store=store)
+    with pytest.raises(ValueError, match="example_rate"):
+        WorkerPool(engine, workers=2)
+    store.close()